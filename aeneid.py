@@ -12,16 +12,135 @@ from aeneid.utils import utils as utils
 import re
 from aeneid.utils import webutils as wu
 from aeneid.dbservices.DataExceptions import DataException
+import aeneid.dbservices.QueryLog as QueryLog
+import aeneid.dbservices.Metrics as Metrics
+import aeneid.dbservices.Serializer as Serializer
 from flask import Response
+from flask import g
 import logging
+import hashlib
+import time
 from urllib.parse import urlencode
+from aeneid.utils import asgiutils
+from aeneid.utils import compressutils
+from aeneid.utils.asgiutils import AsgiResponse
+import aeneid.dbservices.AsyncRDBDataTable as AsyncRDBDataTable
 
 # Default delimiter to delineate primary key fields in string.
 key_delimiter = "_"
 
+# Query parameters of _aggregate that are not part of the query template. The functions are
+# BaseDataTable.aggregate_functions.
+aggregate_parameters = ['group_by', 'order_by', 'limit', 'count', 'sum', 'avg', 'min', 'max']
+
+# Query parameters on a collection GET that are not part of the query template.
+collection_parameters = ['fields', 'limit', 'offset', 'order_by', 'cursor', 'paging', 'stream', 'ids', 'include', 'count']
+
+
+# Query parameters that the async path serves on the event loop. Requests with other (non-template) parameters
+# go to the Flask views.
+async_parameters = ['fields', 'limit', 'offset', 'order_by']
+
 
 app = Flask(__name__)
 
+# The same routes as an ASGI app. Plain GETs of rows and collections run on the event loop with
+# AsyncRDBDataTable. Everything else runs the Flask views in a bounded threadpool of AENEID_WSGI_THREADS threads.
+asgi_app = asgiutils.AsgiApp(app, max_workers=int(os.environ.get("AENEID_WSGI_THREADS", "32")))
+asgi_app.on_shutdown(AsyncRDBDataTable.close_pools)
+
+# Optionally preload table metadata and DB connections on a background thread. This does not delay startup.
+if os.environ.get("AENEID_WARM_UP", "0") == "1":
+    ds.warm_up(background=True)
+
+# Optionally log a sample of the queries, e.g. AENEID_QUERY_LOG=0.01 logs 1% of them. Off by default.
+if os.environ.get("AENEID_QUERY_LOG", None):
+    QueryLog.configure(rate=float(os.environ["AENEID_QUERY_LOG"]))
+
+# Response compression: AENEID_COMPRESSION=0 turns it off, AENEID_COMPRESSION_MIN_SIZE is the smallest body (bytes)
+# to compress and AENEID_COMPRESSION_LEVEL sets the level of every encoding.
+if os.environ.get("AENEID_COMPRESSION", "1") == "0":
+    compressutils.enabled = False
+if os.environ.get("AENEID_COMPRESSION_MIN_SIZE", None):
+    compressutils.min_size = int(os.environ["AENEID_COMPRESSION_MIN_SIZE"])
+if os.environ.get("AENEID_COMPRESSION_LEVEL", None):
+    for e in compressutils.levels:
+        compressutils.levels[e] = int(os.environ["AENEID_COMPRESSION_LEVEL"])
+
+# Queries slower than this (milliseconds) go in the slow query log.
+if os.environ.get("AENEID_SLOW_QUERY_MS", None):
+    Metrics.slow_query_ms = float(os.environ["AENEID_SLOW_QUERY_MS"])
+
+
+@app.before_request
+def start_timer():
+    g.start_time = time.perf_counter()
+
+
+@app.after_request
+def record_latency(response):
+    # Label by the route pattern, not the URL, so that the number of series stays fixed.
+    if Metrics.enabled and "start_time" in g:
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        Metrics.observe("aeneid_request_duration_seconds",
+                        {"route": route, "method": request.method, "status": str(response.status_code)},
+                        (time.perf_counter() - g.start_time) * 1000.0)
+    return response
+
+
+def get_template(parameters):
+    """
+
+    :param parameters: Query parameters that are not part of the template.
+    :return: The query template from the other parameters of ?f1=v1&f2=v2& ..., or None.
+    """
+    tmp = None
+    for k, v in request.args.items():
+        if k not in parameters:
+            if tmp is None:
+                tmp = {}
+            tmp[k] = v
+
+    return tmp
+
+
+def get_includes(dbname, resource, field_list):
+    """
+
+    :param dbname: Schema of the resource.
+    :param resource: dbschema.table_name
+    :param field_list: The requested fields, or None.
+    :return: (list of related dbschema.table_names from ?include=r1,r2, field list extended with the join
+        columns needed to load them, the join columns to remove from the response because they were not
+        requested)
+    """
+    include = request.args.get('include', None)
+    if not include:
+        return [], field_list, []
+
+    related = [dbname + "." + r for r in include.split(",")]
+    field_list, extra_columns = ds.get_include_fields(resource, related, field_list)
+
+    return related, field_list, extra_columns
+
+
+def get_batch_size():
+    """
+
+    :return: The ?batch_size= parameter, default 1000. Raises a data_error, i.e. a 400, if it is not a positive
+        integer.
+    """
+    batch_size = request.args.get('batch_size', '1000')
+    try:
+        result = int(batch_size)
+    except ValueError:
+        result = 0
+
+    if result <= 0:
+        raise DataException(DataException.data_error, "batch_size must be a positive integer")
+
+    return result
+
 
 def get_location(dbname, resource_name, k):
 
@@ -31,22 +150,38 @@ def get_location(dbname, resource_name, k):
     return result
 
 
-def compute_links(result, limit, offset):
+def compute_links(result, limit, offset, next_cursor=None):
+
+    args = {}
+    for k, v in request.args.items():
+        args[k] = v
+
+    return make_links(result, request.url, request.base_url, args, limit, offset, next_cursor)
+
 
+def make_links(result, url, base, args, limit, offset, next_cursor=None):
+    """
+
+    :param result: The response document. Links are added to it.
+    :param url: The request URL.
+    :param base: The request URL without the query string.
+    :param args: The query parameters, as a dictionary.
+    :return: The result with the self and next links.
+    """
     result['links'] = []
 
-    self = {"rel": "self", "href": request.url}
+    self = {"rel": "self", "href": url}
     result['links'].append(self)
 
-    next_offset = int(offset) + int(limit)
+    args = dict(args)
 
-    base = request.base_url
-    args = {}
-    for k, v in request.args.items():
-        if not k == 'offset':
-            args[k] = v
-        else:
-            args[k] = next_offset
+    # In keyset mode, the next page is identified by an opaque cursor. Otherwise, bump the offset.
+    if next_cursor is not None:
+        args['cursor'] = next_cursor
+    elif limit is not None and 'cursor' not in args and args.get('paging', None) != 'keyset':
+        args['offset'] = int(offset or 0) + int(limit)
+    else:
+        return result
 
     params = urlencode(args)
     self = {"rel": "next", "href": base + "?" + params}
@@ -55,6 +190,169 @@ def compute_links(result, limit, offset):
     return result
 
 
+def data_exception_response(e):
+    """
+
+    :param e: A DataException raised by the data service.
+    :return: 400 for bad requests (e.g. unknown columns), 404 for unknown tables, otherwise 500.
+    """
+    utils.debug_message("Data exception, e = ", str(e))
+    return Response(str(e.message), status=data_exception_status(e), mimetype="text/plain")
+
+
+def data_exception_status(e):
+    """
+
+    :param e: A DataException.
+    :return: The HTTP status for the exception.
+    """
+    if e.code == DataException.data_error:
+        return 400
+    elif e.code == DataException.no_such_resource:
+        return 404
+    else:
+        return 500
+
+
+def compute_etag(result_data):
+    if isinstance(result_data, str):
+        result_data = result_data.encode('utf-8')
+    return hashlib.sha1(result_data).hexdigest()
+
+
+def not_modified_response(resource):
+    """
+
+    :param resource: dbschema.table_name
+    :return: A 304 response if the request's If-None-Match matches the ETag of the last response for this
+        request and the table has not changed since. Otherwise, None.
+    """
+    if not request.if_none_match:
+        return None
+
+    etag = ds.get_etag(resource, request.full_path)
+    if etag is not None:
+        return etag_not_modified_response(etag)
+
+    return None
+
+
+def etag_not_modified_response(etag):
+    """
+
+    :param etag: ETag of the uncompressed body.
+    :return: A 304 response if If-None-Match has the ETag of the body in any encoding, otherwise None.
+    """
+    for t in compressutils.variant_etags(etag):
+        if request.if_none_match.contains(t):
+            resp = Response(status=304)
+            resp.set_etag(t)
+            resp.vary.add("Accept-Encoding")
+            return resp
+
+    return None
+
+
+def compressed_body(resource, etag, encoding, data, version, route):
+    """
+
+    :return: The body compressed with encoding, from the result cache if it was compressed before.
+    """
+    result = ds.get_compressed(resource, etag, encoding)
+    if result is not None:
+        if Metrics.enabled:
+            Metrics.increment("aeneid_compression_cache_hits_total", {"route": route, "encoding": encoding})
+        return result
+
+    result = compressutils.compress(data, encoding, route)
+    ds.put_compressed(resource, etag, encoding, result, version)
+    return result
+
+
+def json_response(resource, result, version):
+    """
+
+    :param resource: dbschema.table_name
+    :param result: The result to return as JSON.
+    :param version: The table version from before the result was read.
+    :return: A 200 response with a strong ETag, or 304 if the client already has this body. The body is
+        compressed if the client accepts it and it is at least compressutils.min_size bytes. A compressed body
+        has the ETag etag-<encoding>.
+    """
+    with Metrics.timer("serialize", resource):
+        result_data = Serializer.dumpb(result, ds.get_encoders(resource))
+    ds.record_response_size(resource, len(result_data))
+    etag = compute_etag(result_data)
+    ds.put_etag(resource, request.full_path, etag, version)
+
+    if request.if_none_match:
+        not_modified = etag_not_modified_response(etag)
+        if not_modified is not None:
+            return not_modified
+
+    encoding = compressutils.choose_encoding(request.headers.get("Accept-Encoding", None), len(result_data))
+    if encoding is not None:
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        result_data = compressed_body(resource, etag, encoding, result_data, version, route)
+
+    resp = Response(result_data, status=200, mimetype='application/json')
+    resp.vary.add("Accept-Encoding")
+    if encoding is not None:
+        resp.headers["Content-Encoding"] = encoding
+        resp.set_etag(etag + "-" + encoding)
+    else:
+        resp.set_etag(etag)
+    return resp.make_conditional(request)
+
+
+def wants_stream():
+    """
+
+    :return: None for a normal response, 'ndjson' for newline delimited JSON (Accept: application/x-ndjson or
+        ?stream=ndjson) or 'json' for a chunked JSON document (?stream=true).
+    """
+    s = request.args.get('stream', None)
+    if s == 'ndjson' or (s is None and request.accept_mimetypes.best == 'application/x-ndjson'):
+        return 'ndjson'
+    if s is not None and s.lower() in ('true', '1', 'json'):
+        return 'json'
+    return None
+
+
+def stream_response(rows, mode, links, encoders=None):
+    """
+
+    Send rows as they are read from the DB, so memory use does not depend on the size of the result.
+
+    :param rows: Generator over the rows.
+    :param mode: 'ndjson' or 'json'
+    :param links: The links section for a JSON document.
+    :param encoders: Column encoders for the rows, from ds.get_encoders()
+    :return: A streaming response.
+    """
+    # Read the first row now, so that a failing query produces an error status instead of a truncated body.
+    first = next(rows, None)
+
+    def ndjson():
+        if first is not None:
+            yield Serializer.dumpb(first, encoders) + b"\n"
+        for r in rows:
+            yield Serializer.dumpb(r, encoders) + b"\n"
+
+    def json_document():
+        yield b'{"data": ['
+        if first is not None:
+            yield Serializer.dumpb(first, encoders)
+        for r in rows:
+            yield b", " + Serializer.dumpb(r, encoders)
+        yield b'], "links": ' + Serializer.dumpb(links) + b'}'
+
+    if mode == 'ndjson':
+        return Response(ndjson(), status=200, mimetype='application/x-ndjson')
+    else:
+        return Response(json_document(), status=200, mimetype='application/json')
+
+
 @app.route('/')
 def hello_world():
     return """
@@ -161,7 +459,55 @@ def api():
     return 'You probably want to call an API on one of the resources.'
 
 
-@app.route('/api/<dbname>/<resource_name>/<primary_key>', methods=['GET', 'PUT', 'DELETE'])
+@app.route('/stats/pool')
+def pool_stats():
+
+    result_data = json.dumps(ds.get_pool_stats(), default=str)
+    return Response(result_data, status=200, mimetype='application/json')
+
+
+@app.route('/stats/cache')
+def cache_stats():
+
+    result_data = json.dumps(ds.get_cache_stats(), default=str)
+    return Response(result_data, status=200, mimetype='application/json')
+
+
+@app.route('/stats/tables')
+def table_stats():
+
+    result_data = json.dumps(ds.get_table_stats(), default=str)
+    return Response(result_data, status=200, mimetype='application/json')
+
+
+@app.route('/stats/startup')
+def startup_stats():
+
+    result_data = json.dumps(ds.get_startup_stats(), default=str)
+    return Response(result_data, status=200, mimetype='application/json')
+
+
+@app.route('/stats/compression')
+def compression_stats():
+
+    result_data = json.dumps(compressutils.get_stats(), default=str)
+    return Response(result_data, status=200, mimetype="application/json")
+
+
+@app.route('/stats/slow_queries')
+def slow_queries():
+
+    result_data = json.dumps(ds.get_slow_queries(), default=str)
+    return Response(result_data, status=200, mimetype='application/json')
+
+
+@app.route('/metrics')
+def metrics():
+
+    return Response(ds.get_metrics(), status=200, mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/api/<dbname>/<resource_name>/<primary_key>', methods=['GET', 'HEAD', 'PUT', 'PATCH', 'DELETE'])
 def handle_resource(dbname, resource_name, primary_key):
 
     resp = Response("Internal server error", status=500, mimetype="text/plain")
@@ -175,19 +521,33 @@ def handle_resource(dbname, resource_name, primary_key):
         # This should probably occur in the data service and not here.
         resource = dbname + "." + resource_name
 
-        if request.method == 'GET':
+        # HEAD is a GET without the body. Flask drops the body and keeps the headers, e.g. the ETag.
+        if request.method in ('GET', 'HEAD'):
             # Look for the fields=f1,f2, ... argument in the query parameters.
             field_list = request.args.get('fields', None)
             if field_list is not None:
                 field_list = field_list.split(",")
 
+            # ?include=r1,r2 embeds the related rows.
+            includes, field_list, extra_columns = get_includes(dbname, resource, field_list)
+
+            # If the client has the current version, answer 304 without reading or serializing the row.
+            # Included rows come from other tables, so the version of this table is not enough.
+            version = ds.get_table_version(resource)
+            if not includes:
+                not_modified = not_modified_response(resource)
+                if not_modified is not None:
+                    return not_modified
+
             # Call the data service layer.
             result = ds.get_by_primary_key(resource, key_columns, field_list=field_list)
 
+            if result and includes:
+                result = ds.include_related(resource, [result], includes, drop_columns=extra_columns)[0]
+
             if result:
                 # We managed to find a row. Return JSON data and 200
-                result_data = json.dumps(result, default=str)
-                resp = Response(result_data, status=200, mimetype='application/json')
+                resp = json_response(resource, result, version)
             else:
                 resp = Response("NOT FOUND", status=404, mimetype='text/plain')
 
@@ -198,8 +558,35 @@ def handle_resource(dbname, resource_name, primary_key):
                 resp = Response("OK", status=200, mimetype='text/plain')
             else:
                 resp = Response("NOT FOUND", status=404, mimetype='text/plain')
-        else:
-            resp = Response("I am a teapot that will not PUT", status=422, mimetype='text/plain')
+
+        elif request.method in ('PUT', 'PATCH'):
+            # PUT replaces the row and PATCH changes only the columns in the body. Either creates the row if
+            # there is none, in one INSERT ... ON DUPLICATE KEY UPDATE.
+            new_r = request.get_json(silent=True)
+            if not isinstance(new_r, dict):
+                return Response("Expected a JSON object", status=400, mimetype="text/plain")
+
+            pk_columns = ds.get_primary_key_columns(resource)
+            if len(pk_columns) != len(key_columns):
+                return Response("Wrong number of key values", status=400, mimetype="text/plain")
+
+            key = dict(zip(pk_columns, key_columns))
+            for k, v in key.items():
+                if k in new_r and str(new_r[k]) != v:
+                    return Response("The key in the body does not match the URL", status=400,
+                                    mimetype="text/plain")
+
+            new_r.update(key)
+            result = ds.upsert(resource, new_r, partial=(request.method == 'PATCH'))
+
+            if result == 1:
+                resp = Response("CREATED", status=201, mimetype="text/plain")
+                resp.headers["Location"] = get_location(dbname, resource_name, key)
+            else:
+                resp = Response("OK", status=200, mimetype="text/plain")
+
+    except DataException as e:
+        resp = data_exception_response(e)
 
     except Exception as e:
         # We need a better overall approach to generating correct errors.
@@ -208,7 +595,189 @@ def handle_resource(dbname, resource_name, primary_key):
     return resp
 
 
-@app.route('/api/<dbname>/<resource_name>', methods=['GET', 'POST'])
+@app.route('/api/<dbname>/<resource_name>/<primary_key>/<related_resource>', methods=['GET', 'HEAD', 'POST'])
+def handle_related(dbname, resource_name, primary_key, related_resource):
+
+    resp = Response("Internal server error", status=500, mimetype="text/plain")
+
+    try:
+        key_columns = primary_key.split(key_delimiter)
+        resource = dbname + "." + resource_name
+        related = dbname + "." + related_resource
+
+        if request.method in ('GET', 'HEAD'):
+            field_list = request.args.get('fields', None)
+            if field_list is not None:
+                field_list = field_list.split(",")
+
+            limit = request.args.get('limit', None)
+            offset = request.args.get('offset', None)
+            order_by = request.args.get('order_by', None)
+
+            tmp = None
+            for k, v in request.args.items():
+                if k not in collection_parameters:
+                    if tmp is None:
+                        tmp = {}
+                    tmp[k] = v
+
+            # The result may depend on both tables, so there is no early 304 from the related table's version.
+            # json_response() still answers 304 if the body matches the client's ETag.
+            version = ds.get_table_version(related)
+            result = ds.get_related(resource, key_columns, related, tmp, field_list=field_list, limit=limit,
+                                    offset=offset, order_by=order_by)
+
+            if result:
+                result = {"data": result}
+                result = compute_links(result, limit, offset)
+                resp = json_response(related, result, version)
+            else:
+                resp = Response("Not found", status=404, mimetype="text/plain")
+
+        elif request.method == 'POST':
+            # Create a related row, e.g. a fantasy team for a manager. The foreign key columns come from the path.
+            new_r = request.get_json(silent=True)
+            if not isinstance(new_r, dict):
+                return Response("Expected a JSON object", status=400, mimetype="text/plain")
+
+            tmp = ds.get_related_template(resource, key_columns, related)
+            if tmp is None:
+                resp = Response("NOT FOUND", status=404, mimetype='text/plain')
+            else:
+                new_r.update(tmp)
+                result = ds.create(related, new_r)
+                if result and result == 1:
+                    related_key = {k: new_r.get(k, None) for k in ds.get_primary_key_columns(related)}
+                    resp = Response("CREATED", status=201, mimetype="text/plain")
+                    if all(v is not None for v in related_key.values()):
+                        resp.headers["Location"] = "/" + get_location(dbname, related_resource, related_key)
+
+    except DataException as e:
+        resp = data_exception_response(e)
+
+    except Exception as e:
+        utils.debug_message("Something awlful happened, e = ", e)
+
+    return resp
+
+
+def multi_get_response(resource, ids, field_list):
+    """
+
+    :param resource: dbschema.table_name
+    :param ids: List of primary keys, each in the form value1_value2_value3
+    :param field_list: Fields to return, or None.
+    :return: A response with the rows in the order of ids. Missing rows are null in data and listed in missing.
+    """
+    keys = [i.split(key_delimiter) for i in ids]
+    rows = ds.get_by_primary_keys(resource, keys, field_list=field_list)
+
+    result = {
+        "data": rows,
+        "missing": [ids[i] for i in range(0, len(ids)) if rows[i] is None]
+    }
+    result_data = Serializer.dumpb(result, ds.get_encoders(resource))
+    return Response(result_data, status=200, mimetype='application/json')
+
+
+@app.route('/api/<dbname>/<resource_name>/_mget', methods=['POST'])
+def handle_multi_get(dbname, resource_name):
+
+    resp = Response("Internal server error", status=500, mimetype="text/plain")
+
+    try:
+        resource = dbname + "." + resource_name
+
+        # The body is of the form { "ids": ["k1", "k2_k3", ...], "fields": ["f1", ...] }
+        body = request.get_json(silent=True)
+        ids = body.get("ids", None) if isinstance(body, dict) else None
+        if not isinstance(ids, list):
+            resp = Response("Body must contain a list of ids", status=400, mimetype="text/plain")
+        else:
+            resp = multi_get_response(resource, [str(i) for i in ids], body.get("fields", None))
+
+    except DataException as e:
+        resp = data_exception_response(e)
+
+    except Exception as e:
+        utils.debug_message("Something awlful happened, e = ", e)
+
+    return resp
+
+
+@app.route('/api/<dbname>/_batch', methods=['POST'])
+def handle_batch(dbname):
+
+    # The body is a list of operations, or {"operations": [...]}, see ds.batch_operations. They run in one
+    # transaction. The response has one result per operation; if one fails, nothing is changed and the error
+    # names the operation.
+    resp = Response("Internal server error", status=500, mimetype="text/plain")
+
+    try:
+        body = request.get_json(silent=True)
+        operations = body.get("operations", None) if isinstance(body, dict) else body
+        if not isinstance(operations, list):
+            return Response("Expected a list of operations", status=400, mimetype="text/plain")
+
+        batch_size = get_batch_size()
+        result = ds.batch(dbname, operations, batch_size=batch_size)
+        resp = Response(json.dumps({"results": result}, default=str), status=200, mimetype="application/json")
+
+    except DataException as e:
+        resp = data_exception_response(e)
+
+    except Exception as e:
+        utils.debug_message("Something awlful happened, e = ", e)
+
+    return resp
+
+
+@app.route('/api/<dbname>/<resource_name>/_aggregate', methods=['GET'])
+def handle_aggregate(dbname, resource_name):
+
+    resp = Response("Internal server error", status=500, mimetype="text/plain")
+
+    try:
+        resource = dbname + "." + resource_name
+
+        # ?group_by=teamID&sum=HR,H&count=*&order_by=sum_HR&yearID=2004
+        group_by = request.args.get('group_by', None)
+        group_by = group_by.split(",") if group_by else None
+
+        aggregates = []
+        for f in ['count', 'sum', 'avg', 'min', 'max']:
+            columns = request.args.get(f, None)
+            if columns:
+                aggregates.extend([[f, c] for c in columns.split(",")])
+
+        tmp = None
+        for k, v in request.args.items():
+            if k not in aggregate_parameters:
+                if tmp is None:
+                    tmp = {}
+                tmp[k] = v
+
+        version = ds.get_table_version(resource)
+        not_modified = not_modified_response(resource)
+        if not_modified is not None:
+            return not_modified
+
+        result = ds.get_aggregate(resource, tmp, group_by, aggregates or None,
+                                  order_by=request.args.get('order_by', None),
+                                  limit=request.args.get('limit', None))
+
+        resp = json_response(resource, {"data": result}, version)
+
+    except DataException as e:
+        resp = data_exception_response(e)
+
+    except Exception as e:
+        utils.debug_message("Something awlful happened, e = ", e)
+
+    return resp
+
+
+@app.route('/api/<dbname>/<resource_name>', methods=['GET', 'HEAD', 'POST', 'PUT', 'PATCH'])
 def handle_collection(dbname, resource_name):
 
     resp = Response("Internal server error", status=500, mimetype="text/plain")
@@ -218,6 +787,20 @@ def handle_collection(dbname, resource_name):
         # Form the compound resource names dbschema.table_name
         resource = dbname + "." + resource_name
 
+        # ?count=exact|estimate adds the total number of matching rows. HEAD returns only the count headers.
+        count_mode = request.args.get('count', None)
+
+        if request.method == 'HEAD':
+            tmp = get_template(collection_parameters)
+            unindexed = ds.check_filters(resource, tmp)
+            result = ds.get_count(resource, tmp, count_mode or 'exact')
+            resp = Response(status=200, mimetype="application/json")
+            if unindexed:
+                resp.headers["X-Filter-Warning"] = "No index on " + ",".join(unindexed)
+            resp.headers["X-Total-Count"] = str(result)
+            resp.headers["X-Total-Count-Type"] = count_mode or 'exact'
+            return resp
+
         if request.method == 'GET':
 
             # Get the field list if it exists.
@@ -229,42 +812,268 @@ def handle_collection(dbname, resource_name):
             offset = request.args.get('offset', None)
             order_by = request.args.get('order_by', None)
 
+            # ?paging=keyset or a cursor from a previous page selects keyset pagination.
+            cursor = request.args.get('cursor', None)
+            keyset = cursor is not None or request.args.get('paging', None) == 'keyset'
+
             # The query string is of the form ?f1=v1&f2=v2& ...
             # This maps to a query template of the form { "f1" : "v1", ... }
+            # Filters such as ?yearID[gte]=2000 stay in the template as { "yearID[gte]": "2000" }
             # We need to ignore the fields parameters.
             tmp = None
             for k, v in request.args.items():
-                if (not k == 'fields') and (not k == 'limit') and (not k == 'offset') and \
-                        (not k == 'order_by'):
+                if k not in collection_parameters:
                     if tmp is None:
                         tmp = {}
                     tmp[k] = v
 
+            # ?ids=k1,k2,... gets the rows for a list of primary keys with one query.
+            ids = request.args.get('ids', None)
+            if ids is not None:
+                return multi_get_response(resource, ids.split(","), field_list)
+
+            # Filters on a large table with no usable index are logged, or rejected, see ds.filter_policy.
+            unindexed = ds.check_filters(resource, tmp)
+
+            stream = wants_stream()
+            if stream is not None:
+                rows = ds.stream_by_template(resource, tmp, field_list=field_list, limit=limit, offset=offset,
+                                             order_by=order_by)
+                return stream_response(rows, stream, compute_links({}, limit, offset)['links'],
+                                       ds.get_encoders(resource))
+
+            includes, field_list, extra_columns = get_includes(dbname, resource, field_list)
+
+            version = ds.get_table_version(resource)
+            if not includes:
+                not_modified = not_modified_response(resource)
+                if not_modified is not None:
+                    return not_modified
+
             # Find by template.
-            result = ds.get_by_template(resource, tmp, field_list=field_list, limit=limit, offset=offset,
-                                        order_by=order_by)
+            next_cursor = None
+            if keyset:
+                result, next_cursor = ds.get_page(resource, tmp, field_list=field_list, limit=limit or 10,
+                                                  order_by=order_by, cursor=cursor)
+            else:
+                result = ds.get_by_template(resource, tmp, field_list=field_list, limit=limit, offset=offset,
+                                            order_by=order_by)
+
+            # One query per included resource for the whole page.
+            if result and includes:
+                result = ds.include_related(resource, result, includes, drop_columns=extra_columns)
+
+            total = ds.get_count(resource, tmp, count_mode) if count_mode else None
 
             if result:
                 result = {"data": result}
-                result = compute_links(result, limit, offset)
-                result_data = json.dumps(result, default=str)
-                resp = Response(result_data, status=200, mimetype='application/json')
+                result = compute_links(result, limit, offset, next_cursor)
+                if count_mode:
+                    result["meta"] = {"count": total, "count_type": count_mode}
+                resp = json_response(resource, result, version)
             else:
                 resp = Response("Not found", status=404, mimetype="text/plain")
 
+            if count_mode:
+                resp.headers["X-Total-Count"] = str(total)
+                resp.headers["X-Total-Count-Type"] = count_mode
+            if unindexed:
+                resp.headers["X-Filter-Warning"] = "No index on " + ",".join(unindexed)
+
         elif request.method == 'POST':
-            new_r = request.get_json()
-            result = ds.create(resource, new_r)
-            if result and result == 1:
-                resp = Response("CREATED", status=201, mimetype="text/plain")
+            new_r = request.get_json(silent=True)
+
+            # A JSON array is a bulk insert, done in batches instead of one statement and commit per row.
+            if isinstance(new_r, list):
+                if not all(isinstance(r, dict) for r in new_r):
+                    return Response("Expected a JSON array of objects", status=400, mimetype="text/plain")
+
+                batch_size = get_batch_size()
+                result = ds.create_many(resource, new_r, batch_size=batch_size)
+                result_data = json.dumps({"inserted": result})
+                resp = Response(result_data, status=201, mimetype="application/json")
+            elif not isinstance(new_r, dict):
+                return Response("Expected a JSON object or array", status=400, mimetype="text/plain")
+            else:
+                result = ds.create(resource, new_r)
+                if result and result == 1:
+                    resp = Response("CREATED", status=201, mimetype="text/plain")
+
+        elif request.method in ('PUT', 'PATCH'):
+            # Bulk upsert of a JSON array of records, each with its key columns. PUT replaces the rows, PATCH
+            # changes only the columns in each record.
+            new_r = request.get_json(silent=True)
+            if not isinstance(new_r, list) or not all(isinstance(r, dict) for r in new_r):
+                return Response("Expected a JSON array of objects", status=400, mimetype="text/plain")
+
+            batch_size = get_batch_size()
+            result = ds.upsert_many(resource, new_r, partial=(request.method == 'PATCH'), batch_size=batch_size)
+            result_data = json.dumps({"records": len(new_r), "affected_rows": result})
+            resp = Response(result_data, status=200, mimetype="application/json")
+
+
+    except DataException as e:
+        resp = data_exception_response(e)
+
+    except Exception as e:
+        utils.debug_message("Something awlful happened, e = ", e)
+
+    return resp
+
+
+
+def async_json_response(req, resource, result, version):
+    """
+
+    json_response() for the async path.
+    """
+    with Metrics.timer("serialize", resource):
+        result_data = Serializer.dumpb(result, ds.get_encoders(resource))
+    ds.record_response_size(resource, len(result_data))
+    etag = compute_etag(result_data)
+    ds.put_etag(resource, req.full_path, etag, version)
+
+    not_modified = async_etag_not_modified_response(req, etag)
+    if not_modified is not None:
+        return not_modified
+
+    headers = [("vary", "Accept-Encoding")]
+    encoding = compressutils.choose_encoding(req.headers.get("accept-encoding", None), len(result_data))
+    if encoding is not None:
+        result_data = compressed_body(resource, etag, encoding, result_data, version, req.route)
+        headers.append(("content-encoding", encoding))
+        etag = etag + "-" + encoding
+    headers.append(("etag", '"' + etag + '"'))
+
+    return AsgiResponse(result_data, status=200, mimetype='application/json', headers=headers)
+
+
+def async_etag_not_modified_response(req, etag):
+
+    for t in compressutils.variant_etags(etag):
+        if req.if_none_match(t):
+            return AsgiResponse(status=304, mimetype=None, headers=[("etag", '"' + t + '"'),
+                                                                    ("vary", "Accept-Encoding")])
+
+    return None
+
+
+def async_not_modified_response(req, resource):
+
+    etag = ds.get_etag(resource, req.full_path)
+    if etag is not None:
+        return async_etag_not_modified_response(req, etag)
 
+    return None
+
+
+@asgi_app.route("handle_resource")
+async def async_handle_resource(req, dbname, resource_name, primary_key):
+
+    # Only a GET of one row, with at most a field list, is served here. Returning None hands the request to
+    # handle_resource().
+    if req.method != 'GET' or [k for k in req.args if k != 'fields']:
+        return None
+
+    try:
+        key_columns = primary_key.split(key_delimiter)
+        resource = dbname + "." + resource_name
+
+        field_list = req.args.get('fields', None)
+        if field_list is not None:
+            field_list = field_list.split(",")
+
+        # Load the table metadata off the event loop before anything needs it.
+        await ds.warm_up_async(resource)
+
+        version = ds.get_table_version(resource)
+        not_modified = async_not_modified_response(req, resource)
+        if not_modified is not None:
+            return not_modified
+
+        result = await ds.get_by_primary_key_async(resource, key_columns, field_list=field_list)
+
+        if result:
+            resp = async_json_response(req, resource, result, version)
+        else:
+            resp = AsgiResponse("NOT FOUND", status=404, mimetype='text/plain')
+
+    except DataException as e:
+        utils.debug_message("Data exception, e = ", str(e))
+        resp = AsgiResponse(str(e.message), status=data_exception_status(e), mimetype="text/plain")
 
     except Exception as e:
         utils.debug_message("Something awlful happened, e = ", e)
+        resp = AsgiResponse("Internal server error", status=500, mimetype="text/plain")
 
     return resp
 
 
+@asgi_app.route("handle_collection")
+async def async_handle_collection(req, dbname, resource_name):
+
+    # Only a GET with a template, field list, limit, offset and order_by is served here. Keyset paging, streams,
+    # ids, includes and counts go to handle_collection().
+    if req.method != 'GET' or 'application/x-ndjson' in req.headers.get('accept', ''):
+        return None
+    if [k for k in req.args if k in collection_parameters and k not in async_parameters]:
+        return None
+
+    try:
+        resource = dbname + "." + resource_name
+
+        field_list = req.args.get('fields', None)
+        if field_list is not None:
+            field_list = field_list.split(",")
+
+        limit = req.args.get('limit', None)
+        offset = req.args.get('offset', None)
+        order_by = req.args.get('order_by', None)
+
+        tmp = None
+        for k, v in req.args.items():
+            if k not in collection_parameters:
+                if tmp is None:
+                    tmp = {}
+                tmp[k] = v
+
+        # Load the table metadata off the event loop before anything needs it.
+        await ds.warm_up_async(resource)
+        unindexed = ds.check_filters(resource, tmp)
+
+        version = ds.get_table_version(resource)
+        not_modified = async_not_modified_response(req, resource)
+        if not_modified is not None:
+            return not_modified
+
+        result = await ds.get_by_template_async(resource, tmp, field_list=field_list, limit=limit, offset=offset,
+                                                order_by=order_by)
+
+        if result:
+            result = {"data": result}
+            result = make_links(result, req.url, req.base_url, req.args, limit, offset)
+            resp = async_json_response(req, resource, result, version)
+        else:
+            resp = AsgiResponse("Not found", status=404, mimetype="text/plain")
+
+        if unindexed:
+            resp.headers.append(("x-filter-warning", "No index on " + ",".join(unindexed)))
+
+    except DataException as e:
+        utils.debug_message("Data exception, e = ", str(e))
+        resp = AsgiResponse(str(e.message), status=data_exception_status(e), mimetype="text/plain")
+
+    except Exception as e:
+        utils.debug_message("Something awlful happened, e = ", e)
+        resp = AsgiResponse("Internal server error", status=500, mimetype="text/plain")
+
+    return resp
+
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    # AENEID_ASGI=1 serves asgi_app with uvicorn, if it is installed. Otherwise, the Flask development server.
+    if os.environ.get("AENEID_ASGI", "0") == "1":
+        import uvicorn
+        uvicorn.run(asgi_app, host="127.0.0.1", port=5000)
+    else:
+        app.run(debug=True)
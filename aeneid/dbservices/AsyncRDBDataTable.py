@@ -0,0 +1,334 @@
+import asyncio
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aeneid.dbservices.BaseDataTable import BaseDataTable
+from aeneid.dbservices.DerivedDataTable import DerivedDataTable
+from aeneid.dbservices.RDBDataTable import RDBDataTable
+import aeneid.dbservices.ConnectionPool as ConnectionPool
+import aeneid.dbservices.QueryLog as QueryLog
+import aeneid.dbservices.Metrics as Metrics
+
+# The asyncio MySQL driver is optional. Without it, statements run on the blocking pymysql path in a bounded
+# threadpool, so the coroutines below still work, but each statement in flight holds a thread.
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None
+
+
+# Threads for the blocking path: statements when aiomysql is not installed, and operations that do not have
+# an async implementation. More threads than pool connections would only wait on the pool.
+max_workers = ConnectionPool._default_pool_params["max_size"]
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# The catalog reloads table metadata with the blocking driver after its ttl. warm_up() reloads it in the threadpool
+# when it expires within this many seconds, so that a request does not reload it on the event loop.
+metadata_margin = 30.0
+
+# Async pools, one per connect info and event loop. An aiomysql pool can only be used on the loop that
+# created it. The values are tasks, so that concurrent first requests create one pool.
+_pools = {}
+
+
+def get_executor():
+    """
+
+    :return: The bounded threadpool for blocking calls.
+    """
+    global _executor
+
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="aeneid-db")
+
+    return _executor
+
+
+async def run_sync(fn, *args, **kwargs):
+    """
+
+    Run a blocking function in the bounded threadpool, without blocking the event loop.
+
+    :param fn: Function to call.
+    :return: The function's result.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(fn, *args, **kwargs))
+
+
+def has_driver():
+    """
+
+    :return: True if statements run on the asyncio driver, False if they run in the threadpool.
+    """
+    return aiomysql is not None
+
+
+async def _create_pool(connect_info):
+    params = ConnectionPool._default_pool_params
+    return await aiomysql.create_pool(
+        host=connect_info['host'],
+        user=connect_info['user'],
+        password=connect_info['password'],
+        db=connect_info.get('db', None),
+        port=connect_info.get('port', 3306),
+        charset='utf8mb4',
+        cursorclass=aiomysql.DictCursor,
+        autocommit=False,
+        minsize=params["min_size"],
+        maxsize=params["max_size"])
+
+
+async def get_pool(connect_info):
+    """
+
+    :param connect_info: Dictionary with host, user, password, db and (optionally) port.
+    :return: The aiomysql pool for the connect info on the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    key = (ConnectionPool._pool_key(connect_info), id(loop))
+
+    task = _pools.get(key, None)
+    if task is None:
+        task = loop.create_task(_create_pool(connect_info))
+        _pools[key] = task
+
+    try:
+        return await task
+    except Exception:
+        # Do not keep a failed pool; the next call tries again.
+        if _pools.get(key, None) is task:
+            del _pools[key]
+        raise
+
+
+async def close_pools():
+    """
+
+    Close the async pools of the running event loop, e.g. on ASGI lifespan shutdown.
+
+    :return: None
+    """
+    loop_id = id(asyncio.get_running_loop())
+    for key in [k for k in _pools if k[1] == loop_id]:
+        task = _pools.pop(key)
+        try:
+            pool = await task
+        except Exception:
+            continue
+        pool.close()
+        await pool.wait_closed()
+
+
+def get_pool_stats():
+    """
+
+    :return: Dictionary of {"host:port/db": {"size": open connections, "free": idle connections}} for the
+        async pools that are open.
+    """
+    result = {}
+    for (k, loop_id), task in list(_pools.items()):
+        if task.done() and not task.cancelled() and task.exception() is None:
+            pool = task.result()
+            result[str(k[0]) + ":" + str(k[1]) + "/" + str(k[3])] = {"size": pool.size, "free": pool.freesize}
+
+    return result
+
+
+class AsyncRDBDataTable(BaseDataTable):
+    """
+    The BaseDataTable contract for a relational table, with coroutines instead of blocking methods. SQL is
+    compiled by an RDBDataTable for the same table, so validation, the statement cache and the table catalog
+    are shared with the blocking path. Only the execution differs.
+    """
+
+    def __init__(self, table_name, key_columns=None, connect_info=None, debug=True, default_fields=None,
+                 data_table=None):
+        """
+
+        :param table_name: The name of the RDB table.
+        :param key_columns: List, in order, of the columns (fields) that comprise the primary key.
+        :param connect_info: Dictionary of parameters necessary to connect to the data.
+        :param default_fields: Columns to select when the caller does not pass a field list.
+        :param data_table: The RDBDataTable for the table, if there is one already. Otherwise one is created.
+        """
+        if data_table is None:
+            data_table = RDBDataTable(table_name, key_columns=key_columns, connect_info=connect_info,
+                                      debug=debug, default_fields=default_fields)
+
+        super().__init__(table_name, data_table._connect_info, key_columns, debug)
+        self._table = data_table
+        self._ready = False
+
+    def __str__(self):
+        return "AsyncRDBDataTable: table_name = " + self._table_name + \
+               ", driver = " + ("aiomysql" if has_driver() else "threadpool")
+
+    def get_data_table(self):
+        """
+
+        :return: The blocking RDBDataTable for the table.
+        """
+        return self._table
+
+    async def warm_up(self):
+        """
+
+        Load the table metadata without blocking the event loop. The catalog uses the blocking driver, and
+        compiling a statement needs the metadata, so this runs before every statement. It only does work on
+        first use and when the metadata is about to expire.
+
+        :return: None
+        """
+        if not self._table.is_metadata_fresh(metadata_margin):
+            await run_sync(self._table.get_metadata, metadata_margin)
+
+        if not self._ready:
+            if has_driver():
+                await get_pool(self._connect_info)
+            self._ready = True
+
+    async def _run_q(self, q, args=None, fetch=True, commit=True):
+        """
+
+        :param q: SQL with %s slots.
+        :param args: Values for the slots.
+        :param fetch: If True, return the rows. Otherwise return the number of rows affected.
+        :param commit: If True, commit after the statement.
+        :return: Rows or row count.
+        """
+        if not has_driver():
+            return await run_sync(self._table._run_q, q, args=args, fields=None, fetch=fetch, commit=commit)
+
+        pool = await get_pool(self._connect_info)
+
+        async with pool.acquire() as cnx:
+            try:
+                async with cnx.cursor() as cursor:
+                    log_it = self._debug and QueryLog.is_enabled()
+                    timed = log_it or Metrics.enabled
+                    if timed:
+                        start = time.perf_counter()
+
+                    r = await cursor.execute(q, args)
+
+                    if timed:
+                        executed = time.perf_counter()
+
+                    if fetch:
+                        r = await cursor.fetchall()
+
+                if commit:
+                    await cnx.commit()
+
+                if timed:
+                    end = time.perf_counter()
+                    if Metrics.enabled:
+                        Metrics.record_query(self._table_name, q, (executed - start) * 1000.0,
+                                             (end - executed) * 1000.0)
+                    if log_it:
+                        QueryLog.log_query(self._table_name, q, args, (end - start) * 1000.0,
+                                           len(r) if fetch else r)
+
+            except Exception as e:
+                await cnx.rollback()
+                logging.exception("AsyncRDBDataTable._run_q: error = ", exc_info=True)
+                raise e
+
+        return r
+
+    def get_key_columns(self):
+        return self._table.get_key_columns()
+
+    def get_metadata(self):
+        return self._table.get_metadata()
+
+    def is_indexed(self, column):
+        return self._table.is_indexed(column)
+
+    async def find_by_template(self, template, field_list=None, limit=None, offset=None, order_by=None,
+                               keyset=False, after=None):
+        """
+
+        Same as RDBDataTable.find_by_template()
+
+        :return: A DerivedDataTable with the matching rows.
+        """
+        await self.warm_up()
+        q, args = self._table._build_select(template, field_list, limit, offset, order_by, keyset, after)
+        rows = await self._run_q(q, args=args, fetch=True)
+
+        with Metrics.timer("derived_build", self._table_name):
+            return DerivedDataTable("SELECT(" + self._table_name + ")", rows)
+
+    async def find_by_primary_key(self, key_fields, field_list=None):
+        """
+
+        :return: None, or a dictionary with the requested fields of the row with the key.
+        """
+        await self.warm_up()
+        tmp = dict(zip(self._table._get_primary_key_columns(), key_fields))
+        rows = (await self.find_by_template(tmp, field_list)).get_rows()
+
+        if rows:
+            return rows[0]
+        return None
+
+    async def find_by_primary_keys(self, keys, field_list=None):
+        return await run_sync(self._table.find_by_primary_keys, keys, field_list)
+
+    async def find_by_column_values(self, columns, values, field_list=None):
+        return await run_sync(self._table.find_by_column_values, columns, values, field_list)
+
+    async def count_by_template(self, template):
+        await self.warm_up()
+        q, args = self._table._build_count(template)
+        rows = await self._run_q(q, args=args, fetch=True)
+        return int(rows[0]["count"])
+
+    async def estimate_count(self, template):
+        return await run_sync(self._table.estimate_count, template)
+
+    async def aggregate(self, template, group_by=None, aggregates=None, order_by=None, limit=None):
+        return await run_sync(self._table.aggregate, template, group_by, aggregates, order_by, limit)
+
+    async def insert(self, new_record):
+        """
+
+        :param new_record: A dictionary representing a row to add.
+        :return: The number of rows inserted.
+        """
+        await self.warm_up()
+        q, args = self._table._build_insert(self._table_name, list(new_record.keys()),
+                                            list(new_record.values()))
+        return await self._run_q(q, args=args, fetch=False)
+
+    async def insert_many(self, new_records, batch_size=1000):
+        return await run_sync(self._table.insert_many, new_records, batch_size)
+
+    async def delete_by_template(self, template):
+        await self.warm_up()
+        q, args = self._table._build_delete(template)
+        return await self._run_q(q, args=args, fetch=False)
+
+    async def delete_by_key(self, key_fields):
+        await self.warm_up()
+        tmp = dict(zip(self._table._get_primary_key_columns(), key_fields))
+        return await self.delete_by_template(tmp)
+
+    async def update_by_template(self, template, new_values):
+        await self.warm_up()
+        q, args = self._table._build_update(template, new_values)
+        return await self._run_q(q, args=args, fetch=False)
+
+    async def update_by_key(self, key_fields, new_values):
+        await self.warm_up()
+        tmp = dict(zip(self._table._get_primary_key_columns(), key_fields))
+        return await self.update_by_template(tmp, new_values)
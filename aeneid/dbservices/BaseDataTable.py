@@ -3,6 +3,7 @@
 # Do not worry about understanding abstract base classes. This is just a class that defines
 # some methods that subclasses must implement.
 from abc import ABC, abstractmethod
+from aeneid.dbservices.DataExceptions import DataException
 
 
 class BaseDataTable(ABC):
@@ -11,6 +12,9 @@ class BaseDataTable(ABC):
     base class and implement the abstract methods.
     """
 
+    # Functions supported by aggregate().
+    aggregate_functions = ["count", "sum", "avg", "min", "max"]
+
     def __init__(self, table_name, connect_info, key_columns=None, debug=True):
         """
 
@@ -39,6 +43,97 @@ class BaseDataTable(ABC):
         """
         pass
 
+    def find_by_primary_keys(self, keys, field_list=None):
+        """
+
+        Find several records by primary key. Subclasses should override this with a single query or index
+        probe. The default calls find_by_primary_key() for each key.
+
+        :param keys: A list of key values, each a list in the order of the key_columns.
+        :param field_list: A subset of the fields of the records to return.
+        :return: A list with one entry per key, in the same order as keys. The entry is None if there is no
+            record with the key.
+        """
+        return [self.find_by_primary_key(k, field_list) for k in keys]
+
+    def find_by_column_values(self, columns, values, field_list=None):
+        """
+
+        Find the rows matching any of a list of values for some columns. Subclasses should override this with
+        a single query. The default calls find_by_template() for each value.
+
+        :param columns: List of columns, e.g. the foreign key columns.
+        :param values: List of value tuples, in the order of columns.
+        :param field_list: A subset of the fields of the records to return. The columns are always returned.
+        :return: Dictionary of {tuple of the string form of the values: [matching rows]}
+        """
+        if field_list is not None:
+            field_list = list(field_list) + [c for c in columns if c not in field_list]
+
+        result = {}
+        for v in values:
+            rows = self.find_by_template(dict(zip(columns, v)), field_list).get_rows()
+            if rows:
+                result[tuple(str(x) for x in v)] = rows
+
+        return result
+
+    def is_indexed(self, column):
+        """
+
+        :param column: Column name.
+        :return: True if filters on the column can use an index instead of scanning the table.
+        """
+        return False
+
+    def count_by_template(self, template):
+        """
+
+        :param template: Query template.
+        :return: The number of rows matching the template. The default reads the rows.
+        """
+        return len(self.find_by_template(template).get_rows())
+
+    def estimate_count(self, template):
+        """
+
+        :param template: Query template.
+        :return: An estimate of the number of rows matching the template. Engines that can estimate without
+            counting override this. The default is the exact count.
+        """
+        return self.count_by_template(template)
+
+    @staticmethod
+    def aggregate_name(function, column):
+        """
+
+        :return: The name of an aggregate in the result, e.g. sum_HR, or count for count(*).
+        """
+        return "count" if column == "*" else function + "_" + column
+
+    def _check_aggregates(self, aggregates):
+        for function, column in aggregates:
+            if function not in BaseDataTable.aggregate_functions:
+                raise DataException(DataException.data_error, "Unknown aggregate function " + str(function))
+            if column == "*" and function != "count":
+                raise DataException(DataException.data_error, function + "(*) is not supported")
+
+    @abstractmethod
+    def aggregate(self, template, group_by=None, aggregates=None, order_by=None, limit=None):
+        """
+
+        Compute aggregates over the rows matching a template, e.g. the sum of HR per team.
+
+        :param template: Query template selecting the rows.
+        :param group_by: List of columns to group on. If None, there is one group with all the rows.
+        :param aggregates: List of [function, column], e.g. [["sum", "HR"], ["count", "*"]]. The functions are
+            in aggregate_functions.
+        :param order_by: A group by column or aggregate name (see aggregate_name()) to sort on.
+        :param limit: Maximum number of groups to return.
+        :return: A derived table with one row per group, holding the group by columns and the aggregates.
+        """
+        pass
+
     @abstractmethod
     def find_by_template(self, template, field_list=None, limit=None, offset=None, order_by=None):
         """
@@ -63,6 +158,76 @@ class BaseDataTable(ABC):
         """
         pass
 
+    def insert_many(self, new_records, batch_size=1000):
+        """
+
+        Insert a list of records. Subclasses should override this with a batched implementation. The default
+        inserts the records one at a time.
+
+        :param new_records: A list of dictionaries, each representing a row to add.
+        :param batch_size: Number of records to insert per batch.
+        :return: The number of rows inserted.
+        """
+        result = 0
+        for r in new_records:
+            self.insert(r)
+            result += 1
+
+        return result
+
+    def get_key_columns(self):
+        """
+
+        :return: The names of the primary key columns, in key order.
+        """
+        return self._key_columns
+
+    def upsert(self, new_record, partial=False):
+        """
+
+        Insert a record, or update the row with the same primary key. Subclasses should override this with a
+        single statement or index probe. The default looks the row up and then updates or inserts.
+
+        :param new_record: A dictionary with the key columns and the values to store.
+        :param partial: If False, the record replaces the row: columns not in the record are reset (to their
+            default, or null). If True, only the columns in the record are changed.
+        :return: 1 if the row was inserted, 2 if an existing row was changed, 0 if it was already the same.
+            These are the affected row counts of MySQL's INSERT ... ON DUPLICATE KEY UPDATE.
+        """
+        key_columns = self.get_key_columns()
+        if not key_columns or any(k not in new_record for k in key_columns):
+            raise DataException(DataException.data_error, "upsert: the record must have the key columns.")
+
+        key_fields = [new_record[k] for k in key_columns]
+        existing = self.find_by_primary_key(key_fields)
+        if existing is None:
+            return self.insert(new_record)
+
+        if partial:
+            new_values = {k: v for k, v in new_record.items() if k not in key_columns}
+        else:
+            new_values = {k: new_record.get(k, None) for k in existing.keys() if k not in key_columns}
+        if not new_values:
+            return 0
+
+        return 2 if self.update_by_key(key_fields, new_values) else 0
+
+    def upsert_many(self, new_records, partial=False, batch_size=1000):
+        """
+
+        upsert() a list of records. Subclasses should override this with a batched implementation.
+
+        :param new_records: A list of dictionaries, each with the key columns.
+        :param partial: See upsert()
+        :param batch_size: Number of records per batch.
+        :return: The sum of the upsert() results, as for a multi-row INSERT ... ON DUPLICATE KEY UPDATE.
+        """
+        result = 0
+        for r in new_records:
+            result += self.upsert(r, partial)
+
+        return result
+
     @abstractmethod
     def delete_by_template(self, template):
         """
@@ -1,64 +1,327 @@
 from aeneid.dbservices.BaseDataTable import BaseDataTable
-import pandas
-import copy
-
-import csv
-from aeneid.dbservices.BaseDataTable import BaseDataTable
+from aeneid.dbservices.DataExceptions import DataException
+import aeneid.dbservices.Filters as Filters
+import bisect
 import csv
-import copy
+import heapq
+import operator
+import os
+import sys
+
+
+def _sort_key(v):
+    # CSV values are strings. Sort numbers numerically and put them before other strings.
+    try:
+        return 0, float(v), ""
+    except (TypeError, ValueError):
+        return 1, 0.0, v
+
+
+def _to_str(v):
+    return "" if v is None else str(v)
+
+
+def _to_number(v):
+    # Empty and non numeric values are ignored by sum and avg, like NULL in SQL.
+    if v is None or v == "":
+        return None
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        try:
+            return float(v)
+        except (TypeError, ValueError):
+            return None
+
+
+_comparisons = {"gt": operator.gt, "gte": operator.ge, "lt": operator.lt, "lte": operator.le}
+
+
+def _predicate(op, value):
+    """
+
+    :param op: Filter operator.
+    :param value: Filter value, as a string (a list of strings for in).
+    :return: Function of a column value that is True if the value passes the filter. Empty values, the CSV form
+        of NULL, only match eq "".
+    """
+    if op == "eq":
+        return lambda x: x == value
+    if op == "ne":
+        return lambda x: x != value and x != ""
+    if op == "in":
+        values = set(value)
+        return lambda x: x in values
+    if op == "prefix":
+        return lambda x: x != "" and x.startswith(value)
+
+    compare = _comparisons[op]
+    k = _sort_key(value)
+    return lambda x: x != "" and compare(_sort_key(x), k)
+
+
+def _null_last_key(v):
+    return (2, 0.0, "") if v is None else _sort_key(v)
+
+
+def sort_groups(rows, order_by, limit):
+    """
+
+    :param rows: Aggregate result rows.
+    :param order_by: Group by column or aggregate name to sort on, or None.
+    :param limit: Maximum number of rows, or None.
+    :return: The sorted and limited rows.
+    """
+    if order_by:
+        rows.sort(key=lambda r: _null_last_key(r[order_by]))
+    if limit:
+        rows = rows[:int(limit)]
+    return rows
 
 
 class CSVDataTable(BaseDataTable):
     """
-    The implementation classes (XXXDataTable) for CSV database, relational, etc. will extend the
-    base class and implement the abstract methods.
+    In memory implementation of the BaseDataTable for a CSV file. The data is stored by column, with one list
+    of values per column, and a row is a position in the lists. There is a hash index on the key columns and
+    optional hash indexes on other columns, so that lookups by key or by an indexed column do not scan the table.
     """
 
-    def __init__(self, table_name, connect_info, key_columns=None, debug=True):
+    def __init__(self, table_name, connect_info, key_columns=None, debug=True, index_columns=None):
         """
 
         :param table_name: Name of the table. This is the table name for an RDB table or the file name for
             a CSV file holding data.
-        :param connect_info: Dictionary of parameters necessary to connect to the data. See examples in subclasses.
+        :param connect_info: Dictionary of parameters necessary to connect to the data. For a CSV file, this
+            is { "directory": <directory containing the file> }
         :param key_columns: List, in order, of the columns (fields) that comprise the primary key.
             A primary key is a set of columns whose values are unique and uniquely identify a row. For Appearances,
             the columns are ['playerID', 'teamID', 'yearID']
         :param debug: If true, print debug messages.
+        :param index_columns: List of additional columns to build a hash index on, e.g. ['teamID', 'yearID']
         """
-        self._table_name = table_name
-        self._connect_info = connect_info
-        self._key_columns = key_columns
-        self._debug = debug
+        super().__init__(table_name, connect_info, key_columns, debug)
+
+        self._index_columns = list(index_columns) if index_columns else []
 
-        self._rows = None
         self._column_names = None
+        self._data = None               # column name -> list of values
+        self._row_count = 0             # Number of row positions, including deleted rows.
+        self._deleted = set()           # Positions of deleted rows.
+
+        self._key_index = {}            # tuple of key values -> row position
+        self._indexes = {}              # column name -> { value: [row positions, ascending] }
+        self._sorted = {}               # column name -> (sort keys, values) of the distinct values, in order
 
     def __str__(self):
         result = str(type(self))  + ": name = " + self._table_name
         result += "\nconnect_info = " + str(self._connect_info)
         result += "\nKey columns = " + str(self._key_columns)
+        result += "\nIndex columns = " + str(self._index_columns)
 
         if self._column_names is not None:
             result += "\nColumn names = " + str(self._column_names)
-        if self._rows is not None:
-            row_count = len(self._rows)
-        else:
-            row_count = 0
 
+        row_count = self._row_count - len(self._deleted)
         result += "\nNo. of rows = " + str(row_count)
 
-        to_print = min(5, row_count)
-        for i in range(0, to_print):
-            result += "\n" + str(dict(self._rows[i]))
+        for i in list(self._live_rows())[:5]:
+            result += "\n" + str(self._make_row(i))
 
         return result
 
+    def _get_file_path(self):
+        directory = (self._connect_info or {}).get("directory", ".")
+        return os.path.join(directory, self._table_name)
+
     def load(self):
         """
-        You need to implement data load here.
+
+        Load the CSV file into column storage and build the indexes.
+
         :return: None
         """
-        raise NotImplementedError("Student must implement method.")
+        try:
+            with open(self._get_file_path(), "r", newline="", encoding="utf-8") as csv_file:
+                reader = csv.reader(csv_file)
+                self._column_names = next(reader)
+                columns = [[] for c in self._column_names]
+
+                # Many values repeat (team IDs, years, flags). Interning stores each distinct string once.
+                for row in reader:
+                    for i in range(0, len(columns)):
+                        columns[i].append(sys.intern(row[i]) if i < len(row) else "")
+
+        except (OSError, StopIteration) as e:
+            raise DataException(DataException.invalid_file, "CSVDataTable: cannot load " + self._table_name, e)
+
+        self._data = dict(zip(self._column_names, columns))
+        self._row_count = len(columns[0]) if columns else 0
+        self._deleted = set()
+
+        self._build_indexes()
+
+    def _build_indexes(self):
+
+        for c in (self._key_columns or []) + self._index_columns:
+            self._check_columns([c])
+
+        self._key_index = {}
+        if self._key_columns:
+            key_data = [self._data[c] for c in self._key_columns]
+            for i in range(0, self._row_count):
+                k = tuple(col[i] for col in key_data)
+                if k in self._key_index:
+                    raise DataException(DataException.data_error,
+                                        "CSVDataTable: duplicate key " + str(k) + " in " + self._table_name)
+                self._key_index[k] = i
+
+        self._sorted = {}
+        self._indexes = {}
+        for c in self._index_columns:
+            idx = {}
+            col = self._data[c]
+            for i in range(0, self._row_count):
+                idx.setdefault(col[i], []).append(i)
+            self._indexes[c] = idx
+
+    def _check_columns(self, columns):
+        for c in columns:
+            if c not in self._data:
+                raise DataException(DataException.data_error,
+                                    "CSVDataTable: no column " + str(c) + " in " + self._table_name)
+
+    def _live_rows(self):
+        return (i for i in range(0, self._row_count) if i not in self._deleted)
+
+    def _make_row(self, i, field_list=None):
+        if field_list is None:
+            field_list = self._column_names
+        return {c: self._data[c][i] for c in field_list}
+
+    def _get_key(self, record):
+        return tuple(_to_str(record[c]) for c in self._key_columns)
+
+    def _check_key(self, record, operation):
+        if not self._key_columns or any(c not in record for c in self._key_columns):
+            raise DataException(DataException.data_error, "CSVDataTable: " + operation + " needs the key columns.")
+
+    def _sorted_index(self, column):
+        """
+
+        :param column: An indexed column.
+        :return: (sort keys, values) for the distinct values of the column, sorted with numbers in numeric order.
+            Built from the hash index on first use after a change, so range filters can bisect it.
+        """
+        result = self._sorted.get(column, None)
+        if result is None:
+            values = sorted(self._indexes[column].keys(), key=_sort_key)
+            result = ([_sort_key(v) for v in values], values)
+            self._sorted[column] = result
+
+        return result
+
+    def _index_buckets(self, column, op, value):
+        """
+
+        :return: The index buckets (lists of positions) holding the rows that pass the filter, or None if the
+            index cannot be used for the operator.
+        """
+        idx = self._indexes[column]
+
+        if op == "eq":
+            return [idx.get(value, [])]
+        if op == "in":
+            return [idx[v] for v in set(value) if v in idx]
+        if op == "prefix":
+            return [b for v, b in idx.items() if v != "" and v.startswith(value)]
+        if op not in _comparisons:
+            return None
+
+        keys, values = self._sorted_index(column)
+        k = _sort_key(value)
+        lo, hi = 0, len(keys)
+        if op == "gt":
+            lo = bisect.bisect_right(keys, k)
+        elif op == "gte":
+            lo = bisect.bisect_left(keys, k)
+        elif op == "lt":
+            hi = bisect.bisect_left(keys, k)
+        else:
+            hi = bisect.bisect_right(keys, k)
+
+        return [idx[v] for v in values[lo:hi] if v != ""]
+
+    def _find_rows(self, template):
+        """
+
+        :param template: Query template. Keys are columns, for equality, or column[op] (see Filters).
+        :return: List of positions of the matching rows, in ascending order.
+        """
+        terms = []
+        for c, op, v in Filters.parse_template(template):
+            terms.append((c, op, [_to_str(x) for x in v] if op == "in" else _to_str(v)))
+        self._check_columns([t[0] for t in terms])
+
+        eq = {c: v for c, op, v in terms if op == "eq"}
+        remaining = terms
+
+        if self._key_columns and all(k in eq for k in self._key_columns):
+            # Primary key lookup. At most one row, so all the terms are checked on it.
+            i = self._key_index.get(tuple(eq[k] for k in self._key_columns), None)
+            candidates = [i] if i is not None else []
+        else:
+            # Use the index that selects the fewest rows, if any. Hash lookups for eq and in, the sorted distinct
+            # values for ranges. An in on a single key column probes the key index.
+            best = None
+            for j, (c, op, v) in enumerate(terms):
+                if c in self._indexes:
+                    buckets = self._index_buckets(c, op, v)
+                elif op == "in" and self._key_columns == [c]:
+                    buckets = [sorted(self._key_index[(x,)] for x in set(v) if (x,) in self._key_index)]
+                else:
+                    buckets = None
+
+                if buckets is not None:
+                    size = sum(len(b) for b in buckets)
+                    if best is None or size < best[0]:
+                        best = (size, j, buckets)
+
+            if best is not None:
+                buckets = best[2]
+                candidates = buckets[0] if len(buckets) == 1 else list(heapq.merge(*buckets))
+                remaining = terms[:best[1]] + terms[best[1] + 1:]
+            else:
+                candidates = self._live_rows()
+
+        # Apply the remaining terms one column at a time.
+        result = list(candidates)
+        for c, op, v in remaining:
+            col = self._data[c]
+            if op == "eq":
+                result = [i for i in result if col[i] == v]
+            else:
+                p = _predicate(op, v)
+                result = [i for i in result if p(col[i])]
+
+        return result
+
+    def _index_add(self, i):
+        self._sorted = {}
+        if self._key_columns:
+            self._key_index[tuple(self._data[c][i] for c in self._key_columns)] = i
+        for c, idx in self._indexes.items():
+            bisect.insort(idx.setdefault(self._data[c][i], []), i)
+
+    def _index_remove(self, i):
+        self._sorted = {}
+        if self._key_columns:
+            self._key_index.pop(tuple(self._data[c][i] for c in self._key_columns), None)
+        for c, idx in self._indexes.items():
+            bucket = idx.get(self._data[c][i], None)
+            if bucket is not None:
+                bucket.remove(i)
+                if not bucket:
+                    del idx[self._data[c][i]]
 
     def find_by_primary_key(self, key_fields, field_list=None):
         """
@@ -69,7 +332,23 @@ class CSVDataTable(BaseDataTable):
             additional columns, but the caller only requests this subset.
         :return: None, or a dictionary containing the columns/values for the row.
         """
-        raise NotImplementedError("Student must implement method.")
+        if field_list is not None:
+            self._check_columns(field_list)
+
+        i = self._key_index.get(tuple(_to_str(v) for v in key_fields), None)
+        if i is None:
+            return None
+
+        return self._make_row(i, field_list)
+
+    def find_by_primary_keys(self, keys, field_list=None):
+        """
+
+        :param keys: A list of key values, each a list in the order of the key_columns.
+        :param field_list: A subset of the fields of the records to return.
+        :return: A list with the record for each key, in the same order, or None where there is no record.
+        """
+        return [self.find_by_primary_key(k, field_list) for k in keys]
 
     def find_by_template(self, template, field_list=None, limit=None, offset=None, order_by=None):
         """
@@ -77,23 +356,220 @@ class CSVDataTable(BaseDataTable):
         :param template: A dictionary of the form { "field1" : value1, "field2": value2, ...}. The function will return
             a derived table containing the rows that match the template.
         :param field_list: A list of requested fields of the form, ['fielda', 'fieldb', ...]
-        :param limit: Do not worry about this for now.
-        :param offset: Do not worry about this for now.
-        :param order_by: Do not worry about this for now.
+        :param limit: Maximum number of rows to return.
+        :param offset: Number of matching rows to skip.
+        :param order_by: Column to sort on.
         :return: A derived table containing the computed rows.
         """
-        raise NotImplementedError("Student must implement method.")
+        # Imported here because DerivedDataTable is a subclass of this class.
+        from aeneid.dbservices.DerivedDataTable import DerivedDataTable
+
+        if field_list is not None:
+            self._check_columns(field_list)
+
+        ids = self._find_rows(template)
+
+        if order_by:
+            self._check_columns([order_by])
+            col = self._data[order_by]
+            ids.sort(key=lambda i: _sort_key(col[i]))
+
+        start = int(offset) if offset else 0
+        end = (start + int(limit)) if limit else None
+        ids = ids[start:end]
+
+        rows = [self._make_row(i, field_list) for i in ids]
+        return DerivedDataTable("SELECT(" + self._table_name + ")", rows)
+
+    def is_indexed(self, column):
+        """
+
+        :param column: Column name.
+        :return: True if filters on the column can use a hash index: an index column, or the key column of a
+            single column key. A column of a composite key needs its own index, because the key index is on the
+            whole key.
+        """
+        return column in self._indexes or self._key_columns == [column]
 
+    def count_by_template(self, template):
+        """
+
+        :param template: Query template.
+        :return: The number of rows matching the template, using the indexes.
+        """
+        if not template:
+            return self._row_count - len(self._deleted)
+        return len(self._find_rows(template))
+
+    def aggregate(self, template, group_by=None, aggregates=None, order_by=None, limit=None):
+        """
+
+        Hash aggregation: one pass over the matching rows, with a dictionary from the group by values to the
+        running aggregates of the group.
+
+        :param template: Query template selecting the rows.
+        :param group_by: List of columns to group on. If None, there is one group with all the rows.
+        :param aggregates: List of [function, column], e.g. [["sum", "HR"], ["count", "*"]]
+        :param order_by: A group by column or aggregate name to sort on.
+        :param limit: Maximum number of groups to return.
+        :return: A derived table with one row per group.
+        """
+        from aeneid.dbservices.DerivedDataTable import DerivedDataTable
+
+        group_by = list(group_by or [])
+        aggregates = list(aggregates or [])
+        self._check_aggregates(aggregates)
+        self._check_columns(group_by + [c for f, c in aggregates if c != "*"])
+
+        names = group_by + [self.aggregate_name(f, c) for f, c in aggregates]
+        if order_by and order_by not in names:
+            raise DataException(DataException.data_error, "CSVDataTable: cannot order by " + str(order_by))
+
+        ids = self._find_rows(template)
+        group_data = [self._data[c] for c in group_by]
+        agg_data = [(f, self._data[c] if c != "*" else None) for f, c in aggregates]
+
+        # Running state per aggregate: count -> n, sum -> [total, n], avg -> [total, n], min/max -> value.
+        groups = {}
+        for i in ids:
+            k = tuple(col[i] for col in group_data)
+            acc = groups.get(k, None)
+            if acc is None:
+                acc = [0 if f == "count" else ([0, 0] if f in ("sum", "avg") else None) for f, col in agg_data]
+                groups[k] = acc
+
+            for j, (f, col) in enumerate(agg_data):
+                if f == "count":
+                    if col is None or col[i] != "":
+                        acc[j] += 1
+                elif f in ("sum", "avg"):
+                    v = _to_number(col[i])
+                    if v is not None:
+                        acc[j][0] += v
+                        acc[j][1] += 1
+                else:
+                    v = col[i]
+                    if v != "" and (acc[j] is None or
+                                    (_sort_key(v) < _sort_key(acc[j])) == (f == "min")):
+                        acc[j] = v
+
+        if not group_by and not groups:
+            # Without group by there is always one row, as in SQL.
+            groups[()] = [0 if f == "count" else ([0, 0] if f in ("sum", "avg") else None) for f, col in agg_data]
+
+        rows = []
+        for k, acc in groups.items():
+            r = dict(zip(group_by, k))
+            for j, (f, c) in enumerate(aggregates):
+                v = acc[j]
+                if f == "sum":
+                    v = v[0] if v[1] else None
+                elif f == "avg":
+                    v = (v[0] / v[1]) if v[1] else None
+                r[self.aggregate_name(f, c)] = v
+            rows.append(r)
+
+        rows = sort_groups(rows, order_by, limit)
+        return DerivedDataTable("AGGREGATE(" + self._table_name + ")", rows)
 
     def insert(self, new_record):
         """
 
         :param new_record: A dictionary representing a row to add to the set of records. Raises an exception if this
             creates a duplicate primary key.
-        :return: None
+        :return: 1, the number of rows inserted.
         """
-        raise NotImplementedError("Student must implement method.")
+        self._check_columns(new_record.keys())
+
+        if self._key_columns:
+            self._check_key(new_record, "insert")
+            k = self._get_key(new_record)
+            if k in self._key_index:
+                raise DataException(DataException.data_error, "CSVDataTable: duplicate key " + str(k))
 
+        for c in self._column_names:
+            self._data[c].append(sys.intern(_to_str(new_record.get(c, None))))
+
+        i = self._row_count
+        self._row_count += 1
+        self._index_add(i)
+
+        return 1
+
+    def insert_many(self, new_records, batch_size=1000):
+        """
+
+        :param new_records: A list of dictionaries, each representing a row to add. Raises an exception, and
+            inserts nothing, if any record has a duplicate key.
+        :param batch_size: Not used. The whole list is inserted at once.
+        :return: The number of rows inserted.
+        """
+        if self._key_columns:
+            keys = set()
+            for r in new_records:
+                self._check_key(r, "insert")
+                k = self._get_key(r)
+                if k in self._key_index or k in keys:
+                    raise DataException(DataException.data_error, "CSVDataTable: duplicate key " + str(k))
+                keys.add(k)
+
+        for r in new_records:
+            self.insert(r)
+
+        return len(new_records)
+
+    def upsert(self, new_record, partial=False):
+        """
+
+        Insert the record or update the row with the same key. The row is found with the key index.
+
+        :param new_record: A dictionary with the key columns and the values to store.
+        :param partial: If False, replace the row: columns not in the record are set to "" (null). If True, only
+            the columns in the record are changed.
+        :return: 1 if the row was inserted, 2 if an existing row was changed, 0 if it was already the same.
+        """
+        self._check_key(new_record, "upsert")
+        self._check_columns(new_record.keys())
+
+        i = self._key_index.get(self._get_key(new_record), None)
+        if i is None:
+            return self.insert(new_record)
+
+        if partial:
+            columns = [c for c in new_record.keys() if c not in self._key_columns]
+        else:
+            columns = [c for c in self._column_names if c not in self._key_columns]
+
+        new_values = {c: sys.intern(_to_str(new_record.get(c, None))) for c in columns}
+        if all(self._data[c][i] == v for c, v in new_values.items()):
+            return 0
+
+        # The key does not change, so only the secondary indexes need updating.
+        self._index_remove(i)
+        for c, v in new_values.items():
+            self._data[c][i] = v
+        self._index_add(i)
+
+        return 2
+
+    def upsert_many(self, new_records, partial=False, batch_size=1000):
+        """
+
+        :param new_records: A list of dictionaries, each with the key columns. Raises an exception, and changes
+            nothing, if any record is missing a key column or has an unknown column.
+        :param partial: See upsert()
+        :param batch_size: Not used. The whole list is upserted at once.
+        :return: The sum of the upsert() results.
+        """
+        for r in new_records:
+            self._check_key(r, "upsert")
+            self._check_columns(r.keys())
+
+        result = 0
+        for r in new_records:
+            result += self.upsert(r, partial)
+
+        return result
 
     def delete_by_template(self, template):
         """
@@ -103,8 +579,13 @@ class CSVDataTable(BaseDataTable):
         :param template: A template.
         :return: A count of the rows deleted.
         """
-        raise NotImplementedError("Student must implement method.")
+        ids = self._find_rows(template)
+
+        for i in ids:
+            self._index_remove(i)
+            self._deleted.add(i)
 
+        return len(ids)
 
     def delete_by_key(self, key_fields):
         """
@@ -114,7 +595,7 @@ class CSVDataTable(BaseDataTable):
         :param key_fields: List containing the values for the key columns
         :return: A count of the rows deleted.
         """
-        raise NotImplementedError("Student must implement method.")
+        return self.delete_by_template(dict(zip(self._key_columns, key_fields)))
 
     def update_by_template(self, template, new_values):
         """
@@ -125,8 +606,30 @@ class CSVDataTable(BaseDataTable):
             update on this error.
         :return: The number of rows updates.
         """
-        raise NotImplementedError("Student must implement method.")
-
+        self._check_columns(new_values.keys())
+        new_values = {k: sys.intern(_to_str(v)) for k, v in new_values.items()}
+
+        ids = self._find_rows(template)
+
+        # Check for duplicate keys before changing anything.
+        if self._key_columns and any(k in new_values for k in self._key_columns):
+            updated = set(ids)
+            new_keys = set()
+            for i in ids:
+                k = tuple(new_values.get(c, self._data[c][i]) for c in self._key_columns)
+                other = self._key_index.get(k, None)
+                if k in new_keys or (other is not None and other not in updated):
+                    raise DataException(DataException.data_error, "CSVDataTable: duplicate key " + str(k))
+                new_keys.add(k)
+
+        for i in ids:
+            self._index_remove(i)
+        for i in ids:
+            for c, v in new_values.items():
+                self._data[c][i] = v
+            self._index_add(i)
+
+        return len(ids)
 
     def update_by_key(self, key_fields, new_values):
         """
@@ -137,4 +640,4 @@ class CSVDataTable(BaseDataTable):
             update on this error.
         :return: The number of rows updates.
         """
-        raise NotImplementedError("Student must implement method.")
+        return self.update_by_template(dict(zip(self._key_columns, key_fields)), new_values)
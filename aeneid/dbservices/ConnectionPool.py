@@ -0,0 +1,351 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import pymysql
+
+from aeneid.dbservices.DataExceptions import DataException
+
+
+# Default pool settings. Any of these can be overridden per pool by passing pool_params.
+_default_pool_params = {
+    "min_size": 1,                  # Connections opened when the pool is created.
+    "max_size": 10,                 # Hard cap on open connections (idle + in use).
+    "checkout_timeout": 10.0,       # Seconds a caller will wait for a free connection.
+    "max_lifetime": 3600.0,         # Seconds after which a connection is closed instead of reused.
+    "health_check": True,           # Ping a borrowed connection if it has been idle for health_check_idle.
+    "health_check_idle": 30.0       # Seconds idle after which a connection is pinged before it is reused.
+}
+
+
+def _connect(connect_info):
+    """
+
+    Open a new DB connection. This is the only place in the pool that talks to pymysql.connect.
+
+    :param connect_info: Dictionary with host, user, password, db and (optionally) port.
+    :return: A new pymysql connection.
+    """
+    return pymysql.connect(
+        host=connect_info['host'],
+        user=connect_info['user'],
+        password=connect_info['password'],
+        db=connect_info.get('db', None),
+        port=connect_info.get('port', 3306),
+        charset='utf8mb4',
+        cursorclass=pymysql.cursors.DictCursor,
+        autocommit=False)
+
+
+class _PooledConnection:
+    """
+    Book keeping for a connection that the pool owns.
+    """
+
+    def __init__(self, cnx, generation=0):
+        self.cnx = cnx
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.generation = generation            # Pool generation the connection was opened in.
+
+
+class ConnectionPool:
+    """
+    A thread safe, bounded pool of DB connections. Request threads borrow a connection for the duration
+    of a statement or transaction and give it back, rather than sharing one connection per table.
+    """
+
+    def __init__(self, connect_info, pool_params=None, connect_fn=None):
+        """
+
+        :param connect_info: Dictionary of parameters necessary to connect to the DB.
+        :param pool_params: Dictionary overriding entries in _default_pool_params.
+        :param connect_fn: Function taking connect_info and returning a new connection. Defaults to pymysql.
+        """
+        params = dict(_default_pool_params)
+        if pool_params:
+            params.update(pool_params)
+
+        if params["min_size"] > params["max_size"]:
+            raise ValueError("ConnectionPool: min_size cannot be larger than max_size.")
+
+        self._connect_info = connect_info
+        self._params = params
+        self._connect_fn = connect_fn or _connect
+
+        self._lock = threading.Condition()
+        self._idle = []                 # Stack of _PooledConnection. Most recently used is at the end.
+        self._in_use = {}               # id(cnx) -> _PooledConnection
+        self._opening = 0               # Connections being opened outside the lock.
+
+        # Counters reported by stats()
+        self._checkouts = 0
+        self._timeouts = 0
+        self._discarded = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+
+        # The min_size connections are opened by warm_up() or the first checkout, not here, so that
+        # creating a pool (e.g. on import) never blocks on the DB.
+        self._warmed_up = False
+
+        # Incremented by close_all(). Connections opened in an earlier generation are closed, not reused.
+        self._generation = 0
+
+    def warm_up(self):
+        """
+
+        Open connections until there are at least min_size. Safe to call more than once.
+
+        :return: None
+        """
+        with self._lock:
+            if self._warmed_up:
+                return
+            to_open = max(0, self._params["min_size"] - self._size())
+            self._opening += to_open
+
+        opened = 0
+        try:
+            for i in range(0, to_open):
+                pc = _PooledConnection(self._connect_fn(self._connect_info), self._generation)
+                with self._lock:
+                    self._idle.append(pc)
+                    self._opening -= 1
+                    opened += 1
+                    self._lock.notify()
+
+            # Only a complete warm up counts. After a failed connect, the next checkout tries again.
+            with self._lock:
+                self._warmed_up = True
+        finally:
+            # Give back the slots reserved for connections that were not opened because a connect failed.
+            with self._lock:
+                self._opening -= to_open - opened
+                self._lock.notify_all()
+
+    def _size(self):
+        return len(self._idle) + len(self._in_use) + self._opening
+
+    def _is_expired(self, pc):
+        return pc.generation != self._generation or (time.monotonic() - pc.created) > self._params["max_lifetime"]
+
+    def _is_healthy(self, pc):
+        # A ping is a round trip, so only connections that have been idle for a while are checked. A recently
+        # used connection that has gone bad fails its statement, and the caller discards it (see
+        # is_connection_error()).
+        if not self._params["health_check"] or \
+                (time.monotonic() - pc.last_used) <= self._params["health_check_idle"]:
+            return True
+        try:
+            pc.cnx.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    def _close(self, pc):
+        try:
+            pc.cnx.close()
+        except Exception:
+            pass
+
+    def get_connection(self):
+        """
+
+        Borrow a connection. The caller must call release() when done, or use connection() instead.
+
+        :return: A DB connection.
+        """
+        if not self._warmed_up:
+            self.warm_up()
+
+        start = time.monotonic()
+        deadline = start + self._params["checkout_timeout"]
+
+        while True:
+            pc = None
+            with self._lock:
+                while not self._idle and self._size() >= self._params["max_size"]:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise DataException(DataException.internal_error,
+                                            "ConnectionPool: timed out waiting for a connection.")
+                    self._lock.wait(remaining)
+
+                if self._idle:
+                    pc = self._idle.pop()
+                else:
+                    self._opening += 1
+
+            if pc is None:
+                # Open the connection outside the lock so a slow DB does not block other borrowers.
+                try:
+                    pc = _PooledConnection(self._connect_fn(self._connect_info), self._generation)
+                finally:
+                    with self._lock:
+                        self._opening -= 1
+                        self._lock.notify()
+            elif self._is_expired(pc) or not self._is_healthy(pc):
+                self._close(pc)
+                with self._lock:
+                    self._discarded += 1
+                    self._lock.notify()
+                continue
+
+            with self._lock:
+                self._in_use[id(pc.cnx)] = pc
+                waited = time.monotonic() - start
+                self._checkouts += 1
+                self._wait_time += waited
+                self._max_wait_time = max(self._max_wait_time, waited)
+
+            return pc.cnx
+
+    def release(self, cnx, discard=False):
+        """
+
+        Return a borrowed connection to the pool. Any uncommitted work is rolled back.
+
+        :param cnx: A connection returned by get_connection()
+        :param discard: If True, close the connection instead of reusing it, e.g. because it is in the middle
+            of an unbuffered result.
+        :return: None
+        """
+        with self._lock:
+            pc = self._in_use.pop(id(cnx), None)
+
+        if pc is None:
+            return
+
+        reuse = not discard and not self._is_expired(pc)
+        if reuse:
+            try:
+                cnx.rollback()
+            except Exception:
+                reuse = False
+
+        with self._lock:
+            if reuse:
+                pc.last_used = time.monotonic()
+                self._idle.append(pc)
+            else:
+                self._discarded += 1
+            self._lock.notify()
+
+        if not reuse:
+            self._close(pc)
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager form of get_connection()/release().
+        """
+        cnx = self.get_connection()
+        discard = False
+        try:
+            yield cnx
+        except Exception as e:
+            discard = is_connection_error(e)
+            raise
+        finally:
+            self.release(cnx, discard=discard)
+
+    def close_all(self):
+        """
+        Close the idle connections. Connections that are in use are closed when they are released. The pool
+        stays usable: later checkouts open new connections, which are reused as usual.
+        """
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+            self._generation += 1
+            self._warmed_up = False
+
+        for pc in idle:
+            self._close(pc)
+
+    def stats(self):
+        """
+
+        :return: A dictionary with the current pool usage and wait statistics.
+        """
+        with self._lock:
+            result = {
+                "max_size": self._params["max_size"],
+                "min_size": self._params["min_size"],
+                "in_use": len(self._in_use),
+                "idle": len(self._idle),
+                "checkouts": self._checkouts,
+                "timeouts": self._timeouts,
+                "discarded": self._discarded,
+                "total_wait_time": self._wait_time,
+                "max_wait_time": self._max_wait_time,
+                "avg_wait_time": (self._wait_time / self._checkouts) if self._checkouts else 0.0
+            }
+        return result
+
+
+def is_connection_error(e):
+    """
+
+    :param e: An exception raised while using a pooled connection.
+    :return: True if the connection itself failed (e.g. the server closed it), so that it should be discarded
+        rather than returned to the pool.
+    """
+    return isinstance(e, (pymysql.err.OperationalError, pymysql.err.InterfaceError))
+
+
+def set_default_pool_params(pool_params):
+    """
+
+    Change the defaults used for pools created after this call, e.g. from a config file.
+
+    :param pool_params: Dictionary with entries to override in _default_pool_params.
+    :return: None
+    """
+    _default_pool_params.update(pool_params)
+
+
+# Process wide pools, one per distinct set of connect information.
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _pool_key(connect_info):
+    return (connect_info.get('host'), connect_info.get('port', 3306),
+            connect_info.get('user'), connect_info.get('db'))
+
+
+def get_pool(connect_info, pool_params=None):
+    """
+
+    Get the shared pool for the connect information, creating it on first use.
+
+    :param connect_info: Dictionary of parameters necessary to connect to the DB.
+    :param pool_params: Only used if the pool does not exist yet.
+    :return: A ConnectionPool
+    """
+    k = _pool_key(connect_info)
+    with _pools_lock:
+        result = _pools.get(k, None)
+        if result is None:
+            result = ConnectionPool(connect_info, pool_params)
+            _pools[k] = result
+
+    return result
+
+
+def get_all_stats():
+    """
+
+    :return: Dictionary of {"host:port/db": pool stats} for every pool in the process.
+    """
+    with _pools_lock:
+        pools = list(_pools.items())
+
+    result = {}
+    for k, p in pools:
+        result[str(k[0]) + ":" + str(k[1]) + "/" + str(k[3])] = p.stats()
+
+    return result
@@ -1,28 +1,172 @@
-from aeneid.dbservices.CSVDataTable import CSVDataTable
-from aeneid.dbservices.CSVDataTable import CSVDataTable
+from aeneid.dbservices.CSVDataTable import CSVDataTable, sort_groups
+from aeneid.dbservices.DataExceptions import DataException
+import aeneid.dbservices.Filters as Filters
+import numpy as np
+import pandas as pd
+
 
 class DerivedDataTable(CSVDataTable):
     """
-    The implementation classes (XXXDataTable) for CSV database, relational, etc. will extend the
-    base class and implement the abstract methods.
+    The result of a query. The rows are held either as a list of dictionaries, as returned by the DB driver, or as
+    a pandas DataFrame. Filtering, projection, sorting and paging run on the DataFrame as vectorized operations, so a
+    result can be refined further without going back to the database. Each form is built from the other only
+    when it is needed.
     """
 
-    def __init__(self, table_name, rows):
+    def __init__(self, table_name, rows=None, frame=None, key_columns=None):
         """
 
         :param table_name: Name of the table. This is the table name for an RDB table or the file name for
             a CSV file holding data.
-        :param connect_info: Dictionary of parameters necessary to connect to the data. See examples in subclasses.
+        :param rows: List of dictionaries, one per row.
+        :param frame: A pandas DataFrame with the rows. Used if rows is None.
         :param key_columns: List, in order, of the columns (fields) that comprise the primary key.
             A primary key is a set of columns whose values are unique and uniquely identify a row. For Appearances,
             the columns are ['playerID', 'teamID', 'yearID']
-        :param debug: If true, print debug messages.
         """
-        self._table_name = table_name
+        super().__init__(table_name, None, key_columns=key_columns, debug=False)
         self._rows = rows
-        self._connect_info = None
-        self._column_names = None
-        self._key_columns = None
+        self._frame = frame
+
+    def __str__(self):
+        result = str(type(self)) + ": name = " + self._table_name
+
+        row_count = len(self)
+        result += "\nNo. of rows = " + str(row_count)
+
+        rows = self.get_rows()
+        for i in range(0, min(5, row_count)):
+            result += "\n" + str(dict(rows[i]))
+
+        return result
+
+    def __len__(self):
+        if self._rows is not None:
+            return len(self._rows)
+        if self._frame is not None:
+            return len(self._frame)
+        return 0
+
+    def get_frame(self):
+        """
+
+        :return: The rows as a pandas DataFrame, converting from the list of rows on first use.
+        """
+        if self._frame is None:
+            self._frame = pd.DataFrame(self._rows if self._rows is not None else [])
+        return self._frame
+
+    def get_rows(self):
+        """
+
+        :return: The rows as a list of dictionaries, converting from the DataFrame on first use.
+        """
+        if self._rows is None and self._frame is not None:
+            df = self._frame
+            # Missing numbers are NaN in a DataFrame. Return them as None, which is valid JSON.
+            if df.isna().values.any():
+                df = df.astype(object).where(df.notna(), None)
+            self._rows = df.to_dict("records")
+
+        return self._rows
+
+    def load(self):
+        """
+
+        A derived table is built from rows, not loaded from a file.
+        """
+        raise NotImplementedError()
+
+    def is_indexed(self, column):
+        """
+
+        :return: False. The rows are filtered with vectorized scans, not indexes.
+        """
+        return False
+
+    def _check_columns(self, columns):
+        df = self.get_frame()
+        for c in columns:
+            if c not in df.columns:
+                raise DataException(DataException.data_error,
+                                    "DerivedDataTable: no column " + str(c) + " in " + self._table_name)
+
+    @staticmethod
+    def _column_mask(column, value, op="eq"):
+        """
+
+        :param column: A DataFrame column.
+        :param value: Filter value. For in, a list of values.
+        :param op: Filter operator (see Filters).
+        :return: Boolean numpy array, True for the rows that pass the filter.
+        """
+        # Template values usually come from a URL and are strings. Compare with the column's type.
+        if pd.api.types.is_numeric_dtype(column.dtype) and not pd.api.types.is_bool_dtype(column.dtype) \
+                and op != "prefix":
+            try:
+                if op == "in":
+                    value = [float(v) for v in value]
+                else:
+                    value = float(value)
+            except (TypeError, ValueError):
+                return np.zeros(len(column), dtype=bool)
+        elif op in Filters.range_operators and DerivedDataTable._is_number(value):
+            # A numeric range on text, e.g. rows read from a CSV file. Compare as numbers, like CSVDataTable.
+            column = pd.to_numeric(column, errors="coerce")
+            value = float(value)
+        else:
+            # Missing values (NULL) do not pass any filter, as in SQL. Without the notna mask, astype(str) would
+            # turn None into "None". Numeric comparisons with NaN are already False.
+            notna = column.notna()
+            column = column.astype(str)
+            value = [str(v) for v in value] if op == "in" else str(value)
+            return notna.values & DerivedDataTable._compare(column, value, op)
+
+        return DerivedDataTable._compare(column, value, op)
+
+    @staticmethod
+    def _is_number(value):
+        try:
+            float(value)
+            return True
+        except (TypeError, ValueError):
+            return False
+
+    @staticmethod
+    def _compare(column, value, op):
+        if op == "eq":
+            return (column == value).values
+        if op == "ne":
+            return (column.notna() & (column != value)).values
+        if op == "gt":
+            return (column > value).values
+        if op == "gte":
+            return (column >= value).values
+        if op == "lt":
+            return (column < value).values
+        if op == "lte":
+            return (column <= value).values
+        if op == "in":
+            return column.isin(value).values
+        return column.astype(str).str.startswith(str(value)).values
+
+    def _find_mask(self, template):
+        """
+
+        :param template: Query template. Keys are columns, for equality, or column[op] (see Filters).
+        :return: Boolean numpy array, True for the rows that match.
+        """
+        df = self.get_frame()
+        mask = np.ones(len(df), dtype=bool)
+
+        # An empty result built from no rows has no columns. Nothing matches, and there are no columns to check.
+        if template and len(df.columns) > 0:
+            terms = Filters.parse_template(template)
+            self._check_columns([t[0] for t in terms])
+            for c, op, v in terms:
+                mask &= self._column_mask(df[c], v, op)
+
+        return mask
 
     def find_by_primary_key(self, key_fields, field_list=None):
         """
@@ -33,7 +177,11 @@ class DerivedDataTable(CSVDataTable):
             additional columns, but the caller only requests this subset.
         :return: None, or a dictionary containing the columns/values for the row.
         """
-        raise NotImplementedError()
+        if not self._key_columns:
+            raise DataException(DataException.data_error, "DerivedDataTable: table has no key columns.")
+
+        rows = self.find_by_template(dict(zip(self._key_columns, key_fields)), field_list, limit=1).get_rows()
+        return rows[0] if rows else None
 
     def find_by_template(self, template, field_list=None, limit=None, offset=None, order_by=None):
         """
@@ -41,12 +189,116 @@ class DerivedDataTable(CSVDataTable):
         :param template: A dictionary of the form { "field1" : value1, "field2": value2, ...}. The function will return
             a derived table containing the rows that match the template.
         :param field_list: A list of requested fields of the form, ['fielda', 'fieldb', ...]
-        :param limit: Do not worry about this for now.
-        :param offset: Do not worry about this for now.
-        :param order_by: Do not worry about this for now.
+        :param limit: Maximum number of rows to return.
+        :param offset: Number of matching rows to skip.
+        :param order_by: Column to sort on.
         :return: A derived table containing the computed rows.
         """
-        return super().find_by_template(template, field_list, limit, offset, order_by)
+        df = self.get_frame()
+        if len(df.columns) == 0:
+            return DerivedDataTable("SELECT(" + self._table_name + ")", [], key_columns=self._key_columns)
+
+        positions = np.flatnonzero(self._find_mask(template))
+
+        if order_by:
+            self._check_columns([order_by])
+            # A stable argsort of the selected values. Missing values go last.
+            values = df[order_by].iloc[positions].reset_index(drop=True)
+            positions = positions[values.sort_values(kind="stable", na_position="last").index.values]
+
+        start = int(offset) if offset else 0
+        end = (start + int(limit)) if limit else None
+        positions = positions[start:end]
+
+        if field_list is not None:
+            self._check_columns(field_list)
+            result = df.iloc[positions][field_list]
+        else:
+            result = df.iloc[positions]
+
+        return DerivedDataTable("SELECT(" + self._table_name + ")", frame=result.reset_index(drop=True),
+                                key_columns=self._key_columns)
+
+    def count_by_template(self, template):
+        """
+
+        :param template: Query template.
+        :return: The number of rows matching the template.
+        """
+        if not template:
+            return len(self)
+        return int(self._find_mask(template).sum())
+
+    def aggregate(self, template, group_by=None, aggregates=None, order_by=None, limit=None):
+        """
+
+        Hash aggregation of the matching rows with DataFrame.groupby.
+
+        :param template: Query template selecting the rows.
+        :param group_by: List of columns to group on. If None, there is one group with all the rows.
+        :param aggregates: List of [function, column], e.g. [["sum", "HR"], ["count", "*"]]
+        :param order_by: A group by column or aggregate name to sort on.
+        :param limit: Maximum number of groups to return.
+        :return: A derived table with one row per group.
+        """
+        group_by = list(group_by or [])
+        aggregates = list(aggregates or [])
+        self._check_aggregates(aggregates)
+
+        df = self.get_frame()
+        if len(df.columns) == 0:
+            return DerivedDataTable("AGGREGATE(" + self._table_name + ")", [])
+
+        self._check_columns(group_by + [c for f, c in aggregates if c != "*"])
+
+        names = group_by + [self.aggregate_name(f, c) for f, c in aggregates]
+        if order_by and order_by not in names:
+            raise DataException(DataException.data_error, "DerivedDataTable: cannot order by " + str(order_by))
+
+        df = df[self._find_mask(template)]
+        keys = [df[c] for c in group_by]
+
+        def column(f, c):
+            if c == "*":
+                return pd.Series(np.ones(len(df), dtype=np.int64), index=df.index)
+            if f in ("sum", "avg"):
+                return pd.to_numeric(df[c], errors="coerce")
+            return df[c]
+
+        result = {}
+        for f, c in aggregates:
+            values = column(f, c)
+            if group_by:
+                g = values.groupby(keys, sort=False, dropna=False)
+                if f == "count":
+                    v = g.sum() if c == "*" else g.count()
+                elif f == "sum":
+                    v = g.sum(min_count=1)
+                elif f == "avg":
+                    v = g.mean()
+                else:
+                    v = g.min() if f == "min" else g.max()
+            else:
+                if f == "count":
+                    v = len(values) if c == "*" else int(values.count())
+                elif f == "sum":
+                    v = values.sum(min_count=1)
+                elif f == "avg":
+                    v = values.mean()
+                else:
+                    v = values.min() if f == "min" else values.max()
+            result[self.aggregate_name(f, c)] = v
+
+        if group_by:
+            frame = pd.DataFrame(result).reset_index()
+            frame.columns = names
+            rows = DerivedDataTable("AGGREGATE", frame=frame).get_rows()
+        else:
+            rows = [{k: (None if pd.isna(v) else (v.item() if hasattr(v, "item") else v))
+                     for k, v in result.items()}]
+
+        rows = sort_groups(rows, order_by, limit)
+        return DerivedDataTable("AGGREGATE(" + self._table_name + ")", rows)
 
     def insert(self, new_record):
         """
@@ -57,6 +309,15 @@ class DerivedDataTable(CSVDataTable):
         """
         raise NotImplementedError()
 
+    def insert_many(self, new_records, batch_size=1000):
+        raise NotImplementedError()
+
+    def upsert(self, new_record, partial=False):
+        raise NotImplementedError()
+
+    def upsert_many(self, new_records, partial=False, batch_size=1000):
+        raise NotImplementedError()
+
     def delete_by_template(self, template):
         """
 
@@ -99,5 +360,3 @@ class DerivedDataTable(CSVDataTable):
         """
         raise NotImplementedError()
 
-    def get_rows(self):
-        return self._rows
@@ -0,0 +1,88 @@
+import re
+from aeneid.dbservices.DataExceptions import DataException
+
+
+# Filter grammar for query templates. A template key is either a column, for equality, or column[op], e.g.
+#
+#   { "yearID[gte]": "2000", "teamID[in]": "BOS,NYA", "nameLast[prefix]": "Sm" }
+#
+# For in, the value is a list or a comma separated string.
+
+operators = {
+    "eq": "=",
+    "ne": "<>",
+    "gt": ">",
+    "gte": ">=",
+    "lt": "<",
+    "lte": "<=",
+    "in": "IN",
+    "prefix": "LIKE"
+}
+
+# Operators that select a range of values, and can use a sorted index.
+range_operators = ["gt", "gte", "lt", "lte"]
+
+_filter_key = re.compile(r"^(\w+)\[(\w+)\]$")
+
+
+def parse_key(key):
+    """
+
+    :param key: A template key, e.g. "yearID" or "yearID[gte]"
+    :return: (column, operator)
+    """
+    m = _filter_key.match(key)
+    if m is None:
+        return key, "eq"
+
+    column, op = m.group(1), m.group(2)
+    if op not in operators:
+        raise DataException(DataException.data_error, "Unknown filter operator " + op + " in " + key)
+
+    return column, op
+
+
+def in_values(value):
+    """
+
+    :param value: The value of an in filter.
+    :return: List of values.
+    """
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return str(value).split(",")
+
+
+def parse_template(template):
+    """
+
+    :param template: Query template.
+    :return: List of (column, operator, value). For in, the value is a list.
+    """
+    result = []
+    for k, v in (template or {}).items():
+        column, op = parse_key(k)
+        if op == "in":
+            v = in_values(v)
+        result.append((column, op, v))
+
+    return result
+
+
+def like_prefix(value):
+    """
+
+    :param value: A prefix.
+    :return: LIKE pattern matching strings that start with the prefix. Wildcards in the prefix are escaped.
+    """
+    value = str(value).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return value + "%"
+
+
+def template_columns(template):
+    """
+
+    :param template: Query template.
+    :return: The columns the template filters on.
+    """
+    return [parse_key(k)[0] for k in (template or {}).keys()]
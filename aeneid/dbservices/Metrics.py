@@ -0,0 +1,339 @@
+import threading
+import time
+import re
+import logging
+from collections import deque
+from contextlib import contextmanager
+
+
+# Latency metrics for the service. Histograms have a fixed number of log-linear buckets (HDR style), so the
+# memory per series does not depend on the number of observations, and percentiles are within about 12%.
+# Everything is exposed in the Prometheus text format by to_prometheus().
+
+# Set to False to turn off all timing.
+enabled = True
+
+# Queries slower than this many milliseconds are recorded in the slow query log.
+slow_query_ms = 500.0
+
+slow_query_logger = logging.getLogger("aeneid.slow_query")
+
+# Help text for the metrics. Histogram values are recorded in microseconds and exported in seconds.
+_help = {
+    "aeneid_request_duration_seconds": "Latency of HTTP requests by route, method and status.",
+    "aeneid_stage_duration_seconds": "Time spent per stage (sql_execute, sql_fetch, derived_build, serialize).",
+    "aeneid_table_query_duration_seconds": "Latency of SQL statements by table.",
+    "aeneid_slow_queries_total": "Number of queries slower than the slow query threshold.",
+    "aeneid_compression_duration_seconds": "Time to compress response bodies by route and encoding.",
+    "aeneid_compression_input_bytes_total": "Bytes of response bodies before compression.",
+    "aeneid_compression_output_bytes_total": "Bytes of response bodies after compression.",
+    "aeneid_compression_cache_hits_total": "Compressed bodies served from the result cache."
+}
+
+_lock = threading.Lock()
+_histograms = {}            # (name, labels) -> Histogram
+_counters = {}              # (name, labels) -> int
+_slow_queries = deque(maxlen=100)  # The most recent slow queries.
+
+
+class Histogram:
+    """
+    Log-linear histogram of integer microsecond values. Values below 16us have a bucket each. Above that, every
+    power of two is split into 8 buckets. Values above about 19 hours go in the last bucket. A bucket holds the
+    values above its lower bound up to and including its upper bound, like the Prometheus le buckets.
+    """
+
+    sub_bits = 3
+    sub_count = 1 << sub_bits
+    max_exponent = 36
+    bucket_count = sub_count + (max_exponent - sub_bits + 1) * sub_count
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = [0] * Histogram.bucket_count
+        self.count = 0
+        self.total = 0
+
+    @staticmethod
+    def _index(v):
+        if v < 2 * Histogram.sub_count:
+            return max(v, 0)
+
+        k = v.bit_length() - 1
+        if k > Histogram.max_exponent:
+            return Histogram.bucket_count - 1
+
+        sub = (v >> (k - Histogram.sub_bits)) - Histogram.sub_count
+        return Histogram.sub_count + (k - Histogram.sub_bits) * Histogram.sub_count + sub
+
+    @staticmethod
+    def _upper_bound(i):
+        # Largest value that falls in bucket i.
+        if i < 2 * Histogram.sub_count:
+            return i + 1
+
+        k = (i - Histogram.sub_count) // Histogram.sub_count + Histogram.sub_bits
+        sub = (i - Histogram.sub_count) % Histogram.sub_count
+        width = 1 << (k - Histogram.sub_bits)
+        return (Histogram.sub_count + sub) * width + width
+
+    def record(self, us):
+        us = int(us)
+        # Buckets are indexed by us - 1, so that a value equal to a bucket's upper bound is counted in it.
+        i = Histogram._index(us - 1)
+        with self._lock:
+            self._counts[i] += 1
+            self.count += 1
+            self.total += us
+
+    def percentile(self, p):
+        """
+
+        :param p: Percentile, 0 to 100.
+        :return: Upper bound, in microseconds, of the bucket holding the percentile. 0 if there are no values.
+        """
+        with self._lock:
+            counts = list(self._counts)
+            count = self.count
+
+        if count == 0:
+            return 0
+
+        target = max(1, int(round(count * p / 100.0)))
+        seen = 0
+        for i, c in enumerate(counts):
+            seen += c
+            if seen >= target:
+                return Histogram._upper_bound(i)
+
+        return Histogram._upper_bound(len(counts) - 1)
+
+    def cumulative(self, bounds):
+        """
+
+        :param bounds: Ascending list of powers of two, in microseconds.
+        :return: List of (bound, number of values less than or equal to bound), then the total count and sum.
+        """
+        with self._lock:
+            counts = list(self._counts)
+            count, total = self.count, self.total
+
+        result = []
+        i = 0
+        seen = 0
+        for b in bounds:
+            end = Histogram._index(b - 1) + 1
+            while i < end:
+                seen += counts[i]
+                i += 1
+            result.append((b, seen))
+
+        return result, count, total
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def observe(name, labels, ms):
+    """
+
+    :param name: Metric name, e.g. "aeneid_stage_duration_seconds"
+    :param labels: Dictionary of label values. Keep the set of values small; each combination is a series.
+    :param ms: Elapsed time in milliseconds.
+    :return: None
+    """
+    key = (name, _labels_key(labels))
+    h = _histograms.get(key, None)
+    if h is None:
+        with _lock:
+            h = _histograms.setdefault(key, Histogram())
+
+    h.record(ms * 1000.0)
+
+
+def increment(name, labels, n=1):
+    key = (name, _labels_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + n
+
+
+@contextmanager
+def timer(stage, table_name=None):
+    """
+
+    Time a block as one stage of a request, e.g.
+
+        with Metrics.timer("serialize", resource):
+            data = json.dumps(result)
+
+    :param stage: Stage name.
+    :param table_name: Table the work is for, if any.
+    """
+    if not enabled:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("aeneid_stage_duration_seconds", {"stage": stage, "table": table_name or ""},
+                (time.perf_counter() - start) * 1000.0)
+
+
+_string_literal = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+_number_literal = re.compile(r"\b\d+(?:\.\d+)?\b")
+_in_list = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_values_list = re.compile(r"(\(\.\.\.\))(?:\s*,\s*\(\.\.\.\))+")
+
+
+def normalize_sql(q):
+    """
+
+    :param q: SQL text, with %s slots or literals.
+    :return: The SQL with literals and slots replaced by ?, IN lists and multi-row VALUES collapsed, and
+        whitespace collapsed. Queries that differ only in their values normalize to the same text.
+    """
+    q = " ".join(q.split())
+    q = q.replace("%s", "?")
+    q = _string_literal.sub("?", q)
+    q = _number_literal.sub("?", q)
+    q = _in_list.sub("(...)", q)
+    q = _values_list.sub(r"\1, ...", q)
+    return q
+
+
+def record_query(table_name, q, execute_ms, fetch_ms=0.0):
+    """
+
+    Record the timings for one SQL statement, and add it to the slow query log if it is slow.
+
+    :param table_name: Table the statement is for.
+    :param q: SQL text.
+    :param execute_ms: Time for execute().
+    :param fetch_ms: Time for fetching the result.
+    :return: None
+    """
+    observe("aeneid_stage_duration_seconds", {"stage": "sql_execute", "table": table_name}, execute_ms)
+    if fetch_ms:
+        observe("aeneid_stage_duration_seconds", {"stage": "sql_fetch", "table": table_name}, fetch_ms)
+
+    total_ms = execute_ms + fetch_ms
+    observe("aeneid_table_query_duration_seconds", {"table": table_name}, total_ms)
+
+    if total_ms >= slow_query_ms:
+        entry = {
+            "time": time.time(),
+            "table": table_name,
+            "elapsed_ms": round(total_ms, 3),
+            "execute_ms": round(execute_ms, 3),
+            "fetch_ms": round(fetch_ms, 3),
+            "sql": normalize_sql(q)
+        }
+        _slow_queries.append(entry)
+        increment("aeneid_slow_queries_total", {"table": table_name})
+        slow_query_logger.warning("Slow query: %s", entry)
+
+
+def get_slow_queries():
+    """
+
+    :return: The most recent slow queries, newest last.
+    """
+    return list(_slow_queries)
+
+
+def get_percentiles(name, percentiles=(50, 90, 99)):
+    """
+
+    :param name: Histogram metric name.
+    :return: List of {labels..., "count": n, "p50_ms": ...} for every series of the metric.
+    """
+    with _lock:
+        series = [(k[1], h) for k, h in _histograms.items() if k[0] == name]
+
+    result = []
+    for labels, h in series:
+        e = dict(labels)
+        e["count"] = h.count
+        for p in percentiles:
+            e["p" + str(p) + "_ms"] = h.percentile(p) / 1000.0
+        result.append(e)
+
+    return result
+
+
+def get_counters(name):
+    """
+
+    :param name: Counter metric name.
+    :return: List of (labels dictionary, value) for every series of the counter.
+    """
+    with _lock:
+        return [(dict(k[1]), n) for k, n in _counters.items() if k[0] == name]
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+        _slow_queries.clear()
+
+
+def _escape(v):
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + (list(extra) if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(k + '="' + _escape(v) + '"' for k, v in items) + "}"
+
+
+# Exported bucket bounds: powers of two from 128us to about 67s. The full resolution is used for percentiles.
+_export_bounds = [1 << k for k in range(7, 27)]
+
+
+def to_prometheus(gauges=None):
+    """
+
+    :param gauges: Optional list of (name, help, [(labels dict, value), ...]) to export as gauges, e.g. pool and
+        cache statistics.
+    :return: All metrics in the Prometheus text exposition format.
+    """
+    with _lock:
+        histograms = sorted(_histograms.items(), key=lambda e: e[0])
+        counters = sorted(_counters.items(), key=lambda e: e[0])
+
+    lines = []
+    last_name = None
+    for (name, labels), h in histograms:
+        if name != last_name:
+            lines.append("# HELP " + name + " " + _help.get(name, name))
+            lines.append("# TYPE " + name + " histogram")
+            last_name = name
+
+        buckets, count, total = h.cumulative(_export_bounds)
+        for b, n in buckets:
+            lines.append(name + "_bucket" + _format_labels(labels, [("le", repr(b / 1000000.0))]) + " " + str(n))
+        lines.append(name + "_bucket" + _format_labels(labels, [("le", "+Inf")]) + " " + str(count))
+        lines.append(name + "_sum" + _format_labels(labels) + " " + repr(total / 1000000.0))
+        lines.append(name + "_count" + _format_labels(labels) + " " + str(count))
+
+    last_name = None
+    for (name, labels), n in counters:
+        if name != last_name:
+            lines.append("# HELP " + name + " " + _help.get(name, name))
+            lines.append("# TYPE " + name + " counter")
+            last_name = name
+        lines.append(name + _format_labels(labels) + " " + str(n))
+
+    for name, help_text, samples in (gauges or []):
+        lines.append("# HELP " + name + " " + help_text)
+        lines.append("# TYPE " + name + " gauge")
+        for labels, v in samples:
+            lines.append(name + _format_labels(_labels_key(labels)) + " " + str(v))
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,137 @@
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+
+
+# Structured query log. Each executed statement can produce one DEBUG record on the "aeneid.query" logger,
+# with the SQL, the arguments, the elapsed time and the row count as record attributes.
+#
+# The logger is at INFO by default, so setting the root logger to DEBUG does not turn it on. When it is off,
+# the cost per query is one isEnabledFor() check. The SQL and arguments are only formatted if a handler
+# actually emits the record, and with the queued handler that happens on the listener thread.
+
+logger = logging.getLogger("aeneid.query")
+logger.setLevel(logging.INFO)
+
+# Fraction of queries to log when query logging is on, e.g. 0.01 for 1%.
+sample_rate = 1.0
+
+_listener = None
+
+
+class _QueryMessage:
+    """
+    The message for a query record. Formatting is deferred to str(), i.e. to the handler that emits it.
+    """
+
+    __slots__ = ("table_name", "sql", "args", "elapsed_ms", "rows")
+
+    def __init__(self, table_name, sql, args, elapsed_ms, rows):
+        self.table_name = table_name
+        self.sql = sql
+        self.args = args
+        self.elapsed_ms = elapsed_ms
+        self.rows = rows
+
+    def __str__(self):
+        return "table=%s elapsed_ms=%.3f rows=%s sql=%s args=%s" % \
+               (self.table_name, self.elapsed_ms, self.rows, " ".join(self.sql.split()), self.args)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler.prepare() formats the record on the calling thread. This version enqueues the record as is,
+    so the request thread never formats the message or does any I/O.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def is_enabled():
+    """
+
+    :return: True if a query should be timed and logged. Applies sampling, so the answer differs per call
+        when sample_rate is less than 1.
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return False
+
+    return sample_rate >= 1.0 or random.random() < sample_rate
+
+
+def log_query(table_name, sql, args, elapsed_ms, rows=None):
+    """
+
+    Log one query. Call only if is_enabled() returned True.
+
+    :param table_name: Table the query was run for.
+    :param sql: SQL text with %s slots.
+    :param args: Arguments for the slots. These are not interpolated into the SQL.
+    :param elapsed_ms: Time to execute (and fetch) in milliseconds.
+    :param rows: Number of rows returned or affected, if known.
+    :return: None
+    """
+    msg = _QueryMessage(table_name, sql, args, elapsed_ms, rows)
+    logger.debug(msg, extra={"table_name": table_name, "sql": sql, "sql_args": args,
+                             "elapsed_ms": elapsed_ms, "rows": rows})
+
+
+def configure(level=logging.DEBUG, rate=None, handler=None, use_queue=True):
+    """
+
+    Turn query logging on or off.
+
+    :param level: logging.DEBUG to log queries, anything higher to turn query logging off.
+    :param rate: Fraction of queries to log. None keeps the current value.
+    :param handler: Handler that writes the records. Default is a StreamHandler on stdout.
+    :param use_queue: If True, records go through a queue and handler runs on a background thread.
+    :return: None
+    """
+    global sample_rate, _listener
+
+    if rate is not None:
+        sample_rate = float(rate)
+
+    logger.setLevel(level)
+
+    if handler is None and level > logging.DEBUG:
+        return
+
+    shutdown()
+
+    if handler is None:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter(" *** QUERY: %(message)s"))
+
+    if use_queue:
+        q = queue.SimpleQueue()
+        _listener = logging.handlers.QueueListener(q, handler, respect_handler_level=True)
+        _listener.start()
+        logger.addHandler(_DeferredQueueHandler(q))
+    else:
+        logger.addHandler(handler)
+
+    # Records are handled here. Do not also pass them to the root logger's handlers.
+    logger.propagate = False
+
+
+def shutdown():
+    """
+
+    Remove the query log handlers and stop the background thread, after it writes the queued records.
+
+    :return: None
+    """
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+    for h in list(logger.handlers):
+        logger.removeHandler(h)
+
+    logger.propagate = True
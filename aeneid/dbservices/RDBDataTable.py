@@ -3,8 +3,16 @@
 
 from aeneid.dbservices.BaseDataTable import BaseDataTable
 from aeneid.dbservices.DerivedDataTable import DerivedDataTable
+from aeneid.dbservices.DataExceptions import DataException
+import aeneid.dbservices.ConnectionPool as ConnectionPool
+import aeneid.dbservices.TableCatalog as TableCatalog
+import aeneid.dbservices.QueryLog as QueryLog
+import aeneid.dbservices.Metrics as Metrics
+import aeneid.dbservices.Filters as Filters
 import pandas as pd
 import logging
+import time
+from decimal import Decimal
 import pymysql
 
 
@@ -27,12 +35,23 @@ class RDBDataTable(BaseDataTable):
     }
 
 
-    def __init__(self, table_name, key_columns=None, connect_info=None, debug=True):
+    # If True, _run_q counts rows and (approximately) bytes read per table. Off by default because counting
+    # bytes looks at every value.
+    collect_io_stats = False
+
+    # Compiled statements (SQL text for a statement shape) are cached per table, up to max_statements.
+    use_statement_cache = True
+    max_statements = 500
+
+
+    def __init__(self, table_name, key_columns=None, connect_info=None, debug=True, default_fields=None):
         """
 
         :param table_name: The name of the RDB table.
         :param connect_info: Dictionary of parameters necessary to connect to the data.
         :param key_columns: List, in order, of the columns (fields) that comprise the primary key.
+        :param default_fields: Columns to select when the caller does not pass a field list. If None, all
+            columns are selected.
         """
 
         # Initialize and store information in the parent class.
@@ -42,27 +61,27 @@ class RDBDataTable(BaseDataTable):
         if connect_info is None:
             self._connect_info = RDBDataTable._default_connect_info
 
-        # Create a connection to use inside this object. In general, this is not the right approach.
-        # There would be a connection pool shared across many classes and applications.
-        self._cnx = pymysql.connect(
-            host=self._connect_info['host'],
-            user=self._connect_info['user'],
-            password=self._connect_info['password'],
-            db=self._connect_info['db'],
-            charset='utf8mb4',
-            cursorclass=pymysql.cursors.DictCursor)
+        # Connections come from a process wide pool shared by every table with the same connect info.
+        # Each statement borrows a connection and returns it, so request threads do not share a socket.
+        self._pool = ConnectionPool.get_pool(self._connect_info)
 
-        self._key_columns = self._get_primary_key_columns()
+        # Table metadata (keys, columns, foreign keys) is cached in a shared catalog.
+        # Key columns passed in by the caller take precedence over the catalog.
+        self._catalog = TableCatalog.get_catalog(self._connect_info)
+
+        self._default_fields = default_fields
+        self._statements = {}
+        self._io_stats = {"queries": 0, "rows_read": 0, "bytes_read": 0}
 
 
     def debug_message(self, *m):
         """
-        Prints some debug information if self._debug is True
+        Logs some debug information if self._debug is True. Queries are logged through QueryLog, not here.
         :param m: List of things to print.
         :return: None
         """
-        if self._debug:
-            print(" *** DEBUG:", *m)
+        if self._debug and logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(" *** DEBUG: %s", " ".join(str(x) for x in m))
 
 
     def __str__(self):
@@ -72,7 +91,7 @@ class RDBDataTable(BaseDataTable):
         """
         result = "RDBDataTable: table_name = " + self._table_name
         result += "\nTable type = " + str(type(self))
-        result += "\nKey fields: " + str(self._key_columns)
+        result += "\nKey fields: " + str(self._get_primary_key_columns())
 
         # Find out how many rows are in the table.
         q1 = "SELECT count(*) as count from " + self._table_name
@@ -84,7 +103,8 @@ class RDBDataTable(BaseDataTable):
         q = "select * from " + self._table_name + " limit 5"
 
         # Read into a data frame to make pretty print easier.
-        df = pd.read_sql(q, self._cnx)
+        with self._pool.connection() as cnx:
+            df = pd.read_sql(q, cnx)
         result += "\nFirst five rows:\n"
         result += df.to_string()
 
@@ -98,14 +118,18 @@ class RDBDataTable(BaseDataTable):
             may also have {} after select for columns to choose.
         :param args: A tuple of values to insert in the %s slots.
         :param fetch: If true, return the result.
-        :param cnx: A database connection. May be None
+        :param cnx: A database connection. May be None, in which case one is borrowed from the pool
+            for the duration of this statement.
         :param commit: Do not worry about this for now. This is more wizard stuff.
         :return: A result set or None.
         """
+        borrowed = False
+        discard = False
         try:
-            # Use the connection in the object if no connection provided.
+            # Borrow a connection from the pool if no connection provided.
             if cnx is None:
-                cnx = self._cnx
+                cnx = self._pool.get_connection()
+                borrowed = True
 
             # Convert the list of columns into the form "col1, col2, ..." for following SELECT.
             if fields:
@@ -113,15 +137,25 @@ class RDBDataTable(BaseDataTable):
 
             cursor = cnx.cursor()  # Just ignore this for now.
 
-            # If debugging is turned on, will print the query sent to the database.
-            self.debug_message("Query = ", cursor.mogrify(q, args))
+            # If debugging is on and the query log is enabled (and samples this query), the query is logged.
+            # Otherwise nothing is formatted.
+            log_it = self._debug and QueryLog.is_enabled()
+            timed = log_it or Metrics.enabled
+            if timed:
+                start = time.perf_counter()
 
             r = cursor.execute(q, args)  # Execute the query.
 
+            if timed:
+                executed = time.perf_counter()
+
             # Technically, INSERT, UPDATE and DELETE do not return results.
             # Sometimes the connector libraries return the number of created/deleted rows.
             if fetch:
                 r = cursor.fetchall()  # Return all elements of the result.
+
+                if RDBDataTable.collect_io_stats:
+                    self._count_io(r)
             else:
                 # r = None
                 pass
@@ -129,14 +163,51 @@ class RDBDataTable(BaseDataTable):
             if commit:  # Do not worry about this for now.
                 cnx.commit()
 
+            if timed:
+                end = time.perf_counter()
+                if Metrics.enabled:
+                    Metrics.record_query(self._table_name, q, (executed - start) * 1000.0,
+                                         (end - executed) * 1000.0)
+                if log_it:
+                    QueryLog.log_query(self._table_name, q, args, (end - start) * 1000.0,
+                                       len(r) if fetch else r)
+
         except Exception as e:
-            cnx.rollback()
+            # A failed connection is not put back in the pool. Other errors leave it usable after a rollback.
+            discard = ConnectionPool.is_connection_error(e)
+            if cnx is not None and not discard:
+                cnx.rollback()
             logging.exception("RDBDataTable._run_q: error = ", exc_info=True)
             raise e
 
+        finally:
+            if borrowed:
+                self._pool.release(cnx, discard=discard)
+
         return r
 
 
+    def _count_io(self, rows):
+        # Approximate bytes read as the length of the text form of every value. Not thread safe. These are
+        # only statistics.
+        n = 0
+        for r in rows:
+            for v in r.values():
+                n += len(str(v)) if v is not None else 0
+
+        self._io_stats["queries"] += 1
+        self._io_stats["rows_read"] += len(rows)
+        self._io_stats["bytes_read"] += n
+
+
+    def get_io_stats(self):
+        """
+
+        :return: Counts of queries, rows and approximate bytes read, if collect_io_stats is on.
+        """
+        return dict(self._io_stats)
+
+
     def _run_insert(self, table_name, column_list, values_list, cnx=None, commit=False):
         """
 
@@ -148,37 +219,47 @@ class RDBDataTable(BaseDataTable):
         :return:
         """
         try:
-            q = "insert into " + table_name + " "
+            q, args = self._build_insert(table_name, column_list, values_list)
+            result = self._run_q(q, args=args, fields=None, fetch=False, cnx=cnx, commit=True)
+            return result
 
-            # If the column list is not None, form the (col1, col2, ...) part of the statement.
-            if column_list is not None:
-                q += "(" + ",".join(column_list) + ") "
+        except Exception as e:
+            logging.error("RDBDataTable._run_insert exception", exc_info=True)
+            raise e
 
-            # We will use query parameters. For a term of the form values(%s, %s, ...) with one slot for
-            # each value to insert.
-            values = ["%s"] * len(values_list)
 
-            # Form the values(%s, %s, ...) part of the statement.
-            values = " ( " + ",".join(values) + ") "
-            values = "values" + values
+    def _build_insert(self, table_name, column_list, values_list):
+        """
 
-            # Put all together.
-            q += values
+        :return: (INSERT statement with a %s slot for each value, the values)
+        """
+        q = "insert into " + table_name + " "
 
-            result = self._run_q(q, args=values_list, fields=None, fetch=False, cnx=cnx, commit=True)
-            return result
+        # If the column list is not None, form the (col1, col2, ...) part of the statement.
+        if column_list is not None:
+            self._validate_columns(column_list)
+            q += "(" + ",".join(column_list) + ") "
 
-        except Exception as e:
-            logging.error("RDBDataTable._run_insert exception", exc_info=True)
-            raise e
+        # We will use query parameters. For a term of the form values(%s, %s, ...) with one slot for
+        # each value to insert.
+        values = ["%s"] * len(values_list)
 
+        # Form the values(%s, %s, ...) part of the statement.
+        values = " ( " + ",".join(values) + ") "
+        values = "values" + values
+
+        # Put all together.
+        q += values
+
+        return q, values_list
 
-    def _get_primary_key(self):
 
-        q = "SHOW KEYS FROM " + self._table_name + " WHERE Key_name = 'PRIMARY'"
-        rows = self._run_q(q=q, args=None)
+    def _get_primary_key(self):
 
-        keys = [r["Column_name"] for r in rows]
+        keys = self._catalog.get_primary_key(self._table_name)
+        if keys is None:
+            raise DataException(DataException.no_such_resource,
+                                "RDBDataTable: no such table " + self._table_name)
 
         return keys
 
@@ -188,13 +269,130 @@ class RDBDataTable(BaseDataTable):
 
         :return: The names of the primary key columns in the form ['col1', ..., 'coln']
 
-        The current implementation just returns the list of keys passed in the constructor.
-        An extended implementation would/should query database data/metadata to get the information.
+        Returns the key columns passed in the constructor, if any. Otherwise the key comes from the
+        table catalog, which caches INFORMATION_SCHEMA metadata instead of running SHOW KEYS on every call.
         """
+        if self._key_columns:
+            return self._key_columns
+
         result = self._get_primary_key()
         return result
 
 
+    def get_key_columns(self):
+        """
+
+        :return: The names of the primary key columns, in key order.
+        """
+        return self._get_primary_key_columns()
+
+
+    def get_join_columns(self, other_table_name):
+        """
+
+        :param other_table_name: Name of the table to navigate to, of the form schema.table
+        :return: List with one entry per foreign key relating the tables. Each entry is a list of the form
+            [[column in this table, column in other table], ...]
+        """
+        return self._catalog.get_join_columns(self._table_name, other_table_name)
+
+
+    def warm_up(self):
+        """
+
+        Open the pool's initial connections and load the table's metadata into the catalog.
+
+        :return: None
+        """
+        self._pool.warm_up()
+        self.get_metadata()
+
+
+    def get_metadata(self, margin=0.0):
+        """
+
+        :param margin: Reload the metadata if it expires within this many seconds.
+        :return: The TableMetadata (columns, column types, primary and foreign keys) for the table.
+        """
+        return self._catalog.get_table(self._table_name, margin)
+
+
+    def is_metadata_fresh(self, margin=0.0):
+        """
+
+        :param margin: Seconds the metadata must stay fresh for.
+        :return: True if the table's metadata is loaded and will not be reloaded within margin seconds.
+        """
+        return self._catalog.is_fresh(self._table_name, margin)
+
+
+    def is_indexed(self, column):
+        """
+
+        :param column: Column name.
+        :return: True if the column is the first column of an index on the table.
+        """
+        md = self.get_metadata()
+        return md is not None and md.is_indexed(column)
+
+
+    def get_column_names(self):
+        """
+
+        :return: The column names of the table, in ordinal order.
+        """
+        return self._catalog.get_columns(self._table_name)
+
+
+    def set_default_fields(self, default_fields):
+        """
+
+        :param default_fields: Columns to select when the caller does not pass a field list, or None for all.
+        :return: None
+        """
+        if default_fields is not None:
+            self._validate_columns(default_fields)
+        self._default_fields = default_fields
+        self.clear_statement_cache()
+
+
+    def _validate_columns(self, columns):
+        """
+
+        Check column names against the catalog. Column names are put into SQL text, so this is what keeps
+        arbitrary strings from the query string out of the SQL.
+
+        :param columns: List of column names.
+        :return: None. Raises a DataException if a column does not exist.
+        """
+        md = self.get_metadata()
+        if md is None:
+            raise DataException(DataException.no_such_resource,
+                                "RDBDataTable: no such table " + self._table_name)
+
+        bad = [c for c in columns if c not in md.column_types]
+        if bad:
+            raise DataException(DataException.data_error,
+                                "RDBDataTable: unknown columns " + str(bad) + " for " + self._table_name)
+
+
+    def get_select_list(self, field_list):
+        """
+
+        :param field_list: Requested fields, or None.
+        :return: The validated list of columns to select. Without a field list, this is the table's default
+            projection, or all columns.
+        """
+        if field_list is None:
+            field_list = self._default_fields
+        if field_list is None:
+            return self.get_column_names()
+
+        field_list = [f.strip() for f in field_list]
+        self._validate_columns(field_list)
+        return field_list
+
+
     def find_by_primary_key(self, key_fields, field_list=None):
         """
 
@@ -230,71 +428,328 @@ class RDBDataTable(BaseDataTable):
         return result
 
 
-    def _template_to_where_clause(self, t):
+    def _in_clause(self, columns, count):
         """
-        Convert a query template into a WHERE clause.
-        :param t: Query template.
-        :return: (WHERE clause, arg values for %s in clause)
+
+        :param columns: List of columns.
+        :param count: Number of values (tuples of values for several columns) in the list.
+        :return: WHERE c IN (%s, ...) or, for several columns, WHERE (c1, c2, ...) IN ((%s, %s, ...), ...)
         """
-        terms = []
-        args = []
-        w_clause = ""
-
-        # The where clause will be of the for col1=%s, col2=%s, ...
-        # Build a list containing the individual col1=%s
-        # The args passed to +run_q will be the values in the template in the same order.
-        for k, v in t.items():
-            temp_s = k + "=%s "
-            terms.append(temp_s)
-            args.append(v)
-
-        if len(terms) > 0:
-            w_clause = "WHERE " + " AND ".join(terms)
-        else:
-            w_clause = ""
-            args = None
+        if len(columns) == 1:
+            return "WHERE " + columns[0] + " IN (" + ",".join(["%s"] * count) + ")"
+
+        row_slot = "(" + ",".join(["%s"] * len(columns)) + ")"
+        return "WHERE (" + ",".join(columns) + ") IN (" + ",".join([row_slot] * count) + ")"
 
-        return w_clause, args
 
+    def find_by_primary_keys(self, keys, field_list=None, chunk_size=500):
+        """
 
-    def _get_extras(self, limit=None, offset=None, order_by=None):
+        Find several records with one query per chunk of keys, of the form WHERE k IN (...) or, for a
+        composite key, WHERE (k1, k2, ...) IN ((...), ...).
 
-        result = ' '
-        if order_by:
-            result += ' order by ' + order_by + ' '
-        if limit:
-            result += ' limit ' + str(limit)
-        if offset:
-            result += ' offset ' + str(offset)
+        :param keys: A list of key values, each a list in the order of the key columns.
+        :param field_list: A subset of the fields of the records to return.
+        :param chunk_size: Maximum number of keys per query.
+        :return: A list with one entry per key, in the same order as keys. The entry is None if there is no
+            record with the key.
+        """
+        try:
+            key_columns = self._get_primary_key_columns()
+            n = len(key_columns)
+
+            # The key columns are needed to match rows to keys, even if not requested.
+            f_select = self.get_select_list(field_list)
+            extra_columns = [k for k in key_columns if k not in f_select]
+            projection = list(f_select) if extra_columns else None
+            f_select = f_select + extra_columns
+
+            # Keys from URLs are strings, while the DB may return numbers. Match on the string form.
+            found = {}
+
+            for i in range(0, len(keys), chunk_size):
+                chunk = keys[i:i + chunk_size]
 
+                w_clause = self._in_clause(key_columns, len(chunk))
+                args = [v for k in chunk for v in k]
+                q = "select {} from " + self._table_name + " " + w_clause
+
+                rows = self._run_q(q, args=args, fields=f_select, fetch=True)
+                for r in rows:
+                    found[tuple(str(r[k]) for k in key_columns)] = r
+
+            result = []
+            for k in keys:
+                r = found.get(tuple(str(v) for v in k), None)
+                if r is not None and projection is not None:
+                    r = self._project([r], projection)[0]
+                result.append(r)
+
+        except Exception as e:
+            logging.error("RDBDataTable.find_by_primary_keys exception", exc_info=True)
+            raise e
 
         return result
 
 
-    def _project(self, rows, field_list):
-        return rows
+    def find_by_column_values(self, columns, values, field_list=None, chunk_size=500):
+        """
 
-        pass
+        Find the rows matching any of a list of values for some columns, with one IN query per chunk of
+        values. This loads the related rows for a whole page of parent rows at once, e.g. the batting rows for
+        a list of players.
 
+        :param columns: List of columns, e.g. the foreign key columns.
+        :param values: List of value tuples, in the order of columns.
+        :param field_list: A subset of the fields of the records to return. The columns are always returned.
+        :param chunk_size: Maximum number of values per query.
+        :return: Dictionary of {tuple of the string form of the values: [matching rows]}
         """
+        try:
+            self._validate_columns(columns)
+            f_select = self.get_select_list(field_list)
+            f_select = f_select + [c for c in columns if c not in f_select]
+
+            result = {}
+            values = list(values)
+            for i in range(0, len(values), chunk_size):
+                chunk = values[i:i + chunk_size]
+                q = "select {} from " + self._table_name + " " + self._in_clause(columns, len(chunk))
+                args = [v for t in chunk for v in t]
 
+                rows = self._run_q(q, args=args, fields=f_select, fetch=True)
+                for r in rows:
+                    result.setdefault(tuple(str(r[c]) for c in columns), []).append(r)
+
+        except Exception as e:
+            logging.error("RDBDataTable.find_by_column_values exception", exc_info=True)
+            raise e
+
+        return result
+
+
+    def _template_shape(self, template):
+        """
+
+        :param template: Query template. Keys are columns or column[op] (see Filters).
+        :return: The shape of the template, a tuple of (key, number of values for in, or None), sorted by key.
+            Templates with the same shape compile to the same SQL.
+        """
         result = []
+        for k, v in (template or {}).items():
+            column, op = Filters.parse_key(k)
+            result.append((k, len(Filters.in_values(v)) if op == "in" else None))
+
+        return tuple(sorted(result))
+
+
+    def _template_args(self, template, shape):
+        """
+
+        :return: The values for the %s slots of the template's terms, in the order of shape.
+        """
+        args = []
+        for k, n in shape:
+            column, op = Filters.parse_key(k)
+            if op == "in":
+                args.extend(Filters.in_values(template[k]))
+            elif op == "prefix":
+                args.append(Filters.like_prefix(template[k]))
+            else:
+                args.append(template[k])
+
+        return args
+
+
+    def _where_terms(self, shape, alias=""):
+        """
+
+        :param shape: From _template_shape().
+        :param alias: Prefix for the column names, e.g. "d."
+        :return: List of terms of the form col=%s, col>=%s, col IN (%s,%s), col LIKE %s, ...
+        """
+        parsed = [(Filters.parse_key(k), n) for k, n in shape]
+        self._validate_columns([p[0][0] for p in parsed])
 
+        terms = []
+        for (column, op), n in parsed:
+            if op == "in":
+                terms.append(alias + column + " IN (" + ",".join(["%s"] * n) + ") ")
+            elif op == "prefix":
+                terms.append(alias + column + " LIKE %s ")
+            else:
+                terms.append(alias + column + Filters.operators[op] + "%s ")
+
+        return terms
+
+
+    def _where_clause(self, shape):
+        terms = self._where_terms(shape)
+        return ("WHERE " + " AND ".join(terms)) if terms else ""
+
+
+    def _project(self, rows, field_list):
+        """
+
+        Project rows onto a field list in Python. Used to drop columns that were selected only for internal use,
+        e.g. to match rows to keys.
+
+        :param rows: List of dictionaries.
+        :param field_list: Fields to keep, or None to keep everything.
+        :return: List of dictionaries.
+        """
         if field_list is None:
-            result = rows
-        else:
-            for r in rows:
-                new_r = {f: r[f] for f in field_list}
-                result.append(new_r)
+            return rows
+
+        return [{f: r[f] for f in field_list} for r in rows]
+
+
+    def get_keyset_columns(self, order_by=None):
+        """
+
+        :param order_by: Optional column to sort on.
+        :return: The columns that define a unique, total order for keyset pagination: the order_by column
+            followed by the primary key columns.
+        """
+        result = []
+
+        if order_by:
+            columns = self.get_column_names()
+            if columns is not None and order_by not in columns:
+                raise DataException(DataException.data_error,
+                                    "RDBDataTable: cannot order " + self._table_name + " by " + order_by)
+            result.append(order_by)
 
+        result.extend([k for k in self._get_primary_key_columns() if k not in result])
         return result
 
+
+    def _seek_clause(self, keyset_columns, after):
+        """
+
+        Build the predicate selecting rows that sort after a given row in keyset order. The predicate is written
+        as (c1 > v1) OR (c1 = v1 AND c2 > v2) OR ..., which MySQL can use as a range on the index.
+
+        :param keyset_columns: Columns from get_keyset_columns()
+        :param after: Values of the keyset columns for the last row of the previous page.
+        :return: (predicate, arg values for %s in the predicate)
+        """
+        if len(after) != len(keyset_columns):
+            raise DataException(DataException.data_error, "RDBDataTable: invalid cursor.")
+
+        terms = []
+        args = []
+
+        for i in range(0, len(keyset_columns)):
+            t = [c + "=%s" for c in keyset_columns[:i]]
+            t.append(keyset_columns[i] + ">%s")
+            terms.append("(" + " AND ".join(t) + ")")
+            args.extend(after[:i + 1])
+
+        return "(" + " OR ".join(terms) + ")", args
+
+
+    def _get_statement(self, statement_key, compile_fn):
+        """
+
+        Get a compiled statement from the statement cache, compiling it on a miss. Column validation and SQL
+        text construction happen once per statement shape, so the hot path only binds values.
+
+        :param statement_key: Tuple identifying the statement shape, e.g. (operation, template keys, fields, ...)
+        :param compile_fn: Function that returns the compiled statement.
+        :return: The compiled statement.
         """
+        if not RDBDataTable.use_statement_cache:
+            return compile_fn()
+
+        result = self._statements.get(statement_key, None)
+        if result is None:
+            result = compile_fn()
+            if len(self._statements) >= RDBDataTable.max_statements:
+                self._statements.clear()
+            self._statements[statement_key] = result
+
+        return result
+
+
+    def clear_statement_cache(self):
+        self._statements.clear()
+
+
+    def _compile_select(self, keys, field_list, has_limit, has_offset, order_by, keyset, has_after):
+        """
+
+        :return: (SQL text with %s slots for the template values, seek values, limit and offset in that order,
+            number of keyset columns)
+        """
+        w_clause = self._where_clause(keys)
+
+        # Push down only the requested columns, or the table's default projection.
+        f_select = self.get_select_list(field_list)
+
+        q = "select " + ",".join(f_select) + " from " + self._table_name + " " + w_clause
+        n_keyset = 0
+
+        if keyset:
+            keyset_columns = self.get_keyset_columns(order_by)
+            n_keyset = len(keyset_columns)
+
+            if has_after:
+                seek = self._seek_clause(keyset_columns, [None] * n_keyset)[0]
+                q += (" AND " if keys else " WHERE ") + seek
+
+            q += " order by " + ",".join(keyset_columns)
+            if has_limit:
+                q += " limit %s"
+        else:
+            if order_by:
+                self._validate_columns([order_by])
+                q += " order by " + order_by
+            if has_limit:
+                q += " limit %s"
+            if has_offset:
+                q += " offset %s"
+
+        return q, n_keyset
+
+
+    def _build_select(self, template, field_list=None, limit=None, offset=None, order_by=None,
+                      keyset=False, after=None):
+        """
+
+        Build the SELECT for find_by_template() and stream_by_template() from the statement cache.
+
+        :return: (query, args for the %s slots)
+        """
+        template = template or {}
+        keys = self._template_shape(template)
+        has_after = bool(keyset and after)
+        has_offset = bool(offset) and not keyset
+        fields_key = tuple(field_list) if field_list is not None else None
+
+        statement_key = ("select", keys, fields_key, bool(limit), has_offset, order_by, keyset, has_after)
+        q, n_keyset = self._get_statement(statement_key, lambda: self._compile_select(
+            keys, field_list, bool(limit), has_offset, order_by, keyset, has_after))
+
+        args = self._template_args(template, keys)
+
+        if has_after:
+            if len(after) != n_keyset:
+                raise DataException(DataException.data_error, "RDBDataTable: invalid cursor.")
+            for i in range(0, n_keyset):
+                args.extend(after[:i + 1])
+
+        if limit:
+            args.append(int(limit))
+        if has_offset:
+            args.append(int(offset))
+
+        return q, (args if args else None)
 
 
     def find_by_template(self, template, field_list=None, limit=None,
                          offset=None, order_by=None, follow_paths=False,
-                         commit=True):
+                         commit=True, keyset=False, after=None):
         """
 
         :param template: A dictionary of the form { "field1" : value1, "field2": value2, ...}
@@ -302,6 +757,9 @@ class RDBDataTable(BaseDataTable):
         :param limit: Do not worry about this for now.
         :param offset: Do not worry about this for now.
         :param order_by: Do not worry about this for now.
+        :param keyset: If True, sort on get_keyset_columns(order_by) and ignore offset. Pages are selected with
+            after instead, so the cost of a page does not grow with its position.
+        :param after: For keyset pagination, the keyset column values of the last row of the previous page.
         :return: A list containing dictionaries. A dictionary is in the list representing each record
             that matches the template. The dictionary only contains the requested fields.
         """
@@ -309,48 +767,307 @@ class RDBDataTable(BaseDataTable):
         result = None
 
         try:
-            # Compute the where clause.
-            w_clause = self._template_to_where_clause(template)
+            q, args = self._build_select(template, field_list, limit, offset, order_by, keyset, after)
+            result = self._run_q(q, args=args, fields=None, fetch=True, commit=commit)
 
-            if field_list is None:
-                # If there is not field list, we are doing 'select *'
-                f_select = ['*']
-            else:
-                f_select = field_list
+            # SELECT queries always produce tables.
+            with Metrics.timer("derived_build", self._table_name):
+                result = DerivedDataTable("SELECT(" + self._table_name + ")", result)
+
+        except Exception as e:
+            logging.error("RDBDataTable.find_by_template exception", exc_info=True)
+            raise e
+
+        return result
+
+
+    def _compile_related(self, related, join_map, keys, field_list, has_limit, has_offset, order_by):
+        """
+
+        :return: SQL joining this table (s) to the related table (d) on join_map, selecting the related rows for
+            one primary key of this table. Slots are the key values, the template values, limit and offset.
+        """
+        f_select = related.get_select_list(field_list)
+
+        q = "select " + ",".join(["d." + f for f in f_select]) + \
+            " from " + self._table_name + " s join " + related._table_name + " d on " + \
+            " AND ".join(["s." + m[0] + "=d." + m[1] for m in join_map])
+
+        terms = ["s." + k + "=%s" for k in self._get_primary_key_columns()]
+        terms.extend(related._where_terms(keys, "d."))
+        q += " WHERE " + " AND ".join(terms)
+
+        if order_by:
+            related._validate_columns([order_by])
+            q += " order by d." + order_by
+        if has_limit:
+            q += " limit %s"
+        if has_offset:
+            q += " offset %s"
+
+        return q
+
+
+    def find_related(self, key_fields, related, join_map, template=None, field_list=None, limit=None,
+                     offset=None, order_by=None):
+        """
+
+        Find the rows of a related table that match one row of this table, e.g. the batting rows for a player.
+
+        If the join columns in this table are part of its primary key, the values come from key_fields and the
+        related table is queried directly, on its (indexed) foreign key columns. Otherwise, a single JOIN
+        finds the rows. Either way, this is one query.
 
-            # Query template.
-            # _run_q will use args for %s terms and will format the field selection into {}
-            q = "select {} from " + self._table_name + " " + w_clause[0]
+        :param key_fields: Values of this table's primary key columns, in order.
+        :param related: The RDBDataTable to navigate to.
+        :param join_map: List of the form [[column in this table, column in related table], ...]
+        :param template: Additional template on the related table's columns.
+        :return: A derived table containing the related rows.
+        """
+        template = template or {}
+        key_columns = self._get_primary_key_columns()
+        if len(key_fields) != len(key_columns):
+            raise DataException(DataException.data_error,
+                                "RDBDataTable: expected " + str(len(key_columns)) + " key values")
+        key = dict(zip(key_columns, key_fields))
 
+        try:
+            if all(m[0] in key for m in join_map):
+                t = dict(template)
+                for m in join_map:
+                    if m[1] in t and str(t[m[1]]) != str(key[m[0]]):
+                        # The template contradicts the relationship.
+                        return DerivedDataTable("SELECT(" + related._table_name + ")", [])
+                    t[m[1]] = key[m[0]]
+
+                return related.find_by_template(t, field_list, limit, offset, order_by)
+
+            keys = related._template_shape(template)
+            has_offset = bool(offset)
+            fields_key = tuple(field_list) if field_list is not None else None
+            statement_key = ("related", related._table_name, tuple(tuple(m) for m in join_map), keys, fields_key,
+                             bool(limit), has_offset, order_by)
+            q = self._get_statement(statement_key, lambda: self._compile_related(
+                related, join_map, keys, field_list, bool(limit), has_offset, order_by))
+
+            args = list(key_fields) + related._template_args(template, keys)
             if limit:
-                q += " limit " + str(limit)
-            if offset:
-                q += " offset " + str(offset)
+                args.append(int(limit))
+            if has_offset:
+                args.append(int(offset))
 
-            result = self._run_q(q, args=w_clause[1], fields=f_select, fetch=True, commit=commit)
+            result = self._run_q(q, args=args, fields=None, fetch=True)
+            with Metrics.timer("derived_build", related._table_name):
+                result = DerivedDataTable("SELECT(" + related._table_name + ")", result)
 
-            # SELECT queries always produce tables.
-            result = DerivedDataTable("SELECT(" + self._table_name + ")", result)
+        except Exception as e:
+            logging.error("RDBDataTable.find_related exception", exc_info=True)
+            raise e
+
+        return result
+
+
+    def count_by_template(self, template):
+        """
+
+        :param template: Query template.
+        :return: The number of rows matching the template, from SELECT count(*).
+        """
+        q, args = self._build_count(template)
+        rows = self._run_q(q, args=args, fields=None, fetch=True)
+
+        return int(rows[0]["count"])
+
+
+    def _build_count(self, template):
+        """
+
+        :return: (SELECT count(*) for the template, args for the %s slots)
+        """
+        template = template or {}
+        keys = self._template_shape(template)
+
+        def compile_count():
+            return "select count(*) as count from " + self._table_name + " " + \
+                   self._where_clause(keys)
+
+        q = self._get_statement(("count", keys), compile_count)
+        args = self._template_args(template, keys)
+        return q, (args if args else None)
+
+
+    def estimate_count(self, template):
+        """
+
+        Estimate the number of matching rows without counting them. For the whole table, this is TABLE_ROWS
+        from INFORMATION_SCHEMA.TABLES. With a template, it is the optimizer's row estimate from EXPLAIN. Both
+        come from index statistics, so they are cheap but approximate (InnoDB estimates can be off by tens
+        of percent).
+
+        :param template: Query template.
+        :return: Estimated row count.
+        """
+        template = template or {}
+        keys = self._template_shape(template)
+
+        if not keys:
+            md = self._catalog.get_table(self._table_name)
+            if md is None:
+                raise DataException(DataException.no_such_resource, "RDBDataTable: no table " + self._table_name)
+
+            q = "select TABLE_ROWS as count from INFORMATION_SCHEMA.TABLES where TABLE_SCHEMA=%s and TABLE_NAME=%s"
+            rows = self._run_q(q, args=[md.schema, md.table_name], fields=None, fetch=True)
+            return int(rows[0]["count"] or 0) if rows else 0
+
+        def compile_explain():
+            return "explain select 1 from " + self._table_name + " " + \
+                   self._where_clause(keys)
+
+        q = self._get_statement(("explain", keys), compile_explain)
+        rows = self._run_q(q, args=self._template_args(template, keys), fields=None, fetch=True)
+        if not rows:
+            return 0
+
+        # rows is the number of rows the access path reads. filtered is the percentage expected to pass the
+        # rest of the WHERE clause.
+        r = rows[0]
+        estimate = float(r.get("rows", None) or 0) * float(r.get("filtered", None) or 100.0) / 100.0
+        return int(round(estimate))
+
+
+    def _compile_aggregate(self, keys, group_by, aggregates, order_by, has_limit):
+        """
+
+        :return: SQL for aggregate(). Slots are the template values and the limit.
+        """
+        self._check_aggregates(aggregates)
+        self._validate_columns(list(group_by) + [c for f, c in aggregates if c != "*"])
+
+        names = list(group_by) + [self.aggregate_name(f, c) for f, c in aggregates]
+        if order_by and order_by not in names:
+            raise DataException(DataException.data_error, "RDBDataTable: cannot order by " + str(order_by))
+
+        terms = list(group_by)
+        for f, c in aggregates:
+            terms.append(f.upper() + "(" + c + ") AS " + self.aggregate_name(f, c))
+
+        q = "select " + ",".join(terms) + " from " + self._table_name + " " + \
+            self._where_clause(keys)
+
+        if group_by:
+            q += " group by " + ",".join(group_by)
+        if order_by:
+            q += " order by " + order_by
+        if has_limit:
+            q += " limit %s"
+
+        return q
+
+
+    def aggregate(self, template, group_by=None, aggregates=None, order_by=None, limit=None):
+        """
+
+        Compute the aggregates in the database, with one GROUP BY query.
+
+        :param template: Query template selecting the rows.
+        :param group_by: List of columns to group on. If None, there is one group with all the rows.
+        :param aggregates: List of [function, column], e.g. [["sum", "HR"], ["count", "*"]]
+        :param order_by: A group by column or aggregate name to sort on.
+        :param limit: Maximum number of groups to return.
+        :return: A derived table with one row per group.
+        """
+        template = template or {}
+        keys = self._template_shape(template)
+        group_by = tuple(group_by or ())
+        aggregates = tuple(tuple(a) for a in (aggregates or ()))
+
+        try:
+            statement_key = ("aggregate", keys, group_by, aggregates, order_by, bool(limit))
+            q = self._get_statement(statement_key, lambda: self._compile_aggregate(
+                keys, group_by, aggregates, order_by, bool(limit)))
+
+            args = self._template_args(template, keys)
+            if limit:
+                args.append(int(limit))
+
+            rows = self._run_q(q, args=(args if args else None), fields=None, fetch=True)
+
+            # SUM and AVG come back as Decimal. Return JSON numbers.
+            for r in rows:
+                for k, v in r.items():
+                    if isinstance(v, Decimal):
+                        r[k] = int(v) if v == v.to_integral_value() else float(v)
+
+            result = DerivedDataTable("AGGREGATE(" + self._table_name + ")", rows)
 
         except Exception as e:
-            logging.error("RDBDataTable.find_by_template exception", exc_info=True)
+            logging.error("RDBDataTable.aggregate exception", exc_info=True)
             raise e
 
         return result
 
 
-    def delete_by_template(self, template):
+    def stream_by_template(self, template, field_list=None, limit=None, offset=None, order_by=None,
+                           batch_size=500):
+        """
+
+        Like find_by_template(), but returns a generator over the rows. The query runs on an unbuffered
+        server side cursor, so only batch_size rows are in memory at a time. The connection is held until the
+        generator is exhausted or closed.
+
+        :param batch_size: Number of rows to fetch from the server at a time.
+        :return: A generator producing one dictionary per row.
+        """
+        q, args = self._build_select(template, field_list, limit, offset, order_by)
+
+        cnx = self._pool.get_connection()
+        finished = False
+        try:
+            log_it = self._debug and QueryLog.is_enabled()
+            start = time.perf_counter()
+
+            cursor = cnx.cursor(pymysql.cursors.SSDictCursor)
+            cursor.execute(q, args)
+
+            # Only the time to execute is known here. The rows are read as the caller consumes them.
+            if log_it:
+                QueryLog.log_query(self._table_name, q, args, (time.perf_counter() - start) * 1000.0)
+            if Metrics.enabled:
+                Metrics.record_query(self._table_name, q, (time.perf_counter() - start) * 1000.0)
+
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for r in rows:
+                    yield r
+
+            cursor.close()
+            finished = True
+
+        except Exception as e:
+            logging.error("RDBDataTable.stream_by_template exception", exc_info=True)
+            raise e
+
+        finally:
+            # If the caller stopped early, the connection still has unread rows. Close it rather than
+            # reading the rest of a possibly huge result just to reuse it.
+            self._pool.release(cnx, discard=not finished)
+
+
+    def delete_by_template(self, template, cnx=None):
         """
 
         Deletes all records that match the template.
 
         :param template: A template.
+        :param cnx: A connection with an open transaction, e.g. from a batch. The caller commits. If None,
+            the delete is committed on its own.
         :return: A count of the rows deleted.
         """
         try:
-            wc = self._template_to_where_clause(template)
-            q = "delete from " + self._table_name + " " + wc[0]
-            result = self._run_q(q=q, args=wc[1], fields=None, fetch=False, cnx=None, commit=True)
+            q, args = self._build_delete(template)
+            result = self._run_q(q=q, args=args, fields=None, fetch=False, cnx=cnx, commit=(cnx is None))
 
         except Exception as e:
             logging.error("RDBDataTable.delete_by_templete exception", exc_info=True)
@@ -359,11 +1076,27 @@ class RDBDataTable(BaseDataTable):
         return result
 
 
-    def delete_by_key(self, key_fields):
+    def _build_delete(self, template):
+        """
+
+        :return: (DELETE for the rows matching the template, args for the %s slots)
+        """
+        template = template or {}
+        keys = self._template_shape(template)
+
+        def compile_delete():
+            return "delete from " + self._table_name + " " + self._where_clause(keys)
+
+        q = self._get_statement(("delete", keys), compile_delete)
+        args = self._template_args(template, keys)
+        return q, (args if args else None)
+
+
+    def delete_by_key(self, key_fields, cnx=None):
 
         try:
-            k = dict(zip(self._key_columns, key_fields))
-            return self.delete_by_template(k)
+            k = dict(zip(self._get_primary_key_columns(), key_fields))
+            return self.delete_by_template(k, cnx=cnx)
 
         except Exception as e:
             logging.error("RDBDataTable.delete_by_key exception", exc_info=True)
@@ -393,39 +1126,179 @@ class RDBDataTable(BaseDataTable):
             return result
 
         except Exception as e:
-            print("Insert Exception = ", e)
+            logging.exception("RDBDataTable.insert: error = ", exc_info=True)
+            raise e
+
+
+    def insert_many(self, new_records, batch_size=1000, cnx=None):
+        """
+
+        Insert records with multi-row INSERT ... VALUES (...), (...) statements, batch_size rows per statement.
+        Each batch is committed as one transaction. All batches use the same pooled connection.
+
+        :param new_records: A list of dictionaries, each representing a row to add. Records that have different
+            columns go into different statements.
+        :param batch_size: Number of records per INSERT statement and transaction.
+        :param cnx: A connection with an open transaction, e.g. from a batch. The statements run on it and the
+            caller commits.
+        :return: The number of rows inserted.
+        """
+        result = 0
+
+        # Group the records by column list, keeping the order of the first record with each list.
+        groups = {}
+        for r in new_records:
+            groups.setdefault(tuple(r.keys()), []).append(r)
+
+        def run(cnx, commit):
+            n = 0
+            for column_list, records in groups.items():
+                self._validate_columns(column_list)
+                row_slot = "(" + ",".join(["%s"] * len(column_list)) + ")"
+
+                for i in range(0, len(records), batch_size):
+                    batch = records[i:i + batch_size]
+                    q = "insert into " + self._table_name + " (" + ",".join(column_list) + ") values " + \
+                        ",".join([row_slot] * len(batch))
+                    args = [r[c] for r in batch for c in column_list]
+
+                    n += self._run_q(q, args=args, fields=None, fetch=False, cnx=cnx, commit=commit)
+            return n
+
+        try:
+            if cnx is not None:
+                result = run(cnx, False)
+            else:
+                with self._pool.connection() as cnx:
+                    result = run(cnx, True)
+
+        except Exception as e:
+            logging.error("RDBDataTable.insert_many exception", exc_info=True)
             raise e
 
+        return result
+
+
+    def _compile_upsert(self, column_list, partial):
+        """
+
+        :return: (INSERT ... VALUES without the rows, the ON DUPLICATE KEY UPDATE clause)
+        """
+        self._validate_columns(column_list)
+        key_columns = self._get_primary_key_columns()
+
+        # For a replace, every non key column is set, so columns missing from the record get VALUES(c), which
+        # is the column default.
+        if partial:
+            update_columns = [c for c in column_list if c not in key_columns]
+        else:
+            update_columns = [c for c in self.get_column_names() if c not in key_columns]
+
+        # A record with only key columns changes nothing, but the clause cannot be empty.
+        if not update_columns:
+            update_columns = key_columns[:1]
+
+        prefix = "insert into " + self._table_name + " (" + ",".join(column_list) + ") values "
+        suffix = " on duplicate key update " + ",".join([c + "=VALUES(" + c + ")" for c in update_columns])
+        return prefix, suffix
+
+
+    def upsert(self, new_record, partial=False, cnx=None):
+        """
+
+        Insert the record or update the row with the same key, in one INSERT ... ON DUPLICATE KEY UPDATE.
+
+        :param new_record: A dictionary with the key columns and the values to store.
+        :param partial: If False, replace the row: columns not in the record are set to their defaults. If True,
+            only the columns in the record are changed.
+        :param cnx: A connection with an open transaction. The caller commits.
+        :return: 1 if the row was inserted, 2 if an existing row was changed, 0 if it was already the same.
+        """
+        return self.upsert_many([new_record], partial=partial, cnx=cnx)
+
 
-    def update_by_template(self, template, new_values):
+    def upsert_many(self, new_records, partial=False, batch_size=1000, cnx=None):
+        """
+
+        upsert() with multi-row INSERT ... ON DUPLICATE KEY UPDATE statements, batch_size rows per statement.
+
+        :param new_records: A list of dictionaries, each with the key columns. Records that have different
+            columns go into different statements.
+        :param partial: See upsert()
+        :param batch_size: Number of records per statement and transaction.
+        :param cnx: A connection with an open transaction. The caller commits.
+        :return: The affected row count: 1 per inserted row, 2 per changed row.
+        """
+        groups = {}
+        for r in new_records:
+            groups.setdefault(tuple(r.keys()), []).append(r)
+
+        def run(cnx, commit):
+            n = 0
+            for column_list, records in groups.items():
+                prefix, suffix = self._get_statement(("upsert", column_list, partial),
+                                                     lambda: self._compile_upsert(column_list, partial))
+                row_slot = "(" + ",".join(["%s"] * len(column_list)) + ")"
+
+                for i in range(0, len(records), batch_size):
+                    batch = records[i:i + batch_size]
+                    q = prefix + ",".join([row_slot] * len(batch)) + suffix
+                    args = [r[c] for r in batch for c in column_list]
+
+                    n += self._run_q(q, args=args, fields=None, fetch=False, cnx=cnx, commit=commit)
+            return n
+
+        try:
+            if cnx is not None:
+                result = run(cnx, False)
+            else:
+                with self._pool.connection() as cnx:
+                    result = run(cnx, True)
+
+        except Exception as e:
+            logging.error("RDBDataTable.upsert_many exception", exc_info=True)
+            raise e
+
+        return result
+
+
+    def update_by_template(self, template, new_values, cnx=None):
         """
 
         :param template: A template that defines which matching rows to update.
         :param new_values: A dictionary containing fields and the values to set for the corresponding fields
             in the records.
+        :param cnx: A connection with an open transaction, e.g. from a batch. The caller commits.
         :return: The number of rows updates.
         """
-        terms = []
-        set_args = []
+        q, args = self._build_update(template, new_values)
+        result = self._run_q(q, args, fetch=False, cnx=cnx, commit=(cnx is None))
+        return result
 
-        for k, v in new_values.items():
-            terms.append(k + "=%s")
-            set_args.append(v)
 
-        terms = ",".join(terms)
+    def _build_update(self, template, new_values):
+        """
 
-        wc = self._template_to_where_clause(template)
+        :return: (UPDATE setting new_values on the rows matching the template, args for the %s slots)
+        """
+        template = template or {}
+        keys = self._template_shape(template)
+        set_keys = tuple(sorted(new_values.keys()))
 
-        set_args.extend(wc[1])
+        def compile_update():
+            self._validate_columns(set_keys)
+            terms = ",".join([k + "=%s" for k in set_keys])
+            return "update " + self._table_name + " set " + terms + " " + self._where_clause(keys)
 
-        q = "update " + self._table_name + " set " + str(terms) + " " + wc[0]
+        q = self._get_statement(("update", set_keys, keys), compile_update)
 
-        result = self._run_q(q, set_args, fetch=False)
-        return result
+        args = [new_values[k] for k in set_keys]
+        args.extend(self._template_args(template, keys))
+        return q, args
 
 
-    def update_by_key(self, key_fields, new_values):
+    def update_by_key(self, key_fields, new_values, cnx=None):
 
-        tmp = dict(zip(self._key_columns, key_fields))
-        return self.update_by_template(tmp, new_values)
+        tmp = dict(zip(self._get_primary_key_columns(), key_fields))
+        return self.update_by_template(tmp, new_values, cnx=cnx)
 
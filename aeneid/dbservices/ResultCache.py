@@ -0,0 +1,276 @@
+import threading
+import time
+import pickle
+import hashlib
+from collections import OrderedDict
+
+
+def _estimate_size(value):
+    """
+
+    Cheap estimate of the memory used by a cached result (a row, a list of rows, or bytes). This is not
+    exact. It only needs to be good enough to keep the cache near its memory cap.
+
+    :param value: The cached value.
+    :return: Approximate size in bytes.
+    """
+    if value is None:
+        return 16
+    if isinstance(value, (bytes, str)):
+        return 48 + len(value)
+    if isinstance(value, dict):
+        return 64 + sum(48 + len(str(k)) + len(str(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return 64 + sum(_estimate_size(v) for v in value)
+
+    return 48 + len(str(value))
+
+
+def make_key(table_name, *parts):
+    """
+
+    :param table_name: schema.table the result came from.
+    :param parts: The rest of the key, e.g. template, field list, order_by, limit, offset.
+    :return: A hashable key. Templates (dictionaries) are converted to sorted tuples.
+    """
+    result = [table_name]
+    for p in parts:
+        if isinstance(p, dict):
+            p = tuple(sorted((k, str(v)) for k, v in p.items()))
+        elif isinstance(p, list):
+            p = tuple(p)
+        result.append(p)
+
+    return tuple(result)
+
+
+class InMemoryCacheBackend:
+    """
+    A shared backend that lives in this process. It has the same interface as a networked backend
+    (get/set/delete for values, get_counter/incr for counters, all with string keys), so it can stand in
+    for one in tests.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}                 # key -> (expires at, value)
+
+    def get(self, key):
+        with self._lock:
+            e = self._data.get(key, None)
+            if e is None:
+                return None
+            if e[0] is not None and e[0] < time.monotonic():
+                del self._data[key]
+                return None
+            return e[1]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            expires = (time.monotonic() + ttl) if ttl else None
+            self._data[key] = (expires, value)
+
+    def get_counter(self, key):
+        return int(self.get(key) or 0)
+
+    def incr(self, key):
+        with self._lock:
+            e = self._data.get(key, (None, 0))
+            v = int(e[1]) + 1
+            self._data[key] = (e[0], v)
+            return v
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class RedisCacheBackend:
+    """
+    Adapter for a redis-py style client (get, set with ex=, incr, delete). The client is passed in, so
+    redis is only needed by deployments that use it.
+    """
+
+    def __init__(self, client, prefix="aeneid:"):
+        self._client = client
+        self._prefix = prefix
+
+    def get(self, key):
+        v = self._client.get(self._prefix + key)
+        return pickle.loads(v) if v is not None else None
+
+    def set(self, key, value, ttl=None):
+        self._client.set(self._prefix + key, pickle.dumps(value), ex=int(ttl) if ttl else None)
+
+    def get_counter(self, key):
+        v = self._client.get(self._prefix + key)
+        return int(v) if v is not None else 0
+
+    def incr(self, key):
+        return self._client.incr(self._prefix + key)
+
+    def delete(self, key):
+        self._client.delete(self._prefix + key)
+
+
+class ResultCache:
+    """
+    Read-through cache for query results. By default entries live in a local LRU with a TTL and a memory cap.
+    If a shared backend is given, entries and per table versions are kept there instead, so that every
+    worker sees the invalidations made by the others.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024, ttl=60.0, backend=None):
+        """
+
+        :param max_entries: Maximum number of entries in the local cache.
+        :param max_bytes: Approximate memory cap for the local cache.
+        :param ttl: Seconds before an entry expires.
+        :param backend: Optional shared backend, e.g. InMemoryCacheBackend or RedisCacheBackend.
+        """
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._backend = backend
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (expires at, size, value)
+        self._table_keys = {}           # table name -> set of keys, for per table invalidation.
+        self._bytes = 0
+        self._generations = {}          # table name (None for everything) -> number of invalidations
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def generation(self, table_name):
+        """
+
+        Get the table's current generation. Every invalidation changes it. Pass it to put() so that a result
+        read before a concurrent write is not cached after the write invalidated the table.
+
+        :param table_name: schema.table
+        :return: An opaque value.
+        """
+        if self._backend is not None:
+            # The "v:*" counter is bumped when everything is invalidated.
+            return str(self._backend.get_counter("v:*")) + "." + str(self._backend.get_counter("v:" + table_name))
+
+        with self._lock:
+            return self._generations.get(table_name, 0), self._generations.get(None, 0)
+
+    def _backend_key(self, key, version=None):
+        # Every key embeds the table's current version. Bumping the version on a write makes all older
+        # entries unreachable and they age out of the backend through their TTL.
+        table_name = key[0]
+        if version is None:
+            version = self.generation(table_name)
+        digest = hashlib.sha1(repr(key[1:]).encode("utf-8")).hexdigest()
+        return "r:" + table_name + ":" + version + ":" + digest
+
+    def _remove(self, key):
+        e = self._entries.pop(key, None)
+        if e is not None:
+            self._bytes -= e[1]
+            keys = self._table_keys.get(key[0], None)
+            if keys is not None:
+                keys.discard(key)
+
+    def get(self, key):
+        """
+
+        :param key: A key from make_key().
+        :return: (True, value) on a hit, (False, None) on a miss.
+        """
+        if self._backend is not None:
+            e = self._backend.get(self._backend_key(key))
+            with self._lock:
+                if e is None:
+                    self.misses += 1
+                    return False, None
+                self.hits += 1
+            return True, e[0]
+
+        with self._lock:
+            e = self._entries.get(key, None)
+            if e is None or e[0] < time.monotonic():
+                if e is not None:
+                    self._remove(key)
+                self.misses += 1
+                return False, None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, e[2]
+
+    def put(self, key, value, generation=None):
+        """
+
+        :param key: A key from make_key().
+        :param value: The result to cache.
+        :param generation: The value of generation() from before the result was read. If the table has been
+            invalidated since, the result is not cached.
+        :return: None
+        """
+        if self._backend is not None:
+            # Wrap the value so that a cached None is distinguishable from a miss.
+            self._backend.set(self._backend_key(key, generation), (value,), self._ttl)
+            return
+
+        size = _estimate_size(value)
+        if size > self._max_bytes:
+            return
+
+        with self._lock:
+            if generation is not None and \
+                    generation != (self._generations.get(key[0], 0), self._generations.get(None, 0)):
+                return
+
+            self._remove(key)
+            self._entries[key] = (time.monotonic() + self._ttl, size, value)
+            self._table_keys.setdefault(key[0], set()).add(key)
+            self._bytes += size
+
+            while len(self._entries) > self._max_entries or self._bytes > self._max_bytes:
+                old_key = next(iter(self._entries))
+                self._remove(old_key)
+                self.evictions += 1
+
+    def invalidate(self, table_name=None):
+        """
+
+        Drop all cached results for a table, or everything.
+
+        :param table_name: schema.table or None
+        :return: None
+        """
+        with self._lock:
+            self.invalidations += 1
+            self._generations[table_name] = self._generations.get(table_name, 0) + 1
+            if table_name is None:
+                self._entries.clear()
+                self._table_keys.clear()
+                self._bytes = 0
+            else:
+                for k in list(self._table_keys.get(table_name, ())):
+                    self._remove(k)
+                self._table_keys.pop(table_name, None)
+
+        if self._backend is not None:
+            self._backend.incr("v:" + (table_name or "*"))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "shared_backend": self._backend is not None,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self._max_entries,
+                "max_bytes": self._max_bytes,
+                "ttl": self._ttl
+            }
@@ -0,0 +1,146 @@
+import json
+import logging
+
+# orjson is optional. It is several times faster than the json module for rows of numbers and strings.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# JSON serialization for responses. The output has the same values as json.dumps(obj, default=str): Decimal,
+# date, datetime, time and bytes become their str() form. orjson writes compact JSON (no spaces after : and ,)
+# so the bytes differ from the json module, but not the document.
+#
+# Values that JSON does not support are converted by per column encoders, chosen once per table from the MySQL
+# column types. Rows of tables that have no such columns are passed to the encoder as they are, so nothing is
+# done per value in Python.
+
+# Set to False to always use the json module.
+use_orjson = True
+
+# MySQL DATA_TYPE -> function converting the pymysql value to a JSON value.
+type_encoders = {
+    "decimal": str,
+    "date": str,
+    "datetime": str,
+    "timestamp": str,
+    "time": str,
+    "year": str,
+    "binary": str,
+    "varbinary": str,
+    "tinyblob": str,
+    "blob": str,
+    "mediumblob": str,
+    "longblob": str,
+    "bit": str
+}
+
+
+def has_orjson():
+    """
+
+    :return: True if responses are encoded with orjson.
+    """
+    return orjson is not None and use_orjson
+
+
+def get_encoders(column_types):
+    """
+
+    :param column_types: Dictionary of column name -> MySQL DATA_TYPE, e.g. TableMetadata.column_types
+    :return: Dictionary of column name -> encoder, for the columns that need one. Empty if none do.
+    """
+    result = {}
+    for c, t in (column_types or {}).items():
+        enc = type_encoders.get(str(t).lower(), None)
+        if enc is not None:
+            result[c] = enc
+
+    return result
+
+
+def encode_rows(rows, encoders):
+    """
+
+    :param rows: List of row dictionaries. These may be shared, e.g. with the result cache, so they are not
+        changed.
+    :param encoders: Dictionary from get_encoders()
+    :return: The rows with the encoded columns converted. The same list if there is nothing to convert.
+    """
+    if not encoders or not rows:
+        return rows
+
+    # Rows may be None, e.g. for keys that were not found by a multi get.
+    first = next((r for r in rows if r is not None), None)
+    if first is None:
+        return rows
+
+    encoders = [(c, f) for c, f in encoders.items() if c in first]
+    if not encoders:
+        return rows
+
+    result = []
+    for r in rows:
+        if r is None:
+            result.append(r)
+            continue
+        r = dict(r)
+        for c, f in encoders:
+            v = r.get(c, None)
+            if v is not None:
+                r[c] = f(v)
+        result.append(r)
+
+    return result
+
+
+def encode(obj, encoders):
+    """
+
+    :param obj: A row, a list of rows, or a document with the rows in "data".
+    :param encoders: Dictionary from get_encoders() for the table the rows come from.
+    :return: The object with the rows encoded.
+    """
+    if not encoders:
+        return obj
+
+    if isinstance(obj, list):
+        return encode_rows(obj, encoders)
+
+    if isinstance(obj, dict):
+        if isinstance(obj.get("data", None), list):
+            obj = dict(obj)
+            obj["data"] = encode_rows(obj["data"], encoders)
+            return obj
+        return encode_rows([obj], encoders)[0]
+
+    return obj
+
+
+def dumpb(obj, encoders=None):
+    """
+
+    :param obj: Object to serialize.
+    :param encoders: Optional column encoders, see encode().
+    :return: The JSON document as UTF-8 bytes.
+    """
+    obj = encode(obj, encoders)
+
+    if has_orjson():
+        try:
+            # Datetimes go to default=str too, so they look the same as with the json module.
+            return orjson.dumps(obj, default=str, option=orjson.OPT_PASSTHROUGH_DATETIME)
+        except TypeError:
+            # E.g. integers larger than 64 bits or non string keys.
+            logging.debug("Serializer.dumpb: falling back to json", exc_info=True)
+
+    return json.dumps(obj, default=str).encode("utf-8")
+
+
+def dumps(obj, encoders=None):
+    """
+
+    :return: dumpb() as a string.
+    """
+    return dumpb(obj, encoders).decode("utf-8")
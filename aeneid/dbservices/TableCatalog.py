@@ -0,0 +1,331 @@
+import threading
+import time
+import logging
+
+import aeneid.dbservices.ConnectionPool as ConnectionPool
+
+
+# Seconds that metadata for a schema is considered fresh. Use invalidate() after DDL changes.
+default_ttl = 300.0
+
+# One query per schema loads columns, primary keys and foreign keys for every table in the schema.
+# Two more small queries load the indexes and row estimates.
+# A column appears once per key constraint it participates in, and once (with NULL key columns)
+# if it is in no constraint.
+_schema_q = """
+    SELECT
+      c.TABLE_NAME,
+      c.COLUMN_NAME,
+      c.ORDINAL_POSITION,
+      c.DATA_TYPE,
+      c.COLUMN_TYPE,
+      c.IS_NULLABLE,
+      k.CONSTRAINT_NAME,
+      k.ORDINAL_POSITION AS KEY_POSITION,
+      k.REFERENCED_TABLE_SCHEMA,
+      k.REFERENCED_TABLE_NAME,
+      k.REFERENCED_COLUMN_NAME
+    FROM
+      INFORMATION_SCHEMA.COLUMNS c
+      LEFT JOIN INFORMATION_SCHEMA.KEY_COLUMN_USAGE k
+        ON k.TABLE_SCHEMA = c.TABLE_SCHEMA AND k.TABLE_NAME = c.TABLE_NAME
+          AND k.COLUMN_NAME = c.COLUMN_NAME
+    WHERE
+      c.TABLE_SCHEMA = %s
+    ORDER BY
+      c.TABLE_NAME, c.ORDINAL_POSITION
+"""
+
+
+# Indexes, by index and column order, and row estimates for every table in the schema.
+_index_q = """
+    SELECT TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX, COLUMN_NAME
+    FROM INFORMATION_SCHEMA.STATISTICS
+    WHERE TABLE_SCHEMA = %s
+    ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX
+"""
+
+_rows_q = """
+    SELECT TABLE_NAME, TABLE_ROWS
+    FROM INFORMATION_SCHEMA.TABLES
+    WHERE TABLE_SCHEMA = %s
+"""
+
+
+class TableMetadata:
+    """
+    Columns, primary key and foreign keys for one table.
+    """
+
+    def __init__(self, schema, table_name):
+        self.schema = schema
+        self.table_name = table_name
+        self.columns = []               # Column names in ordinal order.
+        self.column_types = {}          # Column name -> MySQL DATA_TYPE, e.g. 'varchar', 'int'
+        self.primary_key = []           # Primary key columns, in key order.
+
+        # Constraint name -> {"referenced_table": "schema.table", "map": [[column, referenced_column], ...]}
+        self.foreign_keys = {}
+
+        self.indexes = {}               # Index name -> columns, in index order.
+        self.row_estimate = None        # TABLE_ROWS when the metadata was loaded. Approximate for InnoDB.
+
+    def is_indexed(self, column):
+        """
+
+        :param column: Column name.
+        :return: True if the column is the first column of an index, so that equality and range filters on it
+            can use the index.
+        """
+        for columns in self.indexes.values():
+            if columns and columns[0] == column:
+                return True
+        return False
+
+    def full_name(self):
+        return self.schema + "." + self.table_name
+
+    def to_json(self):
+        return {
+            "table_name": self.full_name(),
+            "columns": self.columns,
+            "column_types": self.column_types,
+            "primary_key": self.primary_key,
+            "foreign_keys": self.foreign_keys,
+            "indexes": self.indexes,
+            "row_estimate": self.row_estimate
+        }
+
+
+def split_table_name(table_name, default_schema=None):
+    """
+
+    :param table_name: A name of the form schema.table or table.
+    :param default_schema: Schema to use if the name does not have one.
+    :return: (schema, table)
+    """
+    if "." in table_name:
+        schema, table = table_name.split(".", 1)
+    else:
+        schema, table = default_schema, table_name
+
+    return schema, table
+
+
+class TableCatalog:
+    """
+    Caches table metadata from INFORMATION_SCHEMA. Metadata is loaded for a whole schema at a time,
+    with one query, and reloaded after ttl seconds or an explicit invalidate().
+    """
+
+    def __init__(self, pool, default_schema=None, ttl=None):
+        """
+
+        :param pool: ConnectionPool used to run the metadata queries.
+        :param default_schema: Schema for table names that do not have a schema prefix.
+        :param ttl: Seconds before a schema's metadata is reloaded. Defaults to default_ttl.
+        """
+        self._pool = pool
+        self._default_schema = default_schema
+        self._ttl = default_ttl if ttl is None else ttl
+
+        self._lock = threading.RLock()
+        self._schemas = {}              # schema -> (load time, {table name: TableMetadata})
+        self._schema_locks = {}         # schema -> lock held while loading the schema
+        self._loads = 0
+
+    def _load_schema(self, schema):
+
+        with self._pool.connection() as cnx:
+            cursor = cnx.cursor()
+            cursor.execute(_schema_q, (schema,))
+            rows = cursor.fetchall()
+            cursor.execute(_index_q, (schema,))
+            index_rows = cursor.fetchall()
+            cursor.execute(_rows_q, (schema,))
+            count_rows = cursor.fetchall()
+
+        tables = {}
+        key_positions = {}              # (table, column) -> position in the primary key
+
+        for r in rows:
+            t_name = r['TABLE_NAME']
+            md = tables.get(t_name, None)
+            if md is None:
+                md = TableMetadata(schema, t_name)
+                tables[t_name] = md
+
+            c_name = r['COLUMN_NAME']
+            if c_name not in md.column_types:
+                md.columns.append(c_name)
+                md.column_types[c_name] = r['DATA_TYPE']
+
+            constraint = r['CONSTRAINT_NAME']
+            if constraint is None:
+                continue
+
+            if constraint == 'PRIMARY':
+                md.primary_key.append(c_name)
+                key_positions[(t_name, c_name)] = r['KEY_POSITION']
+            elif r['REFERENCED_TABLE_NAME'] is not None:
+                fk = md.foreign_keys.get(constraint, None)
+                if fk is None:
+                    fk = {
+                        "referenced_table": r['REFERENCED_TABLE_SCHEMA'] + "." + r['REFERENCED_TABLE_NAME'],
+                        "map": []
+                    }
+                    md.foreign_keys[constraint] = fk
+                fk["map"].append([c_name, r['REFERENCED_COLUMN_NAME']])
+
+        # Rows arrive in column order. Put the primary key columns into key order.
+        for t_name, md in tables.items():
+            md.primary_key.sort(key=lambda c: key_positions[(t_name, c)])
+
+        for r in index_rows:
+            md = tables.get(r['TABLE_NAME'], None)
+            if md is not None:
+                md.indexes.setdefault(r['INDEX_NAME'], []).append(r['COLUMN_NAME'])
+
+        for r in count_rows:
+            md = tables.get(r['TABLE_NAME'], None)
+            if md is not None and r['TABLE_ROWS'] is not None:
+                md.row_estimate = int(r['TABLE_ROWS'])
+
+        with self._lock:
+            self._loads += 1
+        logging.debug("TableCatalog: loaded %d tables for schema %s", len(tables), schema)
+
+        return tables
+
+    def _is_fresh(self, entry, margin=0.0):
+        # At most half the ttl, so that a short ttl does not make every call a reload.
+        margin = min(margin, self._ttl / 2)
+        return entry is not None and (time.monotonic() - entry[0]) <= self._ttl - margin
+
+    def _get_schema(self, schema, margin=0.0):
+
+        entry = self._schemas.get(schema, None)
+        if self._is_fresh(entry, margin):
+            return entry[1]
+
+        # One loader per schema. Other threads asking for the same schema wait for it, while
+        # different schemas can load in parallel.
+        with self._lock:
+            schema_lock = self._schema_locks.setdefault(schema, threading.Lock())
+
+        with schema_lock:
+            entry = self._schemas.get(schema, None)
+            if not self._is_fresh(entry, margin):
+                entry = (time.monotonic(), self._load_schema(schema))
+                with self._lock:
+                    if entry[1]:
+                        self._schemas[schema] = entry
+                    else:
+                        # A schema with no tables, e.g. a misspelled name in a URL, is not cached.
+                        self._schema_locks.pop(schema, None)
+
+        return entry[1]
+
+    def get_table(self, table_name, margin=0.0):
+        """
+
+        :param table_name: Table name of the form schema.table or table.
+        :param margin: Reload the metadata if it expires within this many seconds.
+        :return: TableMetadata or None if the table does not exist.
+        """
+        schema, table = split_table_name(table_name, self._default_schema)
+        return self._get_schema(schema, margin).get(table, None)
+
+    def is_fresh(self, table_name, margin=0.0):
+        """
+
+        :param table_name: Table name of the form schema.table or table.
+        :param margin: Seconds the metadata must stay fresh for.
+        :return: True if get_table() would not load the table's schema within the next margin seconds.
+        """
+        schema, table = split_table_name(table_name, self._default_schema)
+        return self._is_fresh(self._schemas.get(schema, None), margin)
+
+    def get_primary_key(self, table_name):
+        md = self.get_table(table_name)
+        return list(md.primary_key) if md is not None else None
+
+    def get_columns(self, table_name):
+        md = self.get_table(table_name)
+        return list(md.columns) if md is not None else None
+
+    def get_join_columns(self, source_table, destination_table):
+        """
+
+        :param source_table: Table to navigate from, schema.table
+        :param destination_table: Table to navigate to, schema.table
+        :return: List of constraints of the form [[source column, destination column], ...]. The
+            foreign key may be declared in either table.
+        """
+        result = []
+
+        src = self.get_table(source_table)
+        dst = self.get_table(destination_table)
+        if src is None or dst is None:
+            return result
+
+        for fk in src.foreign_keys.values():
+            if fk["referenced_table"] == dst.full_name():
+                result.append([list(m) for m in fk["map"]])
+
+        if src.full_name() != dst.full_name():
+            for fk in dst.foreign_keys.values():
+                if fk["referenced_table"] == src.full_name():
+                    result.append([[m[1], m[0]] for m in fk["map"]])
+
+        return result
+
+    def invalidate(self, table_name=None):
+        """
+
+        Drop cached metadata. Metadata is loaded per schema, so invalidating a table reloads its schema.
+
+        :param table_name: A table name (schema.table), a schema name or None for everything.
+        :return: None
+        """
+        with self._lock:
+            if table_name is None:
+                self._schemas = {}
+            else:
+                schema, table = split_table_name(table_name, self._default_schema)
+                if "." not in table_name and table_name in self._schemas:
+                    schema = table_name
+                self._schemas.pop(schema, None)
+
+    def stats(self):
+        with self._lock:
+            return {"schemas": list(self._schemas.keys()), "loads": self._loads, "ttl": self._ttl}
+
+
+# Process wide catalogs, one per distinct set of connect information.
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(connect_info):
+    """
+
+    :param connect_info: Dictionary of parameters necessary to connect to the DB.
+    :return: The shared TableCatalog for the connect information.
+    """
+    k = ConnectionPool._pool_key(connect_info)
+    with _catalogs_lock:
+        result = _catalogs.get(k, None)
+        if result is None:
+            result = TableCatalog(ConnectionPool.get_pool(connect_info), connect_info.get('db', None))
+            _catalogs[k] = result
+
+    return result
+
+
+def invalidate_all(table_name=None):
+    with _catalogs_lock:
+        catalogs = list(_catalogs.values())
+
+    for c in catalogs:
+        c.invalidate(table_name)
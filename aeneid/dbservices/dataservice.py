@@ -1,12 +1,27 @@
 #Xinquan Wang -- xw2566
 
 
+import time
+_import_start = time.perf_counter()
+
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
 import pymysql.cursors
 import json
+import base64
 import aeneid.utils.utils as ut
 import aeneid.utils.dffutils as db
 import aeneid.dbservices.DataExceptions
+from aeneid.dbservices.DataExceptions import DataException
 from aeneid.dbservices.RDBDataTable import RDBDataTable
+import aeneid.dbservices.AsyncRDBDataTable as AsyncRDBDataTable
+import aeneid.dbservices.ConnectionPool as ConnectionPool
+import aeneid.dbservices.TableCatalog as TableCatalog
+import aeneid.dbservices.ResultCache as ResultCache
+import aeneid.dbservices.Metrics as Metrics
+import aeneid.dbservices.Filters as Filters
+import aeneid.dbservices.Serializer as Serializer
 
 db_schema = None                                # Schema containing accessed data
 cnx = None                                      # DB connection to use for accessing the data.
@@ -14,83 +29,1016 @@ key_delimiter = '_'                             # This should probably be a conf
 
 # Is a dictionary of {table_name : [primary_key_field_1, primary_key_field_2, ...]
 # Used to convert a list of column values into a template of the form { col: value }
+# Filled in from the table catalog by get_primary_key_columns().
 primary_keys = {}
 
 # This dictionary contains columns mappings for nevigating from a source table to a destination table.
 # The keys is of the form sourcename_destinationname. The entry is a list of the form
 # [[sourcecolumn1, destinationcolumn1], ...
+# Filled in from the foreign keys in the table catalog by get_join_columns().
 join_columns = {}
 
+# JSON encoders for the columns of each table that pymysql returns as Decimal, datetime, bytes, etc.
+# {table_name: {column: encoder}}. Filled in from the table catalog by get_encoders().
+encoders = {}
+
 # Data structure contains RI constraints. The format is a dictionary with an entry for each schema.
 # Within the schema entry, there is a dictionary containing the constraint name, source and target tables
 # and key mappings.
 ri_constraints = None
 
+# Table handles are created on first use by get_data_table(), so importing this module does not touch the DB.
 data_tables = {}
+_data_tables_lock = threading.Lock()
 
+# AsyncRDBDataTable handles for the async request path, created on first use by get_async_data_table(). Each one
+# compiles its SQL with the table handle in data_tables.
+async_data_tables = {}
 
 # TODO This is a bit of a hack and we should clean up.
 # We should load information from database or configuration file.
-people = RDBDataTable("HW1.people", key_columns=['playerID'])
-data_tables["HW1.people"] = people
-batting = RDBDataTable("HW1.batting", key_columns=['playerID', 'yearID', 'teamID', 'stint'])
-data_tables["HW1.batting"] = batting
-appearances = RDBDataTable("HW1.appearances", key_columns=['playerID', 'yearID', 'teamID'])
-data_tables["HW1.appearances"] = appearances
-offices = RDBDataTable("HW1.offices", key_columns=['officeCode'])
-data_tables["Hw1.offices"] = offices
-fantasy_manager = RDBDataTable("HW1.fantasy_manager", key_columns=['id'])
-data_tables["Hw1.fantasy_manager"] = fantasy_manager
+# Tables that have hard coded key columns. Any other table gets its key from the table catalog.
+table_definitions = {
+    "HW1.people": ['playerID'],
+    "HW1.batting": ['playerID', 'yearID', 'teamID', 'stint'],
+    "HW1.appearances": ['playerID', 'yearID', 'teamID'],
+    "HW1.offices": ['officeCode'],
+    "HW1.fantasy_manager": ['id']
+}
+
+# Columns to return when a request does not have a fields= parameter, e.g. to keep wide tables like batting from
+# sending every column by default. Tables not listed return all columns.
+default_fields = {}
+
+# Bytes of JSON produced per table, recorded by the web layer. Used with RDBDataTable.collect_io_stats to compare
+# the data read and sent with and without projections.
+response_bytes = {}
+
+# What to do with a template that filters a large table only on columns without an index, which means a full
+# table scan: "warn" logs it and returns the columns from check_filters(), "reject" raises a data_error, "off"
+# does not check. A table is large if its row estimate is at least large_table_rows.
+filter_policy = "warn"
+large_table_rows = 100000
+
+# Operations allowed in a batch(). Each is a dictionary of the form
+#   {"op": "create", "resource": "people", "data": {...}}
+#   {"op": "update", "resource": "people", "key": "willite01", "data": {...}}
+#   {"op": "delete", "resource": "batting", "template": {"playerID": "willite01"}}
+# update and delete take a key (a list, or a string with key_delimiter between the values) or a template.
+batch_operations = ["create", "update", "delete"]
+
+# Read-through cache for GET results. Writes through this module invalidate the table's entries.
+result_cache = ResultCache.ResultCache()
+
+# Timings (seconds) for startup. import_time is the time to import this module. warm_up_time is filled in when
+# warm_up() completes.
+startup_stats = {
+    "import_time": None,
+    "warm_up_time": None,
+    "warm_up_errors": []
+}
 
 
 def get_data_table(table_name):
 
     result = data_tables.get(table_name, None)
     if result is None:
-        result = RDBDataTable(table_name)
-        data_tables[table_name] = result
+        # Table names come from URLs. Only tables in the catalog get a handle, so that requests for tables that
+        # do not exist do not fill data_tables.
+        catalog = TableCatalog.get_catalog(RDBDataTable._default_connect_info)
+        if catalog.get_table(table_name) is None:
+            raise DataException(DataException.no_such_resource, "dataservice: no such table " + table_name)
+
+        with _data_tables_lock:
+            result = data_tables.get(table_name, None)
+            if result is None:
+                result = RDBDataTable(table_name, key_columns=table_definitions.get(table_name, None),
+                                      default_fields=default_fields.get(table_name, None))
+                data_tables[table_name] = result
+
+    return result
+
+
+def get_async_data_table(table_name):
+
+    result = async_data_tables.get(table_name, None)
+    if result is None:
+        dt = get_data_table(table_name)
+        with _data_tables_lock:
+            result = async_data_tables.get(table_name, None)
+            if result is None:
+                result = AsyncRDBDataTable.AsyncRDBDataTable(table_name, data_table=dt)
+                async_data_tables[table_name] = result
+
+    return result
+
+
+async def warm_up_async(table_name):
+    """
+
+    get_async_data_table() for coroutines. The catalog lookup for a new handle and the table metadata load run in
+    the threadpool, not on the event loop.
+
+    :param table_name: schema.table
+    :return: The AsyncRDBDataTable for the table, with its metadata loaded.
+    """
+    result = async_data_tables.get(table_name, None)
+    if result is None:
+        result = await AsyncRDBDataTable.run_sync(get_async_data_table, table_name)
+
+    await result.warm_up()
+    return result
+
+
+def warm_up(table_names=None, background=True, max_workers=4):
+    """
+
+    Preload table handles, catalog metadata and pool connections in parallel, so that the first requests
+    do not pay for them. Errors are logged and recorded in startup_stats; they do not stop the app.
+
+    :param table_names: List of schema.table names. Defaults to the tables in table_definitions.
+    :param background: If True, return immediately and warm up on a background thread.
+    :param max_workers: Number of tables to warm up in parallel.
+    :return: The background thread if background is True, otherwise None.
+    """
+    if table_names is None:
+        table_names = list(table_definitions.keys())
+
+    def do_warm_up():
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(lambda tn: get_data_table(tn).warm_up(), t): t for t in table_names}
+            for f in futures:
+                try:
+                    f.result()
+                except Exception as e:
+                    logging.error("dataservice.warm_up: failed for " + futures[f], exc_info=True)
+                    startup_stats["warm_up_errors"].append(futures[f] + ": " + str(e))
+
+        startup_stats["warm_up_time"] = time.perf_counter() - start
+        ut.debug_message("dataservice.warm_up: startup_stats = ", startup_stats)
+
+    if background:
+        t = threading.Thread(target=do_warm_up, name="dataservice-warm-up", daemon=True)
+        t.start()
+        return t
+    else:
+        do_warm_up()
+        return None
+
+
+def set_default_fields(table_name, fields):
+    """
+
+    :param table_name: schema.table
+    :param fields: Columns to return when a request does not list fields, or None for all columns.
+    :return: None
+    """
+    default_fields[table_name] = fields
+    get_data_table(table_name).set_default_fields(fields)
+    invalidate_cache(table_name)
+
+
+def record_response_size(table_name, n):
+    e = response_bytes.setdefault(table_name, {"responses": 0, "bytes": 0})
+    e["responses"] += 1
+    e["bytes"] += n
+
+
+def get_table_stats():
+    """
+
+    :return: For each table in use, rows and bytes read (if RDBDataTable.collect_io_stats is on) and bytes of
+        JSON sent.
+    """
+    result = {}
+    for t_name, dt in list(data_tables.items()):
+        result[t_name] = dt.get_io_stats()
+        result[t_name]["default_fields"] = default_fields.get(t_name, None)
+        result[t_name]["serialized"] = response_bytes.get(t_name, {"responses": 0, "bytes": 0})
+
+    return result
+
+
+def get_startup_stats():
+    return dict(startup_stats)
+
+
+def get_primary_key_columns(table_name):
+    """
+
+    :param table_name: schema.table
+    :return: List of the primary key columns. Uses the key_columns the table was created with, if any,
+        otherwise the table catalog.
+    """
+    dt = get_data_table(table_name)
+    result = dt.get_key_columns()
+    primary_keys[table_name] = result
+    return result
+
+
+def get_join_columns(source_table, destination_table):
+    """
+
+    :param source_table: schema.table to navigate from.
+    :param destination_table: schema.table to navigate to.
+    :return: List of the form [[sourcecolumn1, destinationcolumn1], ...] or None if the tables are not related.
+        If there is more than one foreign key between the tables, the first one is used. The mapping is
+        resolved once per table pair and kept in join_columns until invalidate_metadata().
+    """
+    k = source_table + "_" + destination_table
+    if k in join_columns:
+        return join_columns[k]
+
+    dt = get_data_table(source_table)
+    get_data_table(destination_table)
+    mappings = dt.get_join_columns(destination_table)
+
+    if mappings:
+        result = mappings[0]
+    else:
+        result = None
+
+    join_columns[k] = result
+    return result
+
+
+def get_encoders(table_name):
+    """
+
+    :param table_name: schema.table
+    :return: Serializer encoders for the columns of the table that need one. See Serializer.get_encoders().
+    """
+    result = encoders.get(table_name, None)
+    if result is None:
+        md = get_data_table(table_name).get_metadata()
+        result = Serializer.get_encoders(md.column_types if md is not None else None)
+        encoders[table_name] = result
 
     return result
 
 
+def invalidate_metadata(table_name=None):
+    """
+
+    Drop cached table metadata, e.g. after a schema change.
+
+    :param table_name: schema.table, or None to drop everything.
+    :return: None
+    """
+    TableCatalog.invalidate_all(table_name)
+
+    # Compiled statements contain the column lists from the old metadata.
+    for t_name, dt in list(data_tables.items()):
+        if table_name is None or t_name == table_name or t_name.split(".")[0] == table_name:
+            dt.clear_statement_cache()
+
+    if table_name is None:
+        primary_keys.clear()
+        join_columns.clear()
+        encoders.clear()
+    else:
+        primary_keys.pop(table_name, None)
+        encoders.pop(table_name, None)
+        for k in [k for k in join_columns.keys() if k.startswith(table_name + "_") or
+                  k.endswith("_" + table_name)]:
+            del join_columns[k]
+
+
+def get_pool_stats():
+    """
+
+    :return: Usage and wait statistics for every connection pool used by the data tables. Pools used by the
+        async request path are under "async".
+    """
+    result = ConnectionPool.get_all_stats()
+    async_stats = AsyncRDBDataTable.get_pool_stats()
+    if async_stats:
+        result["async"] = async_stats
+    return result
+
+
+def get_cache_stats():
+    """
+
+    :return: Hit, miss and eviction counters for the result cache.
+    """
+    return result_cache.stats()
+
+
+def get_slow_queries():
+    """
+
+    :return: The most recent queries slower than Metrics.slow_query_ms, with normalized SQL.
+    """
+    return Metrics.get_slow_queries()
+
+
+def get_metrics():
+    """
+
+    :return: Latency histograms, slow query counts, and pool and cache statistics in the Prometheus text format.
+    """
+    pool_stats = get_pool_stats()
+    cache_stats = result_cache.stats()
+
+    gauges = []
+    async_stats = pool_stats.pop("async", {})
+    for name in ("in_use", "idle", "checkouts", "timeouts"):
+        gauges.append(("aeneid_pool_" + name, "Connection pool " + name + ".",
+                       [({"pool": k}, v[name]) for k, v in pool_stats.items()]))
+    for name in ("size", "free"):
+        gauges.append(("aeneid_async_pool_" + name, "Async connection pool " + name + ".",
+                       [({"pool": k}, v[name]) for k, v in async_stats.items()]))
+    for name in ("hits", "misses", "evictions", "invalidations", "entries", "bytes"):
+        gauges.append(("aeneid_cache_" + name, "Result cache " + name + ".", [({}, cache_stats[name])]))
+
+    return Metrics.to_prometheus(gauges)
+
+
+def set_result_cache(cache):
+    """
+
+    Replace the result cache, e.g. with one using a shared backend for multi-worker deployments.
+
+    :param cache: A ResultCache, or None to turn caching off.
+    :return: None
+    """
+    global result_cache
+    result_cache = cache if cache is not None else ResultCache.ResultCache(max_entries=0, max_bytes=0)
+
+
+def invalidate_cache(table_name=None):
+    """
+
+    Drop cached results for a table. Called by every write in this module.
+
+    :param table_name: schema.table, or None for everything.
+    :return: None
+    """
+    result_cache.invalidate(table_name)
+
+
+def get_table_version(table_name):
+    """
+
+    :param table_name: schema.table
+    :return: An opaque version for the table. It changes on every write through this module.
+    """
+    return result_cache.generation(table_name)
+
+
+def get_etag(table_name, request_key):
+    """
+
+    :param table_name: schema.table
+    :param request_key: Identifies the response, e.g. the request path and query string.
+    :return: The ETag of the response last produced for the request, if the table has not changed since.
+    """
+    hit, result = result_cache.get(ResultCache.make_key(table_name, "etag", request_key))
+    return result
+
+
+def put_etag(table_name, request_key, etag, version):
+    """
+
+    Remember the ETag produced for a request, so that a matching If-None-Match can be answered without
+    running the query or serializing the result.
+
+    :param table_name: schema.table
+    :param request_key: Identifies the response, e.g. the request path and query string.
+    :param etag: The ETag of the response.
+    :param version: The value of get_table_version() from before the response was computed.
+    :return: None
+    """
+    result_cache.put(ResultCache.make_key(table_name, "etag", request_key), etag, version)
+
+
+def get_compressed(table_name, etag, encoding):
+    """
+
+    :param table_name: schema.table
+    :param etag: ETag of the uncompressed body.
+    :param encoding: Content-Encoding, e.g. gzip.
+    :return: The compressed body stored by put_compressed(), or None.
+    """
+    hit, result = result_cache.get(ResultCache.make_key(table_name, "compressed", etag, encoding))
+    return result
+
+
+def put_compressed(table_name, etag, encoding, data, version):
+    """
+
+    Store a compressed response body next to the table's cached results, so that a hot response is compressed
+    once. The ETag identifies the body, and the entry is dropped with the table's other entries on a write.
+
+    :param table_name: schema.table
+    :param etag: ETag of the uncompressed body.
+    :param encoding: Content-Encoding of data.
+    :param data: The compressed body.
+    :param version: The value of get_table_version() from before the body was computed.
+    :return: None
+    """
+    result_cache.put(ResultCache.make_key(table_name, "compressed", etag, encoding), data, version)
+
+
 def get_by_template(table_name, template, field_list=None, limit=None, offset=None, order_by=None, commit=True):
 
+    k = ResultCache.make_key(table_name, "template", template, field_list, order_by, limit, offset)
+    hit, result = result_cache.get(k)
+    if hit:
+        return result
+
+    generation = result_cache.generation(table_name)
     dt = get_data_table(table_name)
-    result = dt.find_by_template(template, field_list, limit, offset, order_by, commit)
-    return result.get_rows()
+    result = dt.find_by_template(template, field_list, limit, offset, order_by, commit=commit)
+    result = result.get_rows()
+
+    result_cache.put(k, result, generation)
+    return result
+
+
+def stream_by_template(table_name, template, field_list=None, limit=None, offset=None, order_by=None):
+    """
+
+    :return: A generator over the matching rows. Streams are not cached; they are meant for results too large
+        to hold in memory.
+    """
+    dt = get_data_table(table_name)
+    return dt.stream_by_template(template, field_list, limit, offset, order_by)
 
 
 def get_by_primary_key(table_name, key_fields, field_list=None, commit=True):
 
+    k = ResultCache.make_key(table_name, "key", key_fields, field_list)
+    hit, result = result_cache.get(k)
+    if hit:
+        return result
+
+    generation = result_cache.generation(table_name)
     dt = get_data_table(table_name)
     result = dt.find_by_primary_key(key_fields, field_list)
+
+    result_cache.put(k, result, generation)
+    return result
+
+
+async def get_by_template_async(table_name, template, field_list=None, limit=None, offset=None, order_by=None):
+    """
+
+    get_by_template() for the async request path. Uses the same result cache.
+    """
+    k = ResultCache.make_key(table_name, "template", template, field_list, order_by, limit, offset)
+    hit, result = result_cache.get(k)
+    if hit:
+        return result
+
+    generation = result_cache.generation(table_name)
+    dt = await warm_up_async(table_name)
+    result = await dt.find_by_template(template, field_list, limit, offset, order_by)
+    result = result.get_rows()
+
+    result_cache.put(k, result, generation)
+    return result
+
+
+async def get_by_primary_key_async(table_name, key_fields, field_list=None):
+    """
+
+    get_by_primary_key() for the async request path. Uses the same result cache.
+    """
+    k = ResultCache.make_key(table_name, "key", key_fields, field_list)
+    hit, result = result_cache.get(k)
+    if hit:
+        return result
+
+    generation = result_cache.generation(table_name)
+    dt = await warm_up_async(table_name)
+    result = await dt.find_by_primary_key(key_fields, field_list)
+
+    result_cache.put(k, result, generation)
+    return result
+
+
+def get_related(table_name, key_fields, related_table, template=None, field_list=None, limit=None,
+                offset=None, order_by=None):
+    """
+
+    Navigate from one row of a table to the rows of a related table, using the foreign key between them.
+
+    :param table_name: schema.table of the source row.
+    :param key_fields: Primary key values of the source row.
+    :param related_table: schema.table to navigate to.
+    :param template: Additional template on the related table.
+    :return: List of the related rows.
+    """
+    join_map = get_join_columns(table_name, related_table)
+    if join_map is None:
+        raise DataException(DataException.no_such_resource,
+                            "dataservice: " + related_table + " is not related to " + table_name)
+
+    dt = get_data_table(table_name)
+    related = get_data_table(related_table)
+
+    # If the join columns are in the source key, the result depends only on the related table, and it is cached
+    # and invalidated with that table. A JOIN result also depends on the source row, so it is not cached.
+    key_columns = dt.get_key_columns()
+    cacheable = all(m[0] in key_columns for m in join_map)
+
+    if cacheable:
+        k = ResultCache.make_key(related_table, "related", table_name, key_fields, template, field_list, limit,
+                                 offset, order_by)
+        hit, result = result_cache.get(k)
+        if hit:
+            return result
+        generation = result_cache.generation(related_table)
+
+    result = dt.find_related(key_fields, related, join_map, template, field_list, limit, offset, order_by)
+    result = result.get_rows()
+
+    if cacheable:
+        result_cache.put(k, result, generation)
+
+    return result
+
+
+def get_include_columns(table_name, related_tables):
+    """
+
+    :param table_name: schema.table of the parent rows.
+    :param related_tables: List of schema.table names to include.
+    :return: The parent columns needed to load the related rows, i.e. the join columns.
+    """
+    result = []
+    for related_table in related_tables:
+        join_map = get_join_columns(table_name, related_table)
+        if join_map is None:
+            raise DataException(DataException.no_such_resource,
+                                "dataservice: " + related_table + " is not related to " + table_name)
+        result.extend([m[0] for m in join_map if m[0] not in result])
+
+    return result
+
+
+def get_include_fields(table_name, related_tables, field_list=None):
+    """
+
+    :param table_name: schema.table of the parent rows.
+    :param related_tables: List of schema.table names to include.
+    :param field_list: The requested fields, or None for the table's default fields.
+    :return: (fields to select, the join columns among them that were not requested). The join columns are
+        needed to load the related rows, even if the requested or default fields leave them out.
+    """
+    join_columns = get_include_columns(table_name, related_tables)
+    select_list = get_data_table(table_name).get_select_list(field_list)
+    extra_columns = [c for c in join_columns if c not in select_list]
+
+    if not extra_columns:
+        return field_list, []
+
+    return select_list + extra_columns, extra_columns
+
+
+def include_related(table_name, rows, related_tables, field_list=None, drop_columns=None):
+    """
+
+    Embed the related rows for a page of rows, with one IN query per related table instead of a query per
+    row. Each row gets an entry per related table, named by the table name without the schema, holding the
+    list of related rows.
+
+    :param table_name: schema.table of the rows.
+    :param rows: List of rows. They must contain the join columns (see get_include_columns()).
+    :param related_tables: List of schema.table names to include.
+    :param field_list: Fields to return for the related rows, or None for their defaults.
+    :param drop_columns: Columns to remove from the returned rows, e.g. join columns that were selected only to
+        load the related rows (see get_include_fields()).
+    :return: A new list of rows. The input rows, which may be cached, are not changed.
+    """
+    result = [dict(r) for r in rows]
+
+    for related_table in related_tables:
+        join_map = get_join_columns(table_name, related_table)
+        if join_map is None:
+            raise DataException(DataException.no_such_resource,
+                                "dataservice: " + related_table + " is not related to " + table_name)
+
+        src_columns = [m[0] for m in join_map]
+        dst_columns = [m[1] for m in join_map]
+
+        # Collect the distinct join values on the page, then load all their related rows at once.
+        values = {}
+        for r in rows:
+            v = tuple(r[c] for c in src_columns)
+            if all(x is not None for x in v):
+                values[tuple(str(x) for x in v)] = v
+
+        related = get_data_table(related_table)
+        found = related.find_by_column_values(dst_columns, list(values.values()), field_list) if values else {}
+
+        name = related_table.split(".")[-1]
+        for r in result:
+            r[name] = found.get(tuple(str(r[c]) for c in src_columns), [])
+
+    if drop_columns:
+        for r in result:
+            for c in drop_columns:
+                r.pop(c, None)
+
+    return result
+
+
+def get_related_template(table_name, key_fields, related_table):
+    """
+
+    :param table_name: schema.table of the source row.
+    :param key_fields: Primary key values of the source row.
+    :param related_table: schema.table to navigate to.
+    :return: Template with the related table's foreign key columns set to the source row's values, e.g. to
+        fill in a new related row. None if the source row does not exist.
+    """
+    join_map = get_join_columns(table_name, related_table)
+    if join_map is None:
+        raise DataException(DataException.no_such_resource,
+                            "dataservice: " + related_table + " is not related to " + table_name)
+
+    key_columns = get_primary_key_columns(table_name)
+    key = dict(zip(key_columns, key_fields))
+    if not all(m[0] in key for m in join_map):
+        key = get_by_primary_key(table_name, key_fields, field_list=[m[0] for m in join_map])
+        if key is None:
+            return None
+
+    return {m[1]: key[m[0]] for m in join_map}
+
+
+def check_filters(table_name, template):
+    """
+
+    Check that a template on a large table can use an index. If at least one filter column is indexed, the
+    index narrows the rows and the other filters only look at those.
+
+    :param table_name: schema.table
+    :param template: Query template, possibly with filter operators, e.g. {"yearID[gte]": "2000"}
+    :return: The filter columns, if none of them is indexed and the table is large. Otherwise, an empty list.
+    """
+    if filter_policy == "off" or not template:
+        return []
+
+    dt = get_data_table(table_name)
+    md = dt.get_metadata()
+    if md is None or (md.row_estimate or 0) < large_table_rows:
+        return []
+
+    columns = list(dict.fromkeys(Filters.template_columns(template)))
+    if any(dt.is_indexed(c) for c in columns):
+        return []
+
+    msg = "dataservice: filter on " + table_name + " (about " + str(md.row_estimate) + \
+          " rows) uses no index, columns = " + ",".join(columns)
+    if filter_policy == "reject":
+        raise DataException(DataException.data_error, msg)
+
+    logging.warning(msg)
+    return columns
+
+
+def get_count(table_name, template, mode="exact"):
+    """
+
+    :param table_name: schema.table
+    :param template: Query template.
+    :param mode: "exact" for count(*), "estimate" for the database's estimate.
+    :return: The number of matching rows. Counts are cached per template, not per page, and invalidated by
+        writes to the table, so paging through a result does not count it again.
+    """
+    if mode not in ("exact", "estimate"):
+        raise DataException(DataException.data_error, "dataservice: count must be exact or estimate")
+
+    k = ResultCache.make_key(table_name, "count", mode, template)
+    hit, result = result_cache.get(k)
+    if hit:
+        return result
+
+    generation = result_cache.generation(table_name)
+    dt = get_data_table(table_name)
+    if mode == "exact":
+        result = dt.count_by_template(template)
+    else:
+        result = dt.estimate_count(template)
+
+    result_cache.put(k, result, generation)
+    return result
+
+
+def get_aggregate(table_name, template, group_by=None, aggregates=None, order_by=None, limit=None):
+    """
+
+    :param table_name: schema.table
+    :param template: Query template selecting the rows.
+    :param group_by: List of columns to group on.
+    :param aggregates: List of [function, column], e.g. [["sum", "HR"], ["count", "*"]]
+    :param order_by: A group by column or aggregate name to sort on.
+    :param limit: Maximum number of groups to return.
+    :return: List with one row per group. Results are cached like other reads.
+    """
+    aggregates = [list(a) for a in (aggregates or [["count", "*"]])]
+
+    k = ResultCache.make_key(table_name, "aggregate", template, group_by,
+                             tuple(tuple(a) for a in aggregates), order_by, limit)
+    hit, result = result_cache.get(k)
+    if hit:
+        return result
+
+    generation = result_cache.generation(table_name)
+    dt = get_data_table(table_name)
+    result = dt.aggregate(template, group_by, aggregates, order_by, limit).get_rows()
+
+    result_cache.put(k, result, generation)
+    return result
+
+
+def encode_cursor(values):
+    """
+
+    :param values: Keyset column values of the last row on a page.
+    :return: An opaque, URL safe token for the next page.
+    """
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(token):
+    """
+
+    :param token: A token from encode_cursor()
+    :return: The list of keyset column values.
+    """
+    try:
+        result = json.loads(base64.urlsafe_b64decode(token.encode("ascii")).decode("utf-8"))
+    except Exception as e:
+        raise DataException(DataException.data_error, "dataservice: invalid cursor.", e)
+
+    if not isinstance(result, list):
+        raise DataException(DataException.data_error, "dataservice: invalid cursor.")
+
+    return result
+
+
+def get_page(table_name, template, field_list=None, limit=10, order_by=None, cursor=None):
+    """
+
+    Keyset (seek) pagination. Rows are sorted on order_by plus the primary key, and a page starts after the
+    row identified by the cursor instead of skipping offset rows, so deep pages cost the same as the first.
+
+    :param table_name: schema.table
+    :param template: Query template.
+    :param field_list: Fields to return.
+    :param limit: Page size.
+    :param order_by: Optional column to sort on.
+    :param cursor: Token from the previous page, or None for the first page.
+    :return: (rows, cursor for the next page or None if this is the last page)
+    """
+    limit = int(limit)
+    k = ResultCache.make_key(table_name, "page", template, field_list, order_by, limit, cursor)
+    hit, result = result_cache.get(k)
+    if hit:
+        return result
+
+    generation = result_cache.generation(table_name)
+    dt = get_data_table(table_name)
+    keyset_columns = dt.get_keyset_columns(order_by)
+    after = decode_cursor(cursor) if cursor else None
+
+    # The keyset columns of the last row are needed to build the next cursor, even if not requested.
+    q_fields = dt.get_select_list(field_list)
+    extra_columns = [c for c in keyset_columns if c not in q_fields]
+    q_fields = q_fields + extra_columns
+
+    rows = dt.find_by_template(template, q_fields, limit=limit, order_by=order_by, keyset=True,
+                               after=after).get_rows()
+
+    next_cursor = None
+    if rows and len(rows) == limit:
+        next_cursor = encode_cursor([rows[-1][c] for c in keyset_columns])
+
+    if extra_columns:
+        rows = [{c: v for c, v in r.items() if c not in extra_columns} for r in rows]
+
+    result = (rows, next_cursor)
+    result_cache.put(k, result, generation)
+    return result
+
+
+def get_by_primary_keys(table_name, keys, field_list=None):
+    """
+
+    :param table_name: schema.table
+    :param keys: List of key values, each a list in the order of the key columns.
+    :param field_list: Fields to return.
+    :return: List with the row for each key, in the same order, or None where there is no row. Keys found in
+        the result cache are not queried.
+    """
+    result = [None] * len(keys)
+    misses = []
+
+    for i in range(0, len(keys)):
+        hit, r = result_cache.get(ResultCache.make_key(table_name, "key", list(keys[i]), field_list))
+        if hit:
+            result[i] = r
+        else:
+            misses.append(i)
+
+    if misses:
+        generation = result_cache.generation(table_name)
+        dt = get_data_table(table_name)
+        rows = dt.find_by_primary_keys([keys[i] for i in misses], field_list)
+
+        for i, r in zip(misses, rows):
+            result[i] = r
+            result_cache.put(ResultCache.make_key(table_name, "key", list(keys[i]), field_list), r, generation)
+
     return result
 
 
 def create(table_name, new_value):
     dt = get_data_table(table_name)
-    result = dt.insert(new_value)
+    try:
+        result = dt.insert(new_value)
+    finally:
+        invalidate_cache(table_name)
+    return result
+
+
+def create_many(table_name, new_values, batch_size=1000):
+    dt = get_data_table(table_name)
+    try:
+        result = dt.insert_many(new_values, batch_size=batch_size)
+    finally:
+        invalidate_cache(table_name)
+    return result
+
+
+def upsert(table_name, new_value, partial=False):
+    """
+
+    :param table_name: schema.table
+    :param new_value: The record, with the key columns.
+    :param partial: If True, change only the columns in the record. Otherwise replace the row.
+    :return: 1 if the row was inserted, 2 if it was changed, 0 if it was already the same.
+    """
+    dt = get_data_table(table_name)
+    try:
+        result = dt.upsert(new_value, partial=partial)
+    finally:
+        invalidate_cache(table_name)
+    return result
+
+
+def upsert_many(table_name, new_values, partial=False, batch_size=1000):
+    dt = get_data_table(table_name)
+    try:
+        result = dt.upsert_many(new_values, partial=partial, batch_size=batch_size)
+    finally:
+        invalidate_cache(table_name)
     return result
 
 
 def delete(table_name, key_cols):
     dt = get_data_table(table_name)
-    result = dt.delete_by_key(key_cols)
+    try:
+        result = dt.delete_by_key(key_cols)
+    finally:
+        invalidate_cache(table_name)
     return result
 
 
+def update_by_key(table_name, key_cols, new_values):
+    dt = get_data_table(table_name)
+    try:
+        result = dt.update_by_key(key_cols, new_values)
+    finally:
+        invalidate_cache(table_name)
+    return result
 
 
+def update_by_template(table_name, template, new_values):
+    dt = get_data_table(table_name)
+    try:
+        result = dt.update_by_template(template, new_values)
+    finally:
+        invalidate_cache(table_name)
+    return result
 
 
+def _parse_operation(dbname, i, operation):
+    # Check one batch operation and return it with the schema.table name and the key or template resolved.
+    if not isinstance(operation, dict):
+        raise DataException(DataException.data_error, "Batch operation " + str(i) + " is not an object.")
 
+    op = operation.get("op", None)
+    if op not in batch_operations:
+        raise DataException(DataException.data_error,
+                            "Batch operation " + str(i) + ": op must be one of " + ",".join(batch_operations))
 
+    resource = operation.get("resource", None)
+    if not resource:
+        raise DataException(DataException.data_error, "Batch operation " + str(i) + ": no resource.")
 
+    result = {"index": i, "op": op, "table": dbname + "." + resource, "data": operation.get("data", None),
+              "template": operation.get("template", None)}
 
+    key = operation.get("key", None)
+    if key is not None:
+        key = key.split(key_delimiter) if isinstance(key, str) else list(key)
+        result["template"] = dict(zip(get_primary_key_columns(result["table"]), key))
 
+    if op in ("create", "update") and not isinstance(result["data"], dict):
+        raise DataException(DataException.data_error, "Batch operation " + str(i) + ": no data.")
+    if op in ("update", "delete") and not result["template"]:
+        raise DataException(DataException.data_error,
+                            "Batch operation " + str(i) + ": needs a key or a non-empty template.")
 
+    return result
 
 
+def _group_operations(operations):
+    # Runs of consecutive creates on the same table become one group, which insert_many() inserts with one
+    # multi-row INSERT per column list. Every update and delete is a group by itself, because the result reports
+    # the rows changed by each operation. Operations are never reordered, so a later operation sees the effect
+    # of an earlier one.
+    groups = []
+    for o in operations:
+        if groups and o["op"] == "create" and groups[-1][0]["op"] == "create" and \
+                groups[-1][0]["table"] == o["table"]:
+            groups[-1].append(o)
+        else:
+            groups.append([o])
+
+    return groups
+
+
+def batch(dbname, operations, batch_size=1000):
+    """
+
+    Run a list of create, update and delete operations as one transaction on one pooled connection. If any
+    operation fails, nothing is changed. Consecutive creates on the same table are inserted together with
+    multi-row INSERTs. Each update and delete is one statement.
+
+    :param dbname: Schema of the resources in the operations.
+    :param operations: List of operations, see batch_operations.
+    :param batch_size: Maximum rows per multi-row INSERT.
+    :return: List with one entry per operation, in order, of the form {"op": ..., "resource": ..., "count": rows}
+    """
+    operations = [_parse_operation(dbname, i, o) for i, o in enumerate(operations or [])]
+    if not operations:
+        return []
+
+    tables = list(dict.fromkeys([o["table"] for o in operations]))
+    pool = get_data_table(tables[0])._pool
+    if any(get_data_table(t)._pool is not pool for t in tables):
+        raise DataException(DataException.data_error, "A batch cannot span databases.")
+
+    result = [None] * len(operations)
+
+    try:
+        with pool.connection() as cnx:
+            for group in _group_operations(operations):
+                first = group[0]
+                dt = get_data_table(first["table"])
+                try:
+                    if first["op"] == "create":
+                        dt.insert_many([o["data"] for o in group], batch_size=batch_size, cnx=cnx)
+                        counts = [1] * len(group)
+                    elif first["op"] == "update":
+                        counts = [dt.update_by_template(first["template"], first["data"], cnx=cnx)]
+                    else:
+                        counts = [dt.delete_by_template(first["template"], cnx=cnx)]
+
+                except DataException as e:
+                    raise DataException(e.code, _batch_error_prefix(group) + str(e.message),
+                                        e.original_exception)
+                except aeneid.dbservices.DataExceptions.pymysql_exceptions as e:
+                    mapped = DataException.map_exception(e)
+                    mapped.message = _batch_error_prefix(group) + str(e)
+                    raise mapped
+
+                for o, n in zip(group, counts):
+                    result[o["index"]] = {"op": o["op"], "resource": o["table"], "count": n}
+
+            cnx.commit()
+
+    finally:
+        for t in tables:
+            invalidate_cache(t)
+
+    return result
+
 
+def _batch_error_prefix(group):
+    if len(group) == 1:
+        where = str(group[0]["index"])
+    else:
+        where = str(group[0]["index"]) + "-" + str(group[-1]["index"])
+    return "Batch operation " + where + " (" + group[0]["op"] + " " + group[0]["table"] + "): "
 
 
+startup_stats["import_time"] = time.perf_counter() - _import_start
@@ -0,0 +1,345 @@
+#Xinquan Wang -- xw2566
+
+
+# Benchmarks for the data service. These need the HW1 schema in a local MySQL, like unit_tests.py.
+# The result cache is turned off so that every call goes to the database.
+
+import time
+import json
+from aeneid.dbservices import dataservice as ds
+from aeneid.dbservices.CSVDataTable import CSVDataTable
+import csv
+import os
+import random
+import tempfile
+
+
+ds.set_result_cache(None)
+
+
+def time_it(fn, repeat=5):
+    """
+
+    :param fn: Function to time.
+    :param repeat: Number of runs.
+    :return: The best time in milliseconds.
+    """
+    best = None
+    for i in range(0, repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = (time.perf_counter() - start) * 1000.0
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def pagination_benchmark(pages=(1, 10, 100, 1000, 5000), limit=20):
+
+    # Offset pagination scans offset + limit rows, so its latency grows with the page number.
+    # Keyset pagination seeks on the primary key and should stay flat.
+    result = []
+
+    # Walk the keyset pages once to collect the cursor for the start of each measured page.
+    cursors = {}
+    cursor = None
+    for p in range(1, max(pages) + 1):
+        if p in pages:
+            cursors[p] = cursor
+        rows, cursor = ds.get_page("HW1.batting", None, limit=limit, cursor=cursor)
+        if cursor is None:
+            break
+
+    for p in pages:
+        if p not in cursors:
+            continue
+
+        offset_ms = time_it(lambda: ds.get_by_template("HW1.batting", None, limit=limit,
+                                                       offset=(p - 1) * limit))
+        keyset_ms = time_it(lambda: ds.get_page("HW1.batting", None, limit=limit, cursor=cursors[p]))
+        result.append({"page": p, "offset_ms": round(offset_ms, 2), "keyset_ms": round(keyset_ms, 2)})
+
+    print("pagination_benchmark: \n", json.dumps(result, indent=2))
+
+
+def insert_benchmark(n=2000):
+
+    # Compare rows/sec for one INSERT and commit per row against batched multi-row inserts.
+    def records(prefix):
+        return [{"id": prefix + str(i), "last_name": "Bench", "first_name": "Mark", "email": "bench@columbia.edu"}
+                for i in range(0, n)]
+
+    dt = ds.get_data_table("HW1.fantasy_manager")
+    result = {}
+
+    start = time.perf_counter()
+    for r in records("s"):
+        dt.insert(r)
+    result["single_rows_per_sec"] = round(n / (time.perf_counter() - start), 1)
+    dt.delete_by_template({"last_name": "Bench"})
+
+    for batch_size in (100, 1000):
+        start = time.perf_counter()
+        dt.insert_many(records("m"), batch_size=batch_size)
+        result["batch_" + str(batch_size) + "_rows_per_sec"] = round(n / (time.perf_counter() - start), 1)
+        dt.delete_by_template({"last_name": "Bench"})
+
+    print("insert_benchmark: \n", json.dumps(result, indent=2))
+
+
+def make_batting_csv(directory, rows=105000):
+
+    # Synthetic file with the shape of the Lahman Batting.csv (about 105k rows).
+    random.seed(1)
+    teams = ["BOS", "NYA", "CHN", "LAN", "SFN", "DET", "CLE", "PHI"] + ["T" + str(i) for i in range(0, 22)]
+    with open(os.path.join(directory, "Batting.csv"), "w", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(["playerID", "yearID", "stint", "teamID", "lgID", "G", "AB", "R", "H", "HR"])
+        for i in range(0, rows):
+            w.writerow(["p" + str(i // 5).zfill(5), 1871 + i % 148, i % 5 + 1, random.choice(teams), "AL",
+                        random.randint(1, 162), random.randint(0, 600), random.randint(0, 150),
+                        random.randint(0, 250), random.randint(0, 50)])
+
+
+def csv_index_benchmark(directory=None):
+
+    # Compare indexed lookups in CSVDataTable with a linear scan over a list of row dictionaries.
+    # Pass the directory holding the real Lahman Batting.csv, or a synthetic file is generated.
+    tmp = None
+    if directory is None:
+        tmp = tempfile.TemporaryDirectory()
+        directory = tmp.name
+        make_batting_csv(directory)
+
+    t = CSVDataTable("Batting.csv", {"directory": directory},
+                     key_columns=["playerID", "yearID", "teamID", "stint"], index_columns=["teamID"])
+    load_ms = time_it(t.load, repeat=1)
+    rows = t.find_by_template(None).get_rows()
+    target = rows[len(rows) // 2]
+    key = [target["playerID"], target["yearID"], target["teamID"], target["stint"]]
+
+    result = {
+        "rows": len(rows),
+        "load_ms": round(load_ms, 2),
+        "key_indexed_ms": round(time_it(lambda: t.find_by_primary_key(key)), 4),
+        "key_scan_ms": round(time_it(lambda: [r for r in rows if r["playerID"] == key[0] and
+                                              r["yearID"] == key[1] and r["teamID"] == key[2] and
+                                              r["stint"] == key[3]]), 4),
+        "team_year_indexed_ms": round(time_it(lambda: t.find_by_template({"teamID": "BOS", "yearID": "1960"})), 4),
+        "team_year_scan_ms": round(time_it(lambda: [r for r in rows if r["teamID"] == "BOS" and
+                                                    r["yearID"] == "1960"]), 4)
+    }
+
+    if tmp is not None:
+        tmp.cleanup()
+
+    print("csv_index_benchmark: \n", json.dumps(result, indent=2))
+
+
+def projection_benchmark(limit=1000):
+
+    # Bytes read and serialized for a page of the wide batting table, with all columns and with a projection.
+    from aeneid.dbservices.RDBDataTable import RDBDataTable
+    RDBDataTable.collect_io_stats = True
+    dt = ds.get_data_table("HW1.batting")
+    result = {}
+
+    for name, fields in (("all_columns", None), ("projected", ["playerID", "yearID", "teamID", "HR"])):
+        before = dt.get_io_stats()["bytes_read"]
+        start = time.perf_counter()
+        rows = ds.get_by_template("HW1.batting", None, field_list=fields, limit=limit)
+        serialized = json.dumps(rows, default=str)
+        result[name] = {
+            "bytes_read": dt.get_io_stats()["bytes_read"] - before,
+            "bytes_serialized": len(serialized),
+            "ms": round((time.perf_counter() - start) * 1000.0, 2)
+        }
+
+    RDBDataTable.collect_io_stats = False
+    print("projection_benchmark: \n", json.dumps(result, indent=2))
+
+
+def statement_cache_benchmark(n=10000):
+
+    # Time to build a SELECT for find_by_template with and without the compiled statement cache.
+    # The query itself is not run, so this measures only the Python side of each request.
+    from aeneid.dbservices.RDBDataTable import RDBDataTable
+    dt = ds.get_data_table("HW1.batting")
+    template = {"teamID": "BOS", "yearID": "1960"}
+    fields = ["playerID", "yearID", "teamID", "HR"]
+    result = {}
+
+    for name, enabled in (("uncached", False), ("cached", True)):
+        RDBDataTable.use_statement_cache = enabled
+        dt.clear_statement_cache()
+        ms = time_it(lambda: [dt._build_select(template, fields, limit=10, offset=20, order_by="HR")
+                              for i in range(0, n)])
+        result[name + "_us_per_query"] = round(ms * 1000.0 / n, 2)
+
+    RDBDataTable.use_statement_cache = True
+    print("statement_cache_benchmark: \n", json.dumps(result, indent=2))
+
+
+def include_benchmark(page_sizes=(10, 50, 100), related=("HW1.batting", "HW1.appearances")):
+
+    # Queries and time to load a page of people with their batting and appearances rows: one request per
+    # player per relation (N + 1) against ?include= (one IN query per relation).
+    from aeneid.dbservices.RDBDataTable import RDBDataTable
+    RDBDataTable.collect_io_stats = True
+    tables = ["HW1.people"] + list(related)
+
+    def count_queries():
+        return sum(ds.get_data_table(t).get_io_stats()["queries"] for t in tables)
+
+    def per_row(limit):
+        rows = ds.get_by_template("HW1.people", None, limit=limit)
+        for r in rows:
+            for t in related:
+                ds.get_related("HW1.people", [r["playerID"]], t)
+
+    def included(limit):
+        rows = ds.get_by_template("HW1.people", None, limit=limit)
+        ds.include_related("HW1.people", rows, list(related))
+
+    result = []
+    for limit in page_sizes:
+        e = {"page_size": limit}
+        for name, fn in (("per_row", per_row), ("include", included)):
+            before = count_queries()
+            start = time.perf_counter()
+            fn(limit)
+            e[name + "_ms"] = round((time.perf_counter() - start) * 1000.0, 2)
+            e[name + "_queries"] = count_queries() - before
+        result.append(e)
+
+    RDBDataTable.collect_io_stats = False
+    print("include_benchmark: \n", json.dumps(result, indent=2))
+
+
+def async_benchmark(concurrency=(1, 10, 50, 100), n=2000):
+
+    # Primary key lookups with n requests in flight at most `concurrency` at a time: the blocking path with one
+    # thread per request in flight, against the async path with one coroutine per request. Without aiomysql the
+    # async path runs in the bounded threadpool, so the comparison is only meaningful with the driver installed.
+    import asyncio
+    import statistics
+    from concurrent.futures import ThreadPoolExecutor
+    from aeneid.dbservices import AsyncRDBDataTable
+
+    keys = [[r["playerID"]] for r in ds.get_by_template("HW1.people", None, field_list=["playerID"], limit=1000)]
+    requests = [random.choice(keys) for i in range(0, n)]
+
+    def summary(name, c, elapsed, latencies):
+        latencies = sorted(latencies)
+        return {"path": name, "concurrency": c, "requests_per_s": round(n / elapsed, 1),
+                "p50_ms": round(statistics.median(latencies), 3),
+                "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1], 3)}
+
+    def sync_run(c):
+        def one(k):
+            start = time.perf_counter()
+            ds.get_by_primary_key("HW1.people", k)
+            return (time.perf_counter() - start) * 1000.0
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=c) as executor:
+            latencies = list(executor.map(one, requests))
+        return summary("sync", c, time.perf_counter() - start, latencies)
+
+    async def async_run(c):
+        semaphore = asyncio.Semaphore(c)
+
+        async def one(k):
+            async with semaphore:
+                start = time.perf_counter()
+                await ds.get_by_primary_key_async("HW1.people", k)
+                return (time.perf_counter() - start) * 1000.0
+
+        start = time.perf_counter()
+        latencies = await asyncio.gather(*[one(k) for k in requests])
+        result = summary("async", c, time.perf_counter() - start, latencies)
+        await AsyncRDBDataTable.close_pools()
+        return result
+
+    result = []
+    for c in concurrency:
+        result.append(sync_run(c))
+        result.append(asyncio.run(async_run(c)))
+
+    print("async_benchmark: driver = ", "aiomysql" if AsyncRDBDataTable.has_driver() else "threadpool")
+    print("async_benchmark: \n", json.dumps(result, indent=2))
+
+
+def serializer_benchmark(page_sizes=(100, 1000, 10000)):
+
+    # Per row time to encode a page of batting as the JSON response document: json.dumps(default=str), the
+    # Serializer on the json module, and the Serializer on orjson (if installed) with the column encoders.
+    import aeneid.dbservices.Serializer as Serializer
+    encoders = ds.get_encoders("HW1.batting")
+    result = []
+
+    for limit in page_sizes:
+        doc = {"data": ds.get_by_template("HW1.batting", None, limit=limit)}
+        n = len(doc["data"])
+        e = {"page_size": n, "encoded_columns": sorted(encoders.keys())}
+
+        e["json_default_str_us_per_row"] = round(time_it(lambda: json.dumps(doc, default=str)) * 1000.0 / n, 3)
+
+        Serializer.use_orjson = False
+        e["serializer_json_us_per_row"] = round(time_it(lambda: Serializer.dumpb(doc, encoders)) * 1000.0 / n, 3)
+
+        Serializer.use_orjson = True
+        if Serializer.has_orjson():
+            e["serializer_orjson_us_per_row"] = round(time_it(lambda: Serializer.dumpb(doc, encoders)) * 1000.0 / n,
+                                                      3)
+        result.append(e)
+
+    print("serializer_benchmark: \n", json.dumps(result, indent=2))
+
+
+def compression_benchmark(limit=1000, levels=(1, 6, 9)):
+
+    # Size and time to compress a page of batting with each available encoding and level.
+    import aeneid.dbservices.Serializer as Serializer
+    from aeneid.utils import compressutils
+    data = Serializer.dumpb({"data": ds.get_by_template("HW1.batting", None, limit=limit)})
+    result = []
+
+    for encoding in compressutils.available():
+        for level in levels:
+            compressutils.levels[encoding] = level
+            out = compressutils.compress(data, encoding)
+            ms = time_it(lambda: compressutils.compress(data, encoding))
+            result.append({"encoding": encoding, "level": level, "input_bytes": len(data), "output_bytes": len(out),
+                           "ratio": round(len(out) / len(data), 4), "ms": round(ms, 3)})
+
+    print("compression_benchmark: \n", json.dumps(result, indent=2))
+
+
+print("pagination_benchmark()")
+pagination_benchmark()
+
+print("insert_benchmark()")
+insert_benchmark()
+
+print("csv_index_benchmark()")
+csv_index_benchmark()
+
+print("projection_benchmark()")
+projection_benchmark()
+
+print("statement_cache_benchmark()")
+statement_cache_benchmark()
+
+print("include_benchmark()")
+include_benchmark()
+
+print("async_benchmark()")
+async_benchmark()
+
+print("serializer_benchmark()")
+serializer_benchmark()
+
+print("compression_benchmark()")
+compression_benchmark()
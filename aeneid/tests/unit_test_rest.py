@@ -164,6 +164,101 @@ def test_delete_manager():
 
 
 
+def test_head_and_bad_bodies():
+
+    # HEAD on a row returns the GET headers without a body. Bodies that are not JSON objects are a 400.
+    url = "http://127.0.0.1:5000/api/HW1/people/willite01"
+    result = requests.head(url)
+    print("\ntest_head_and_bad_bodies: HEAD = ", result.status_code, result.headers.get("ETag"), len(result.content))
+
+    url = "http://127.0.0.1:5000/api/HW1/people/willite01/appearances"
+    for body in [["not", "an", "object"], 5]:
+        result = requests.post(url, json=body)
+        print("test_head_and_bad_bodies: related POST ", body, " = ", result.status_code, result.text)
+
+    result = requests.put("http://127.0.0.1:5000/api/HW1/fantasy_manager/ok1", data="not json")
+    print("test_head_and_bad_bodies: PUT = ", result.status_code, result.text)
+
+
+def test_etag():
+
+    # A GET with the ETag of the current response is a 304 with no body. After a change it is a 200 again.
+    url = "http://127.0.0.1:5000/api/HW1/people"
+    params = {"nameLast": "Williams", "limit": 5}
+    result = requests.get(url, params=params)
+    etag = result.headers.get("ETag")
+    print("\ntest_etag: ETag = ", etag)
+
+    result = requests.get(url, params=params, headers={"If-None-Match": etag})
+    print("test_etag: If-None-Match = ", result.status_code, len(result.content))
+
+    result = requests.get(url, params=params, headers={"If-None-Match": '"not-the-etag"'})
+    print("test_etag: other ETag = ", result.status_code)
+
+
+def test_ndjson():
+
+    # Each line of a streamed response is one JSON row.
+    url = "http://127.0.0.1:5000/api/HW1/batting"
+    params = {"playerID": "willite01", "fields": "playerID,yearID,H"}
+    result = requests.get(url, params=dict(params, stream="ndjson"))
+    rows = [json.loads(l) for l in result.text.splitlines() if l]
+    print("\ntest_ndjson: content type = ", result.headers.get("Content-Type"))
+    print("test_ndjson: rows = ", json.dumps(rows, indent=2))
+
+
+def test_multi_get():
+
+    # Missing ids are null in data and listed in missing. A body without a list of ids is a 400.
+    url = "http://127.0.0.1:5000/api/HW1/people/_mget"
+    result = requests.post(url, json={"ids": ["nosuchplayer", "willite01"], "fields": ["playerID", "nameLast"]})
+    print("\ntest_multi_get: result = ", result.status_code, json.dumps(result.json(), indent=2))
+
+    result = requests.post(url, json={"ids": "willite01"})
+    print("test_multi_get: ids not a list = ", result.status_code)
+
+    result = requests.post(url, data="not json")
+    print("test_multi_get: not JSON = ", result.status_code)
+
+
+def test_include():
+
+    # ?include= embeds the related rows in each row.
+    url = "http://127.0.0.1:5000/api/HW1/people"
+    params = {"playerID": "willite01", "fields": "playerID,nameLast", "include": "batting"}
+    result = requests.get(url, params=params)
+    print("\ntest_include: result = ", result.status_code, json.dumps(result.json(), indent=2))
+
+
+def test_count():
+
+    # HEAD with ?count=exact returns the count headers and no body. GET returns the count with the rows.
+    url = "http://127.0.0.1:5000/api/HW1/batting"
+    params = {"playerID": "willite01", "count": "exact"}
+    result = requests.head(url, params=params)
+    print("\ntest_count: HEAD = ", result.status_code, result.headers.get("X-Total-Count"),
+          result.headers.get("X-Total-Count-Type"), len(result.content))
+
+    result = requests.get(url, params=dict(params, fields="playerID,yearID"))
+    print("test_count: GET = ", result.status_code, result.headers.get("X-Total-Count"), len(result.json()["data"]))
+
+
+def test_compression():
+
+    # A large enough response is gzipped when the client asks for it, with its own ETag. The ETag of either form
+    # gives a 304.
+    url = "http://127.0.0.1:5000/api/HW1/batting"
+    params = {"teamID": "BOS", "limit": 100}
+    result = requests.get(url, params=params, headers={"Accept-Encoding": "gzip"})
+    etag = result.headers.get("ETag")
+    print("\ntest_compression: headers = ", result.headers.get("Content-Encoding"), etag,
+          result.headers.get("Vary"))
+
+    result = requests.get(url, params=params, headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    print("test_compression: If-None-Match = ", result.status_code)
+
+    result = requests.get(url, params=params, headers={"Accept-Encoding": "identity"})
+    print("test_compression: identity = ", result.headers.get("Content-Encoding"), result.headers.get("ETag"))
 
 
 test_api_1()
@@ -172,3 +267,10 @@ test_create_manager()
 test_delete_manager()
 print("After deleting manager with id 'ok1'")
 retrieve_manager()
+test_head_and_bad_bodies()
+test_etag()
+test_ndjson()
+test_multi_get()
+test_include()
+test_count()
+test_compression()
@@ -2,11 +2,34 @@
 
 
 from aeneid.dbservices.RDBDataTable import RDBDataTable
+from aeneid.dbservices.DerivedDataTable import DerivedDataTable
+from aeneid.dbservices.CSVDataTable import CSVDataTable
+from aeneid.dbservices.DataExceptions import DataException
 import logging
 logging.basicConfig(level=logging.DEBUG)
 from aeneid.dbservices import dataservice as ds
+from aeneid.dbservices.ResultCache import ResultCache, InMemoryCacheBackend
+import aeneid.dbservices.ConnectionPool as ConnectionPool
+import aeneid.dbservices.AsyncRDBDataTable as AsyncRDBDataTable
+import aeneid.utils.dffutils as dffutils
+import gc
+import threading
+import tempfile
+import os
 import pymysql
 import json
+import time
+import asyncio
+from contextlib import contextmanager
+import datetime
+import decimal
+import aeneid.dbservices.Serializer as Serializer
+import aeneid.dbservices.Metrics as Metrics
+import aeneid.dbservices.QueryLog as QueryLog
+import aeneid.utils.compressutils as compressutils
+import gzip
+import zlib
+import logging.handlers
 
 
 cnx = pymysql.connect(
@@ -18,6 +41,18 @@ cnx = pymysql.connect(
     cursorclass=pymysql.cursors.DictCursor)
 
 
+@contextmanager
+def saved_state():
+    # Tests that change the result cache or the log level put them back, so the tests do not depend on order.
+    cache = ds.result_cache
+    level = logging.getLogger().level
+    try:
+        yield
+    finally:
+        ds.set_result_cache(cache)
+        logging.getLogger().setLevel(level)
+
+
 def create_rdb_test():
 
     tbl = RDBDataTable("people")
@@ -79,6 +114,621 @@ def get_join_column_mapping(schema1, table1, schema2, table2):
     return result
 
 
+def pool_test():
+
+    # Several lookups on different tables should reuse the same pooled connection.
+    ds.get_by_primary_key("HW1.people", ["willite01"])
+    ds.get_by_template("HW1.batting", {"playerID": "willite01"}, limit=5)
+    print("pool_test: ", json.dumps(ds.get_pool_stats(), indent=2, default=str))
+
+
+def pool_warm_up_test():
+
+    # The second of four connects fails. The reserved slots are given back, and the next warm up opens the rest.
+    class FakeConnection:
+        def ping(self, reconnect=False):
+            pass
+
+        def rollback(self):
+            pass
+
+        def close(self):
+            pass
+
+    attempts = []
+
+    def connect(connect_info):
+        attempts.append(connect_info)
+        if len(attempts) == 2:
+            raise pymysql.err.OperationalError(2003, "Can't connect")
+        return FakeConnection()
+
+    pool = ConnectionPool.ConnectionPool({"host": "test"}, {"min_size": 4}, connect_fn=connect)
+    try:
+        pool.warm_up()
+    except pymysql.err.OperationalError:
+        pass
+    print("pool_warm_up_test: after failure = ", pool.stats()["idle"], pool._opening, pool._warmed_up)
+    pool.warm_up()
+    print("pool_warm_up_test: after retry = ", pool.stats()["idle"], pool._opening, pool._warmed_up)
+
+
+def pool_health_check_test():
+
+    # Only a connection idle for longer than health_check_idle is pinged. A connection that fails with a
+    # connection error is discarded.
+    pings = []
+
+    class FakeConnection:
+        def ping(self, reconnect=False):
+            pings.append(self)
+
+        def rollback(self):
+            pass
+
+        def close(self):
+            pass
+
+    pool = ConnectionPool.ConnectionPool({"host": "test"}, {"health_check_idle": 0.05},
+                                         connect_fn=lambda connect_info: FakeConnection())
+    for i in range(5):
+        with pool.connection():
+            pass
+    print("pool_health_check_test: pings when busy = ", len(pings))
+
+    time.sleep(0.1)
+    with pool.connection():
+        pass
+    print("pool_health_check_test: pings after idle = ", len(pings))
+
+    try:
+        with pool.connection():
+            raise pymysql.err.OperationalError(2006, "MySQL server has gone away")
+    except pymysql.err.OperationalError:
+        pass
+    print("pool_health_check_test: discarded = ", pool.stats()["discarded"], pool.stats()["idle"])
+
+
+def pool_close_all_test():
+
+    # close_all() closes the idle connections and, on release, the ones in use. Connections opened after it are
+    # reused. A dffutils connection that is dropped without close() goes back to the pool.
+    class FakeConnection:
+        closed = False
+
+        def ping(self, reconnect=False):
+            pass
+
+        def rollback(self):
+            pass
+
+        def close(self):
+            self.closed = True
+
+    pool = ConnectionPool.ConnectionPool({"host": "test"}, {"min_size": 0, "max_size": 1, "checkout_timeout": 0.1},
+                                         connect_fn=lambda connect_info: FakeConnection())
+    idle = pool.get_connection()
+    pool.release(idle)
+    in_use = pool.get_connection()
+    pool.close_all()
+    pool.release(in_use)
+    print("pool_close_all_test: closed = ", idle.closed and in_use.closed and pool.stats()["idle"] == 0)
+
+    cnx = pool.get_connection()
+    pool.release(cnx)
+    print("pool_close_all_test: reused after close_all = ", pool.get_connection() is cnx and not cnx.closed)
+    pool.release(cnx)
+
+    k = ConnectionPool._pool_key(dffutils.get_connect_info())
+    saved = ConnectionPool._pools.get(k, None)
+    ConnectionPool._pools[k] = pool
+    try:
+        dffutils.get_new_connection()
+        gc.collect()
+        print("pool_close_all_test: dropped connection returned = ", pool.stats()["in_use"] == 0)
+    finally:
+        if saved is None:
+            ConnectionPool._pools.pop(k, None)
+        else:
+            ConnectionPool._pools[k] = saved
+
+
+def get_data_table_test():
+
+    # A table that is not in the catalog is a no_such_resource error, and does not get a handle.
+    try:
+        ds.get_data_table("HW1.no_such_table")
+    except DataException as e:
+        print("get_data_table_test: expected failure = ", e.code == DataException.no_such_resource)
+    print("get_data_table_test: no handle = ", "HW1.no_such_table" not in ds.data_tables)
+
+
+def catalog_test():
+
+    # Keys and join columns come from the cached catalog, not SHOW KEYS or a per call query.
+    print("catalog_test: people key = ", ds.get_primary_key_columns("HW1.people"))
+    print("catalog_test: batting key = ", ds.get_primary_key_columns("HW1.batting"))
+    print("catalog_test: people -> batting = ", ds.get_join_columns("HW1.people", "HW1.batting"))
+
+
+def statement_cache_test():
+
+    # Statements are compiled once per shape, and dropped with the table's metadata after a schema change.
+    with saved_state():
+        ds.set_result_cache(None)
+        dt = ds.get_data_table("HW1.people")
+        ds.get_by_template("HW1.people", {"nameLast": "Williams"}, limit=5)
+        ds.get_by_template("HW1.people", {"nameLast": "Smith"}, limit=5)
+        print("statement_cache_test: compiled = ", len(dt._statements))
+        ds.invalidate_metadata("HW1.people")
+        print("statement_cache_test: after invalidate_metadata = ", len(dt._statements))
+
+
+def cache_test():
+
+    # The second read is a hit. The update invalidates HW1.fantasy_manager, so the third read is a miss.
+    with saved_state():
+        ds.set_result_cache(ResultCache(backend=InMemoryCacheBackend()))
+        ds.get_by_template("HW1.fantasy_manager", {"id": "9"})
+        ds.get_by_template("HW1.fantasy_manager", {"id": "9"})
+        ds.update_by_key("HW1.fantasy_manager", ["9"], {"email": "dff9@columbia.edu"})
+        ds.get_by_template("HW1.fantasy_manager", {"id": "9"})
+        stats = ds.get_cache_stats()
+        print("cache_test: ", json.dumps(stats, indent=2, default=str))
+        print("cache_test: one hit, then a miss after the update = ", stats["hits"] == 1 and stats["misses"] == 2)
+
+
+def aggregate_test():
+
+    # Home runs per team in 2004, computed in MySQL and by the in memory engine on the same rows.
+    aggregates = [["sum", "HR"], ["count", "*"]]
+    rdb = ds.get_aggregate("HW1.batting", {"yearID": "2004"}, ["teamID"], aggregates, order_by="teamID")
+    rows = ds.get_by_template("HW1.batting", {"yearID": "2004"}, field_list=["teamID", "HR"])
+    derived = DerivedDataTable("batting", rows).aggregate(None, ["teamID"], aggregates, order_by="teamID")
+    print("aggregate_test: ", json.dumps(rdb[:5], indent=2, default=str))
+    print("aggregate_test: same result = ", rdb == derived.get_rows())
+
+
+def csv_test():
+
+    # Indexed lookups, range filters and aggregates on a small CSV file, checked against a scan of the same rows.
+    rows = [{"playerID": "p" + str(i), "yearID": str(2000 + i % 5), "teamID": ["BOS", "NYA", "CHA"][i % 3],
+             "HR": str(i % 7) if i % 4 else ""} for i in range(0, 60)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, "batting.csv"), "w") as f:
+            f.write("playerID,yearID,teamID,HR\n")
+            for r in rows:
+                f.write(",".join(r.values()) + "\n")
+
+        tbl = CSVDataTable("batting.csv", {"directory": directory}, key_columns=["playerID"],
+                           index_columns=["teamID", "yearID"])
+        tbl.load()
+
+    def scan(test):
+        return [r["playerID"] for r in rows if test(r)]
+
+    def ids(template):
+        return [r["playerID"] for r in tbl.find_by_template(template).get_rows()]
+
+    print("csv_test: eq = ", ids({"teamID": "BOS", "yearID": "2003"}) ==
+          scan(lambda r: r["teamID"] == "BOS" and r["yearID"] == "2003"))
+    print("csv_test: range = ", ids({"yearID[gt]": "2001", "yearID[lte]": "2003"}) ==
+          scan(lambda r: "2001" < r["yearID"] <= "2003"))
+    print("csv_test: in = ", ids({"playerID[in]": "p3,p1,p99"}) == ["p1", "p3"])
+    print("csv_test: unindexed = ", ids({"HR[gte]": "5"}) == scan(lambda r: r["HR"] != "" and int(r["HR"]) >= 5))
+
+    # Templates on indexed columns must not scan the table.
+    tbl._live_rows = None
+    try:
+        print("csv_test: index used = ", len(tbl._find_rows({"teamID": "NYA", "HR": "3"})) ==
+              len(scan(lambda r: r["teamID"] == "NYA" and r["HR"] == "3")))
+    finally:
+        del tbl._live_rows
+
+    print("csv_test: is_indexed = ", [tbl.is_indexed(c) for c in ["playerID", "teamID", "HR"]])
+
+    aggregates = [["sum", "HR"], ["count", "HR"], ["count", "*"], ["max", "HR"]]
+    csv_result = tbl.aggregate({"yearID[gte]": "2001"}, ["teamID"], aggregates, order_by="teamID").get_rows()
+    expected = []
+    for team in sorted(set(r["teamID"] for r in rows)):
+        hr = [int(r["HR"]) for r in rows if r["teamID"] == team and r["yearID"] >= "2001" and r["HR"] != ""]
+        n = len([r for r in rows if r["teamID"] == team and r["yearID"] >= "2001"])
+        expected.append({"teamID": team, "sum_HR": sum(hr), "count_HR": len(hr), "count": n,
+                         "max_HR": str(max(hr))})
+    print("csv_test: aggregate = ", csv_result == expected)
+
+    try:
+        tbl.insert({"yearID": "2010", "teamID": "BOS"})
+    except DataException as e:
+        print("csv_test: insert without key = ", e.code == DataException.data_error)
+
+
+def derived_test():
+
+    # Filters, projection, sorting and key lookups on a result held as a DataFrame. NULL matches no filter, and an
+    # empty result can be filtered.
+    rows = [
+        {"playerID": "a", "teamID": "BOS", "HR": 10},
+        {"playerID": "b", "teamID": None, "HR": None},
+        {"playerID": "c", "teamID": "NYA", "HR": 30}
+    ]
+    tbl = DerivedDataTable("batting", rows, key_columns=["playerID"])
+
+    result = tbl.find_by_template({"HR[gte]": "10"}, field_list=["playerID"], order_by="HR").get_rows()
+    print("derived_test: range = ", result == [{"playerID": "a"}, {"playerID": "c"}])
+    print("derived_test: NULL does not match = ", tbl.find_by_template({"teamID": "None"}).get_rows() == [] and
+          tbl.count_by_template({"teamID[ne]": "BOS"}) == 1)
+    print("derived_test: keys = ", [r["playerID"] if r else None for r in tbl.find_by_primary_keys([["c"], ["x"]])])
+    print("derived_test: is_indexed = ", tbl.is_indexed("playerID"))
+
+    try:
+        tbl.find_by_template({"no_such_column": "1"})
+    except DataException as e:
+        print("derived_test: unknown column = ", e.code == DataException.data_error)
+
+    empty = DerivedDataTable("batting", [])
+    print("derived_test: empty = ", empty.find_by_template({"teamID": "BOS"}, ["playerID"]).get_rows() == [] and
+          empty.count_by_template({"teamID": "BOS"}) == 0)
+
+    try:
+        tbl.upsert({"playerID": "a", "HR": 11})
+    except NotImplementedError:
+        print("derived_test: read only = ", True)
+
+
+def filter_test():
+
+    # Range, IN and prefix filters. The SQL is the same shape for every value, so it is compiled once.
+    t = {"yearID[gte]": "2000", "teamID[in]": "BOS,NYA", "playerID[prefix]": "will"}
+    rows = ds.get_by_template("HW1.batting", t, field_list=["playerID", "yearID", "teamID"], limit=5)
+    print("filter_test: ", json.dumps(rows, indent=2, default=str))
+    print("filter_test: unindexed = ", ds.check_filters("HW1.batting", {"HR[gte]": "50"}))
+
+
+def async_test():
+
+    # The async path returns the same rows as the blocking path, with aiomysql or in the threadpool.
+    async def run():
+        return await asyncio.gather(ds.get_by_primary_key_async("HW1.people", ["willite01"]),
+                                    ds.get_by_template_async("HW1.batting", {"playerID": "willite01"}, limit=5))
+
+    with saved_state():
+        ds.set_result_cache(None)
+        row, rows = asyncio.run(run())
+        print("async_test: driver = ", str(ds.get_async_data_table("HW1.people")))
+        print("async_test: same result = ", row == ds.get_by_primary_key("HW1.people", ["willite01"]) and
+              rows == ds.get_by_template("HW1.batting", {"playerID": "willite01"}, limit=5))
+
+
+def async_metadata_test():
+
+    # Expired metadata is reloaded in the threadpool, not on the event loop, including before a key lookup.
+    catalog = ds.get_data_table("HW1.people")._catalog
+    load_schema = catalog._load_schema
+    threads = []
+
+    def recording_load_schema(schema):
+        threads.append(threading.current_thread().name)
+        return load_schema(schema)
+
+    with saved_state():
+        ds.set_result_cache(None)
+        catalog._load_schema = recording_load_schema
+        try:
+            ds.invalidate_metadata("HW1.people")
+            asyncio.run(ds.get_by_primary_key_async("HW1.people", ["willite01"]))
+        finally:
+            del catalog._load_schema
+
+    print("async_metadata_test: loaded off the event loop = ", threads != [] and
+          all(t.startswith("aeneid-db") for t in threads))
+    print("async_metadata_test: fresh = ", ds.get_data_table("HW1.people").is_metadata_fresh())
+
+
+def async_driver_test():
+
+    # The aiomysql path. Without aiomysql, the same coroutines run in the threadpool (see async_test()).
+    if not AsyncRDBDataTable.has_driver():
+        print("async_driver_test: skipped, aiomysql is not installed")
+        return
+
+    async def run():
+        dt = await ds.warm_up_async("HW1.batting")
+        try:
+            rows = (await dt.find_by_template({"playerID": "willite01"}, ["playerID", "yearID"])).get_rows()
+            count = await dt.count_by_template({"playerID": "willite01"})
+        finally:
+            await AsyncRDBDataTable.close_pools()
+        return rows, count
+
+    with saved_state():
+        ds.set_result_cache(None)
+        rows, count = asyncio.run(run())
+        expected = ds.get_by_template("HW1.batting", {"playerID": "willite01"}, field_list=["playerID", "yearID"])
+    print("async_driver_test: same result = ", rows == expected and count == len(expected))
+
+
+def batch_test():
+
+    # Two creates (one INSERT), an update and a delete in one transaction. The second batch fails on its last
+    # operation, so its create is rolled back.
+    ops = [
+        {"op": "create", "resource": "fantasy_manager", "data": {"id": "20", "last_name": "Ferguson"}},
+        {"op": "create", "resource": "fantasy_manager", "data": {"id": "21", "last_name": "Ferguson"}},
+        {"op": "update", "resource": "fantasy_manager", "key": "20", "data": {"first_name": "Donald"}},
+        {"op": "delete", "resource": "fantasy_manager", "template": {"id": "21"}}
+    ]
+    print("batch_test: ", json.dumps(ds.batch("HW1", ops), indent=2))
+
+    ops = [
+        {"op": "create", "resource": "fantasy_manager", "data": {"id": "22", "last_name": "Ferguson"}},
+        {"op": "update", "resource": "fantasy_manager", "key": "20", "data": {"no_such_column": "x"}}
+    ]
+    try:
+        ds.batch("HW1", ops)
+    except DataException as e:
+        print("batch_test: expected failure = ", e.message)
+    print("batch_test: rolled back = ", ds.get_by_primary_key("HW1.fantasy_manager", ["22"]) is None)
+    ds.delete("HW1.fantasy_manager", ["20"])
+
+
+def upsert_test():
+
+    # Insert (1), partial update (2), the same values again (0), then a replace that resets first_name.
+    r = {"id": "30", "last_name": "Wenger", "first_name": "Arsene"}
+    print("upsert_test: insert = ", ds.upsert("HW1.fantasy_manager", r))
+    print("upsert_test: patch = ", ds.upsert("HW1.fantasy_manager", {"id": "30", "email": "aw@columbia.edu"},
+                                             partial=True))
+    print("upsert_test: unchanged = ", ds.upsert("HW1.fantasy_manager", {"id": "30", "email": "aw@columbia.edu"},
+                                                 partial=True))
+    print("upsert_test: replace = ", ds.upsert("HW1.fantasy_manager", {"id": "30", "last_name": "Wenger"}))
+    print("upsert_test: ", ds.get_by_primary_key("HW1.fantasy_manager", ["30"]))
+    print("upsert_test: bulk = ", ds.upsert_many("HW1.fantasy_manager", [r, {"id": "31", "last_name": "Klopp"}]))
+    ds.delete("HW1.fantasy_manager", ["30"])
+    ds.delete("HW1.fantasy_manager", ["31"])
+
+
+def metrics_test():
+
+    # Prometheus le buckets count the values less than or equal to the bound. 128us is in the 0.000128 bucket.
+    name = "aeneid_test_duration_seconds"
+    Metrics.observe(name, {"route": "/test"}, 0.128)
+    Metrics.observe(name, {"route": "/test"}, 0.129)
+    try:
+        lines = Metrics.to_prometheus().split("\n")
+        expected = [
+            name + '_bucket{route="/test",le="0.000128"} 1',
+            name + '_bucket{route="/test",le="0.000256"} 2',
+            name + '_bucket{route="/test",le="+Inf"} 2',
+            name + '_count{route="/test"} 2'
+        ]
+        print("metrics_test: buckets = ", all(e in lines for e in expected))
+        print("metrics_test: gauges = ", "# TYPE aeneid_pool_in_use gauge" in ds.get_metrics())
+    finally:
+        with Metrics._lock:
+            del Metrics._histograms[(name, (("route", "/test"),))]
+
+
+def serializer_test():
+
+    # Decimal and date columns are converted with str(), with orjson or the json module. A multi get has None for
+    # keys that are not found, including the first one.
+    enc = Serializer.get_encoders({"id": "varchar", "salary": "decimal", "hired": "date"})
+    rows = [None, {"id": "a", "salary": decimal.Decimal("10.50"), "hired": datetime.date(2019, 1, 2)}]
+    expected = {"data": [None, {"id": "a", "salary": "10.50", "hired": "2019-01-02"}], "missing": ["b"]}
+    result = json.loads(Serializer.dumpb({"data": rows, "missing": ["b"]}, enc))
+    print("serializer_test: missing first key = ", result == expected)
+
+    use_orjson = Serializer.use_orjson
+    try:
+        Serializer.use_orjson = False
+        result = json.loads(Serializer.dumpb({"data": rows, "missing": ["b"]}, enc))
+        print("serializer_test: json module = ", result == expected)
+    finally:
+        Serializer.use_orjson = use_orjson
+
+    print("serializer_test: rows not changed = ", isinstance(rows[1]["salary"], decimal.Decimal))
+
+
+def etag_test():
+
+    # The ETag stored for a request is returned until the table changes.
+    with saved_state():
+        ds.set_result_cache(ResultCache(backend=InMemoryCacheBackend()))
+        request_key = "/api/HW1/fantasy_manager?id=9"
+        version = ds.get_table_version("HW1.fantasy_manager")
+        ds.put_etag("HW1.fantasy_manager", request_key, "abc", version)
+        print("etag_test: stored = ", ds.get_etag("HW1.fantasy_manager", request_key) == "abc")
+
+        ds.update_by_key("HW1.fantasy_manager", ["9"], {"email": "dff9@columbia.edu"})
+        print("etag_test: dropped after a write = ", ds.get_etag("HW1.fantasy_manager", request_key) is None)
+
+        # An ETag computed before a write is not stored, because the response may not include the write.
+        ds.put_etag("HW1.fantasy_manager", request_key, "abc", version)
+        print("etag_test: stale version = ", ds.get_etag("HW1.fantasy_manager", request_key) is None)
+
+
+def keyset_test():
+
+    # Following the cursors returns every row once. A cursor that was not made by get_page is an error.
+    with saved_state():
+        ds.set_result_cache(None)
+        template = {"playerID": "willite01"}
+        fields = ["playerID", "yearID", "stint", "teamID"]
+        all_rows = ds.get_by_template("HW1.batting", template, fields)
+
+        pages = []
+        rows, cursor = ds.get_page("HW1.batting", template, fields, limit=2)
+        pages.append(rows)
+        while cursor is not None:
+            rows, cursor = ds.get_page("HW1.batting", template, fields, limit=2, cursor=cursor)
+            pages.append(rows)
+
+        paged = [r for p in pages for r in p]
+        keys = [(r["yearID"], r["stint"], r["teamID"]) for r in paged]
+        print("keyset_test: pages = ", [len(p) for p in pages])
+        print("keyset_test: every row once = ", len(keys) == len(set(keys)) and
+              sorted(keys) == sorted((r["yearID"], r["stint"], r["teamID"]) for r in all_rows))
+
+        try:
+            ds.get_page("HW1.batting", template, fields, limit=2, cursor="not a cursor")
+            print("keyset_test: bad cursor = False")
+        except DataException as de:
+            print("keyset_test: bad cursor = ", de.code == DataException.data_error)
+
+
+def stream_test():
+
+    # A stream returns the same rows as the query it streams.
+    template = {"playerID": "willite01"}
+    fields = ["playerID", "yearID", "teamID", "H"]
+    rows = ds.get_by_template("HW1.batting", template, fields, order_by="yearID")
+    streamed = list(ds.stream_by_template("HW1.batting", template, fields, order_by="yearID"))
+    print("stream_test: same rows = ", streamed == rows)
+
+    limited = list(ds.stream_by_template("HW1.batting", template, fields, limit=2, offset=1, order_by="yearID"))
+    print("stream_test: limit and offset = ", limited == rows[1:3])
+
+
+def multi_get_test():
+
+    # The rows come back in the order of the keys, with None for a key that has no row, wherever it is.
+    with saved_state():
+        ds.set_result_cache(None)
+        keys = [["nosuchplayer"], ["willite01"], ["nosuchplayer2"], ["willite01"]]
+        rows = ds.get_by_primary_keys("HW1.people", keys, ["playerID", "nameLast"])
+        print("multi_get_test: rows = ", rows)
+        print("multi_get_test: order and missing = ",
+              rows[0] is None and rows[2] is None and rows[1]["playerID"] == "willite01" and rows[3] == rows[1])
+        print("multi_get_test: no keys = ", ds.get_by_primary_keys("HW1.people", [], ["playerID"]) == [])
+
+
+def query_log_test():
+
+    # Sampling at 0 logs nothing, and at 1 logs every query with the SQL as a record attribute. Turning the
+    # log off again restores the defaults.
+    rate = QueryLog.sample_rate
+    handler = logging.handlers.BufferingHandler(1000)
+    with saved_state():
+        ds.set_result_cache(None)
+        try:
+            QueryLog.configure(rate=0, handler=handler, use_queue=False)
+            ds.get_by_template("HW1.people", {"playerID": "willite01"}, ["playerID"])
+            print("query_log_test: rate 0 = ", len(handler.buffer) == 0)
+
+            QueryLog.configure(rate=1, handler=handler)
+            ds.get_by_template("HW1.people", {"playerID": "willite01"}, ["playerID"])
+            ds.get_by_template("HW1.batting", {"playerID": "willite01"}, ["playerID"])
+            QueryLog.shutdown()
+            print("query_log_test: rate 1 = ", len(handler.buffer) == 2 and
+                  all(r.sql and r.elapsed_ms >= 0 for r in handler.buffer))
+        finally:
+            QueryLog.shutdown()
+            QueryLog.configure(level=logging.INFO, rate=rate)
+
+    print("query_log_test: off = ", not QueryLog.is_enabled())
+
+
+def related_test():
+
+    # Navigating from a player to batting returns the same rows as querying batting for the player. Tables
+    # without a foreign key between them are not related.
+    print("related_test: join columns = ", ds.get_join_columns("HW1.people", "HW1.batting"))
+
+    fields = ["playerID", "yearID", "teamID", "H"]
+    related = ds.get_related("HW1.people", ["willite01"], "HW1.batting", field_list=fields, order_by="yearID")
+    rows = ds.get_by_template("HW1.batting", {"playerID": "willite01"}, fields, order_by="yearID")
+    print("related_test: same rows = ", len(related) > 0 and related == rows)
+
+    related = ds.get_related("HW1.people", ["willite01"], "HW1.batting", template={"yearID": "1941"},
+                             field_list=fields)
+    print("related_test: with template = ", [r["yearID"] for r in related])
+
+    try:
+        ds.get_related("HW1.people", ["willite01"], "HW1.fantasy_manager")
+        print("related_test: not related = False")
+    except DataException as de:
+        print("related_test: not related = ", de.code == DataException.no_such_resource)
+
+
+def include_test():
+
+    # Each row gets its batting rows, or an empty list if it has none. The input rows are not changed.
+    print("include_test: columns = ", ds.get_include_columns("HW1.people", ["HW1.batting"]))
+
+    rows = [{"playerID": "willite01", "nameLast": "Williams"}, {"playerID": "nosuchplayer", "nameLast": "None"}]
+    before = json.dumps(rows)
+    fields = ["playerID", "yearID", "H"]
+    result = ds.include_related("HW1.people", rows, ["HW1.batting"], field_list=fields)
+
+    batting = ds.get_by_template("HW1.batting", {"playerID": "willite01"}, fields)
+    key = lambda r: r["yearID"]
+    print("include_test: embedded = ", sorted(result[0]["batting"], key=key) == sorted(batting, key=key))
+    print("include_test: no related rows = ", result[1]["batting"] == [])
+    print("include_test: input unchanged = ", json.dumps(rows) == before)
+
+    # The join column is selected even if the default fields leave it out, and removed again from the response.
+    ds.set_default_fields("HW1.people", ["nameLast"])
+    try:
+        select_list, extra_columns = ds.get_include_fields("HW1.people", ["HW1.batting"])
+        print("include_test: default fields = ", select_list == ["nameLast", "playerID"] and
+              extra_columns == ["playerID"])
+        rows = ds.get_by_template("HW1.people", {"playerID": "willite01"}, select_list)
+        result = ds.include_related("HW1.people", rows, ["HW1.batting"], field_list=fields,
+                                    drop_columns=extra_columns)
+        print("include_test: join column dropped = ", list(result[0].keys()) == ["nameLast", "batting"] and
+              len(result[0]["batting"]) == len(batting))
+    finally:
+        ds.set_default_fields("HW1.people", None)
+
+
+def count_test():
+
+    # The exact count is the number of matching rows. The estimate is a number, but may differ.
+    with saved_state():
+        ds.set_result_cache(None)
+        template = {"playerID": "willite01"}
+        rows = ds.get_by_template("HW1.batting", template, ["playerID"])
+        print("count_test: exact = ", ds.get_count("HW1.batting", template) == len(rows))
+        print("count_test: no rows = ", ds.get_count("HW1.batting", {"playerID": "nosuchplayer"}) == 0)
+        print("count_test: estimate = ", isinstance(ds.get_count("HW1.batting", template, mode="estimate"), int))
+
+        try:
+            ds.get_count("HW1.batting", template, mode="roughly")
+            print("count_test: bad mode = False")
+        except DataException as de:
+            print("count_test: bad mode = ", de.code == DataException.data_error)
+
+
+def compress_test():
+
+    # The encoding follows the client's q-values. Small bodies and bodies that are not text are not compressed.
+    # Compressed bodies decompress to the original, and the same body always compresses to the same bytes.
+    large = json.dumps([{"playerID": "willite01", "yearID": y, "H": 180} for y in range(1939, 1961)]).encode()
+    print("compress_test: gzip = ", compressutils.choose_encoding("gzip", len(large)) == "gzip")
+    print("compress_test: q-values = ",
+          compressutils.choose_encoding("gzip;q=0.5, deflate", len(large)) == "deflate")
+    print("compress_test: refused = ", compressutils.choose_encoding("gzip;q=0", len(large)) is None)
+    print("compress_test: any = ", compressutils.choose_encoding("*", len(large)) == compressutils.available()[0])
+    print("compress_test: small = ", compressutils.choose_encoding("gzip", compressutils.min_size - 1) is None)
+    print("compress_test: mimetype = ", compressutils.choose_encoding("gzip", len(large), "image/png") is None)
+    print("compress_test: no header = ", compressutils.choose_encoding(None, len(large)) is None)
+
+    data = compressutils.compress(large, "gzip")
+    print("compress_test: gzip round trip = ", gzip.decompress(data) == large and len(data) < len(large))
+    print("compress_test: deterministic = ", compressutils.compress(large, "gzip") == data)
+    print("compress_test: deflate round trip = ", zlib.decompress(compressutils.compress(large, "deflate")) == large)
+    print("compress_test: variant ETags = ", compressutils.variant_etags("abc")[:1] == ["abc"] and
+          "abc-gzip" in compressutils.variant_etags("abc"))
+
+    try:
+        compressutils.compress(large, "lzma")
+        print("compress_test: unknown encoding = False")
+    except ValueError:
+        print("compress_test: unknown encoding = True")
+
+
 # join_paths = get_join_column_mapping("HW1", "people", "HW1", "batting")
 # print("JOIN paths = \n", json.dumps(join_paths, indent=2, default=str))
 
@@ -88,4 +738,86 @@ create_rdb_test()
 print("create_fantasy_manager()")
 create_fantasy_manager()
 
+print("pool_test()")
+pool_test()
+
+print("pool_warm_up_test()")
+pool_warm_up_test()
+
+print("pool_health_check_test()")
+pool_health_check_test()
+
+print("pool_close_all_test()")
+pool_close_all_test()
+
+print("get_data_table_test()")
+get_data_table_test()
+
+print("catalog_test()")
+catalog_test()
+
+print("statement_cache_test()")
+statement_cache_test()
+
+print("cache_test()")
+cache_test()
+
+print("aggregate_test()")
+aggregate_test()
+
+print("csv_test()")
+csv_test()
+
+print("derived_test()")
+derived_test()
+
+print("filter_test()")
+filter_test()
+
+print("async_test()")
+async_test()
+
+print("async_metadata_test()")
+async_metadata_test()
+
+print("async_driver_test()")
+async_driver_test()
+
+print("batch_test()")
+batch_test()
+
+print("upsert_test()")
+upsert_test()
+
+print("metrics_test()")
+metrics_test()
+
+print("serializer_test()")
+serializer_test()
+
+print("etag_test()")
+etag_test()
+
+print("keyset_test()")
+keyset_test()
+
+print("stream_test()")
+stream_test()
+
+print("multi_get_test()")
+multi_get_test()
+
+print("query_log_test()")
+query_log_test()
+
+print("related_test()")
+related_test()
+
+print("include_test()")
+include_test()
+
+print("count_test()")
+count_test()
 
+print("compress_test()")
+compress_test()
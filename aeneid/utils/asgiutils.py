@@ -0,0 +1,286 @@
+import asyncio
+import io
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_etags
+
+import aeneid.dbservices.Metrics as Metrics
+
+
+# An ASGI front end for the Flask app. URLs are matched with the Flask app's own url_map. A route with an async
+# handler registered for its endpoint is served on the event loop; every other request, and any request the async
+# handler declines, runs the Flask (WSGI) app in a bounded threadpool. This needs no ASGI framework, only an
+# ASGI server, e.g.
+#
+#   uvicorn.run(asgi_app, host="127.0.0.1", port=5000)
+
+
+class AsgiRequest:
+    """
+    The parts of an HTTP request that the async handlers use.
+    """
+
+    def __init__(self, scope):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.query_string = scope.get("query_string", b"").decode("latin-1")
+        self.headers = {}
+        for k, v in scope.get("headers", []):
+            k = k.decode("latin-1").lower()
+            v = v.decode("latin-1")
+            self.headers[k] = self.headers[k] + "," + v if k in self.headers else v
+
+        # Like request.args.items() in Flask, the first value of each parameter.
+        self.args = {}
+        for k, v in parse_qsl(self.query_string, keep_blank_values=True):
+            self.args.setdefault(k, v)
+
+        # Same as Flask's request.full_path, which keys the ETag cache.
+        self.full_path = self.path + "?" + self.query_string
+
+        scheme = scope.get("scheme", "http")
+        host = self.headers.get("host", None)
+        if host is None and scope.get("server"):
+            host = scope["server"][0] + ":" + str(scope["server"][1])
+        self.base_url = scheme + "://" + (host or "localhost") + scope.get("root_path", "") + self.path
+        self.url = self.base_url + ("?" + self.query_string if self.query_string else "")
+
+        # The route pattern, filled in by AsgiApp.
+        self.route = None
+
+    def if_none_match(self, etag):
+        """
+
+        :param etag: An ETag, unquoted.
+        :return: True if the If-None-Match header matches the ETag.
+        """
+        header = self.headers.get("if-none-match", None)
+        return header is not None and parse_etags(header).contains(etag)
+
+
+class AsgiResponse:
+    """
+    A complete (not streamed) response from an async handler.
+    """
+
+    def __init__(self, body=b"", status=200, mimetype="text/plain", headers=None):
+        self.body = body.encode("utf-8") if isinstance(body, str) else body
+        self.status = status
+        self.headers = [("content-type", mimetype)] if mimetype else []
+        self.headers.extend(headers or [])
+
+    async def send(self, send):
+        headers = [(k.encode("latin-1"), str(v).encode("latin-1")) for k, v in self.headers]
+        headers.append((b"content-length", str(len(self.body)).encode("latin-1")))
+        await send({"type": "http.response.start", "status": self.status, "headers": headers})
+        await send({"type": "http.response.body", "body": self.body})
+
+
+class AsgiApp:
+    """
+    ASGI application wrapping a Flask app.
+    """
+
+    def __init__(self, flask_app, max_workers=32):
+        """
+
+        :param flask_app: The Flask app. Its url_map routes every request.
+        :param max_workers: Threads for requests served by the Flask app. Requests beyond this wait in the
+            executor's queue instead of starting more threads.
+        """
+        self._flask_app = flask_app
+        self._max_workers = max_workers
+        self._executor = None
+        self._handlers = {}
+        self._shutdown_hooks = []
+
+    def route(self, endpoint):
+        """
+
+        Register an async handler for a Flask endpoint, e.g.
+
+            @asgi_app.route("handle_resource")
+            async def async_handle_resource(req, dbname, resource_name, primary_key):
+                ...
+
+        The handler gets an AsgiRequest and the URL variables. It returns an AsgiResponse, or None to hand the
+        request to the Flask view.
+
+        :param endpoint: Name of the Flask view function.
+        """
+        def decorator(fn):
+            self._handlers[endpoint] = fn
+            return fn
+        return decorator
+
+    def on_shutdown(self, fn):
+        """
+
+        :param fn: Coroutine function to call on lifespan shutdown, e.g. to close async DB pools.
+        """
+        self._shutdown_hooks.append(fn)
+        return fn
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="aeneid-wsgi")
+        return self._executor
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError("AsgiApp: unsupported scope type " + str(scope["type"]))
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                for fn in self._shutdown_hooks:
+                    try:
+                        await fn()
+                    except Exception:
+                        logging.error("AsgiApp: shutdown hook failed", exc_info=True)
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                    self._executor = None
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _match(self, scope):
+        # (handler, rule, URL variables) if an async handler is registered for the route, else None.
+        if not self._handlers:
+            return None
+
+        adapter = self._flask_app.url_map.bind(server_name="localhost", script_name=scope.get("root_path") or None,
+                                               url_scheme=scope.get("scheme", "http"))
+        try:
+            rule, variables = adapter.match(scope["path"], method=scope["method"], return_rule=True)
+        except HTTPException:
+            return None
+
+        handler = self._handlers.get(rule.endpoint, None)
+        if handler is None:
+            return None
+        return handler, rule.rule, variables
+
+    async def _http(self, scope, receive, send):
+        match = self._match(scope)
+        if match is not None:
+            handler, rule, variables = match
+            start = time.perf_counter()
+            req = AsgiRequest(scope)
+            req.route = rule
+            resp = await handler(req, **variables)
+            if resp is not None:
+                await resp.send(send)
+                if Metrics.enabled:
+                    Metrics.observe("aeneid_request_duration_seconds",
+                                    {"route": rule, "method": scope["method"], "status": str(resp.status)},
+                                    (time.perf_counter() - start) * 1000.0)
+                return
+
+        await self._call_wsgi(scope, receive, send)
+
+    async def _call_wsgi(self, scope, receive, send):
+        body = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            body.append(message.get("body", b""))
+            more_body = message.get("more_body", False)
+
+        environ = make_environ(scope, b"".join(body))
+        loop = asyncio.get_running_loop()
+        started = []
+
+        def send_from_thread(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def run():
+            status_headers = []
+
+            def start_response(status, headers, exc_info=None):
+                if exc_info is not None and started:
+                    raise exc_info[1].with_traceback(exc_info[2])
+                status_headers[:] = [status, headers]
+
+            def start():
+                status, headers = status_headers
+                send_from_thread({"type": "http.response.start", "status": int(status.split(" ", 1)[0]),
+                                  "headers": [(k.lower().encode("latin-1"), v.encode("latin-1"))
+                                              for k, v in headers]})
+                started.append(True)
+
+            result = self._flask_app.wsgi_app(environ, start_response)
+            try:
+                # Chunks are sent as the app produces them, so streamed responses stay streamed.
+                for chunk in result:
+                    if chunk:
+                        if not started:
+                            start()
+                        send_from_thread({"type": "http.response.body", "body": chunk, "more_body": True})
+                if not started:
+                    start()
+                send_from_thread({"type": "http.response.body", "body": b""})
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+
+        await loop.run_in_executor(self._get_executor(), run)
+
+
+def make_environ(scope, body):
+    """
+
+    :param scope: ASGI HTTP scope.
+    :param body: The request body.
+    :return: The WSGI environ for the request.
+    """
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False
+    }
+
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+        environ["REMOTE_PORT"] = str(scope["client"][1])
+
+    for k, v in scope.get("headers", []):
+        k = k.decode("latin-1").upper().replace("-", "_")
+        v = v.decode("latin-1")
+        if k == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = v
+        elif k == "CONTENT_LENGTH":
+            environ["CONTENT_LENGTH"] = v
+        else:
+            k = "HTTP_" + k
+            environ[k] = environ[k] + "," + v if k in environ else v
+
+    # The whole body has been read, e.g. of a chunked request, so its length is known.
+    if body and "CONTENT_LENGTH" not in environ:
+        environ["CONTENT_LENGTH"] = str(len(body))
+
+    return environ
@@ -0,0 +1,141 @@
+import gzip
+import time
+import zlib
+
+from werkzeug.http import parse_accept_header
+
+import aeneid.dbservices.Metrics as Metrics
+
+# brotli and zstd are optional. Without them, only gzip and deflate are offered.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Content-Encoding negotiation for JSON responses. Bodies smaller than min_size are sent as they are; for those
+# the headers and CPU cost more than compression saves.
+
+enabled = True
+min_size = 1024
+
+# Compression level per encoding. Higher is smaller and slower.
+levels = {
+    "zstd": 3,
+    "br": 4,
+    "gzip": 6,
+    "deflate": 6
+}
+
+# Preference when the client accepts several encodings with the same quality.
+preference = ["zstd", "br", "gzip", "deflate"]
+
+# Mimetypes worth compressing.
+compressible = ["application/json", "application/x-ndjson", "text/plain", "text/html"]
+
+
+def available():
+    """
+
+    :return: The encodings that can be produced, in order of preference.
+    """
+    result = []
+    for e in preference:
+        if (e == "br" and brotli is None) or (e == "zstd" and zstandard is None):
+            continue
+        result.append(e)
+
+    return result
+
+
+def choose_encoding(accept_encoding, size, mimetype="application/json"):
+    """
+
+    :param accept_encoding: The Accept-Encoding request header, or None.
+    :param size: Length of the body in bytes.
+    :param mimetype: Mimetype of the body.
+    :return: The encoding to use, or None to send the body uncompressed.
+    """
+    if not enabled or not accept_encoding or size < min_size or mimetype not in compressible:
+        return None
+
+    accept = parse_accept_header(accept_encoding)
+    result = None
+    best = 0
+    for e in available():
+        q = accept[e]
+        if q > best:
+            result, best = e, q
+
+    return result
+
+
+def variant_etags(etag):
+    """
+
+    :param etag: ETag of the uncompressed body.
+    :return: The ETags the body can have: the ETag itself, and etag-<encoding> for each compressed form.
+    """
+    return [etag] + [etag + "-" + e for e in preference]
+
+
+def compress(data, encoding, route=None):
+    """
+
+    Compress a body, and record the time and the input and output sizes for the route.
+
+    :param data: The body, bytes.
+    :param encoding: An encoding from choose_encoding().
+    :param route: Route pattern for the metrics.
+    :return: The compressed body.
+    """
+    start = time.perf_counter()
+    level = levels.get(encoding, None)
+
+    if encoding == "gzip":
+        # mtime=0 so that the same body always compresses to the same bytes.
+        result = gzip.compress(data, compresslevel=level, mtime=0)
+    elif encoding == "deflate":
+        # HTTP deflate is the zlib format, not raw deflate.
+        result = zlib.compress(data, level)
+    elif encoding == "br":
+        result = brotli.compress(data, quality=level)
+    elif encoding == "zstd":
+        result = zstandard.ZstdCompressor(level=level).compress(data)
+    else:
+        raise ValueError("compressutils: unknown encoding " + str(encoding))
+
+    if Metrics.enabled:
+        labels = {"route": route or "", "encoding": encoding}
+        Metrics.observe("aeneid_compression_duration_seconds", labels, (time.perf_counter() - start) * 1000.0)
+        Metrics.increment("aeneid_compression_input_bytes_total", labels, len(data))
+        Metrics.increment("aeneid_compression_output_bytes_total", labels, len(result))
+
+    return result
+
+
+def get_stats():
+    """
+
+    :return: List of {route, encoding, count, input_bytes, output_bytes, ratio, p50_ms, p99_ms}, where ratio is
+        output bytes / input bytes.
+    """
+    inputs = {tuple(sorted(l.items())): n for l, n in Metrics.get_counters("aeneid_compression_input_bytes_total")}
+    outputs = {tuple(sorted(l.items())): n for l, n in Metrics.get_counters("aeneid_compression_output_bytes_total")}
+    hits = {tuple(sorted(l.items())): n for l, n in Metrics.get_counters("aeneid_compression_cache_hits_total")}
+
+    result = []
+    for e in Metrics.get_percentiles("aeneid_compression_duration_seconds", (50, 99)):
+        k = tuple(sorted((n, e[n]) for n in ("encoding", "route")))
+        e["input_bytes"] = inputs.get(k, 0)
+        e["output_bytes"] = outputs.get(k, 0)
+        e["ratio"] = round(e["output_bytes"] / e["input_bytes"], 4) if e["input_bytes"] else None
+        e["cache_hits"] = hits.get(k, 0)
+        result.append(e)
+
+    return result
@@ -1,7 +1,9 @@
 import json
+import weakref
 import pymysql
 #from . import DataTableExceptions               # Exceptions for the solution
 import aeneid.utils.utils as ut
+import aeneid.dbservices.ConnectionPool as ConnectionPool
 
 pymysql_exceptions = (
     pymysql.err.IntegrityError,
@@ -25,13 +27,82 @@ default_db_params = {
 }
 
 def get_new_connection(params=default_db_params):
-    cnx = pymysql.connect(
-        host=params["dbhost"],
-        port=params["port"],
-        user=params["dbuser"],
-        password=params["dbpw"],
-        db=params["dbname"],
-        charset=params["charset"],
-        cursorclass=params["cursorClass"])
-    return cnx
+    """
 
+    Get a connection for the parameters. Connections come from the shared pool, so close() gives the
+    connection back to the pool instead of closing the socket. Parameters the pool does not support (a
+    different cursor class or charset) get a new, unpooled connection.
+
+    :param params: Dictionary in the format of default_db_params.
+    :return: A connection. The caller must call close() when done.
+    """
+    if params.get("cursorClass") is not pymysql.cursors.DictCursor or params.get("charset") != "utf8mb4":
+        return pymysql.connect(
+            host=params["dbhost"],
+            port=params["port"],
+            user=params["dbuser"],
+            password=params["dbpw"],
+            db=params["dbname"],
+            charset=params["charset"],
+            cursorclass=params["cursorClass"])
+
+    pool = ConnectionPool.get_pool(get_connect_info(params))
+    return _BorrowedConnection(pool, pool.get_connection())
+
+
+class _BorrowedConnection:
+    """
+    A pooled connection whose close() returns it to the pool. Everything else goes to the connection. If the
+    caller drops it without calling close(), it goes back to the pool when it is garbage collected.
+    """
+
+    def __init__(self, pool, cnx):
+        self._pool = pool
+        self._cnx = cnx
+        self._finalizer = weakref.finalize(self, pool.release, cnx)
+        self._finalizer.atexit = False
+
+    def __getattr__(self, name):
+        if self._cnx is None:
+            raise pymysql.err.InterfaceError(0, "dffutils: connection is closed.")
+        return getattr(self._cnx, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._cnx is not None:
+            self._cnx = None
+            self._finalizer()
+
+
+def get_connect_info(params=default_db_params):
+    """
+
+    Convert the dffutils style parameters into the connect_info format used by the data tables and pools.
+
+    :param params: Dictionary in the format of default_db_params.
+    :return: Dictionary with host, port, user, password and db.
+    """
+    return {
+        "host": params["dbhost"],
+        "port": params["port"],
+        "user": params["dbuser"],
+        "password": params["dbpw"],
+        "db": params["dbname"]
+    }
+
+
+def get_pooled_connection(params=default_db_params):
+    """
+
+    Borrow a connection from the shared pool instead of opening a new one. Use as
+    "with get_pooled_connection() as cnx:" so that the connection goes back to the pool.
+
+    :param params: Dictionary in the format of default_db_params.
+    :return: A context manager yielding a connection.
+    """
+    return ConnectionPool.get_pool(get_connect_info(params)).connection()